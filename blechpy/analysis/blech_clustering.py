@@ -1,23 +1,30 @@
 import os
+import re
+import json
 import shutil
+import hashlib
+import zipfile
 import numpy as np
 import pandas as pd
 import itertools as it
 import umap
-import pywt
-from statsmodels.stats.diagnostic import lilliefors
-from copy import deepcopy
-from scipy.spatial.distance import mahalanobis
+from copy import copy, deepcopy
 from scipy import linalg
 from scipy.signal import find_peaks
-from scipy.stats import sem
+from scipy.stats import sem, chi2
 from sklearn.mixture import GaussianMixture
-from sklearn.decomposition import PCA
+from sklearn.decomposition import PCA, IncrementalPCA
+from sklearn.metrics import adjusted_rand_score
 from blechpy.utils import write_tools as wt, print_tools as pt, math_tools as mt, userIO
 from blechpy.dio import h5io
 from blechpy.analysis import clustering, spike_analysis as sas
-from blechpy.plotting import data_plot as dplt
+from blechpy.plotting import data_plot as dplt, blech_waveforms_datashader
 import datetime as dt
+import multiprocessing
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 
 def get_detection_threshold(filt_el):
@@ -25,7 +32,8 @@ def get_detection_threshold(filt_el):
     th = 5.0*np.median(np.abs(filt_el)/0.6745)
     return m-th
 
-def detect_spikes(filt_el, spike_snapshot = [0.5, 1.0], fs = 30000.0, thresh = None):
+def detect_spikes(filt_el, spike_snapshot = [0.5, 1.0], fs = 30000.0, thresh = None,
+                  compact=None):
     '''Detects spikes in the filtered electrode trace and return the waveforms
     and spike_times
 
@@ -37,6 +45,10 @@ def detect_spikes(filt_el, spike_snapshot = [0.5, 1.0], fs = 30000.0, thresh = N
         2-elements, [ms before spike minimum, ms after spike minimum] 
         time around spike to snap as waveform
     fs : float, sampling rate in Hz
+    compact : {None, 'float32', 'int16'} (optional)
+        if provided, waves are returned as a tuple of native-rate snippets of
+        this dtype and their sub-sample alignment (see
+        clustering.compact_dejitter) rather than upsampled waveforms
 
     Returns
     -------
@@ -66,7 +78,14 @@ def detect_spikes(filt_el, spike_snapshot = [0.5, 1.0], fs = 30000.0, thresh = N
             times.append(minimum)
 
     if len(waves) == 0:
-        return None, None
+        return None, None, thresh
+
+    if compact is not None:
+        snippets, offsets, times_dj = clustering.compact_dejitter(np.array(waves),
+                                                                  np.array(times),
+                                                                  spike_snapshot,
+                                                                  fs, dtype=compact)
+        return (snippets, offsets), times_dj, thresh
 
     waves_dj, times_dj = clustering.dejitter(np.array(waves), np.array(times), spike_snapshot, fs)
     return waves_dj, times_dj, thresh
@@ -78,7 +97,17 @@ def implement_pca(scaled_slices):
     return pca_slices, pca.explained_variance_ratio_
 
 
-def implement_umap(waves, n_pc=3, n_neighbors=30, min_dist=0.0):
+def implement_umap(waves, n_pc=3, n_neighbors=30, min_dist=0.0, cache=None,
+                   spike_idx=None):
+    '''Returns UMAP embedding of waveforms. If a UmapCache is passed, the
+    embedding is loaded from (or fit once and stored in) the cache. In that
+    case waves must either be all spikes on the electrode or spike_idx must
+    give the indices of waves in the electrode's spike data, in which case
+    they are embedded on their own.
+    '''
+    if cache is not None:
+        return cache.get_embedding(waves, n_components=n_pc, idx=spike_idx)
+
     reducer = umap.UMAP(n_components=n_pc,
                         n_neighbors=n_neighbors,
                         min_dist=min_dist)
@@ -86,18 +115,16 @@ def implement_umap(waves, n_pc=3, n_neighbors=30, min_dist=0.0):
 
 
 def implement_wavelet_transform(waves, n_pc=10):
-    coeffs = pywt.wavedec(waves, 'haar', axis=1)
-    all_coeffs = np.column_stack(coeffs)
-    k_stats = np.zeros((all_coeffs.shape[1],))
-    p_vals = np.ones((all_coeffs.shape[1],))
-    for i, c in enumerate(all_coeffs.T):
-        k_stats[i], p_vals[i] = lilliefors(c, dist='norm')
-
-    idx = np.argsort(p_vals)
+    '''Returns the n_pc Haar wavelet coefficients of waves that are least
+    normally distributed (lowest Lilliefors p-value)
+    '''
+    all_coeffs = clustering.get_wavelet_coefficients(waves)
+    idx = clustering.rank_wavelet_coefficients(all_coeffs)
     return all_coeffs[:, idx[:n_pc]]
 
 
-def compute_waveform_metrics(waves, n_pc=3, umap=False):
+def compute_waveform_metrics(waves, n_pc=3, umap=False, umap_cache=None,
+                             spike_idx=None, pca=None, return_pca=False):
     '''Make clustering data array with columns:
          - amplitudes, energy, slope, pc1, pc2, pc3, etc
     Parameters
@@ -106,10 +133,22 @@ def compute_waveform_metrics(waves, n_pc=3, umap=False):
         waveforms with a row for each spike waveform
     n_pc : int (optional)
         number of principal components to include in data array
+    umap : bool (optional)
+        use UMAP embedding instead of PCA
+    umap_cache : UmapCache (optional)
+        cache of UMAP embeddings to use instead of fitting
+    spike_idx : np.array (optional)
+        indices of waves in the electrode's spike data, required with
+        umap_cache if waves is a subset of the electrode's spikes
+    pca : sklearn.decomposition.PCA (optional)
+        PCA already fit to energy scaled waveforms, used to project waves
+        into an existing feature space instead of fitting a new PCA
+    return_pca : bool (optional)
+        if True, also return the PCA used (None with umap)
 
     Returns
     -------
-    np.array
+    np.array, list of str
     '''
     data = np.zeros((waves.shape[0], 3))
     for i, wave in enumerate(waves):
@@ -126,17 +165,109 @@ def compute_waveform_metrics(waves, n_pc=3, umap=False):
 
     # Scale waveforms to energy before running PCA
     if umap:
-        pc_waves = implement_umap(waves, n_pc=n_pc)
+        pc_waves = implement_umap(waves, n_pc=n_pc, cache=umap_cache,
+                                  spike_idx=spike_idx)
+    elif pca is not None:
+        pc_waves = pca.transform(scale_waveforms(waves, energy=data[:,1]))
     else:
         scaled_waves = scale_waveforms(waves, energy=data[:,1])
-        pc_waves, _ = implement_pca(scaled_waves)
+        pca = PCA()
+        pc_waves = pca.fit_transform(scaled_waves)
 
     data = np.hstack((data, pc_waves[:,:n_pc]))
     data_columns = ['amplitude', 'energy', 'spike_slope']
     data_columns.extend(['PC%i' % i for i in range(n_pc)])
+    if return_pca:
+        return data, data_columns, pca
+
+    return data, data_columns
+
+
+def compute_waveform_metrics_chunked(waves, n_pc=3, chunk_size=50000,
+                                     pca=None, n_fit=None, return_pca=False):
+    '''Out-of-core version of compute_waveform_metrics for large (e.g.
+    memory-mapped) waveform arrays. Waveforms are read chunk_size rows at a
+    time: amplitude, energy and slope are computed per chunk and the PCA of
+    energy scaled waveforms is fit incrementally (IncrementalPCA) then
+    applied chunk by chunk, so peak memory does not depend on the total
+    number of spikes.
+
+    Parameters
+    ----------
+    waves : np.array, np.memmap or clustering.CompactWaveforms
+        waveforms with a row for each spike waveform
+    n_pc : int (optional)
+        number of principal components to include in data array
+    chunk_size : int (optional)
+        number of waveforms to load at a time
+    pca : PCA (optional)
+        PCA already fit to energy scaled waveforms, used instead of fitting
+    n_fit : int (optional)
+        fit the PCA to only the first n_fit waveforms, default is all
+    return_pca : bool (optional)
+        if True, also return the PCA used
+
+    Returns
+    -------
+    np.array, list of str
+    '''
+    n_spikes = waves.shape[0]
+    n_fit = n_spikes if n_fit is None else n_fit
+    chunk_size = max(chunk_size, n_pc)
+    bounds = list(range(0, n_fit, chunk_size))
+    # fold a trailing chunk too small for a partial PCA fit into the previous one
+    if len(bounds) > 1 and n_fit - bounds[-1] < n_pc:
+        bounds.pop()
+
+    bounds.extend(range(n_fit, n_spikes, chunk_size))
+    bounds = list(zip(bounds, bounds[1:] + [n_spikes]))
+    data = np.zeros((n_spikes, 3 + n_pc))
+    fit = pca is None
+    if fit:
+        pca = IncrementalPCA(n_components=n_pc)
+
+    for start, stop in bounds:
+        chunk = np.asarray(waves[start:stop])
+        data[start:stop, 0] = get_waveform_amplitudes(chunk)
+        data[start:stop, 1] = get_waveform_energy(chunk)
+        data[start:stop, 2] = get_spike_slopes(chunk)
+        if fit and stop <= n_fit:
+            pca.partial_fit(scale_waveforms(chunk, energy=data[start:stop, 1]))
+
+    for start, stop in bounds:
+        chunk = np.asarray(waves[start:stop])
+        pc_waves = pca.transform(scale_waveforms(chunk, energy=data[start:stop, 1]))
+        data[start:stop, 3:] = pc_waves[:, :n_pc]
+
+    data_columns = ['amplitude', 'energy', 'spike_slope']
+    data_columns.extend(['PC%i' % i for i in range(n_pc)])
+    if return_pca:
+        return data, data_columns, pca
+
     return data, data_columns
 
 
+class PCAProjection(object):
+    '''Projection onto the principal components of energy scaled waveforms
+    saved by BlechClust.run, with the same transform as a fitted PCA
+    '''
+
+    def __init__(self, mean, components):
+        self.mean_ = mean
+        self.components_ = components
+
+    @classmethod
+    def load(cls, fn):
+        model = np.load(fn)
+        return cls(model['mean'], model['components'])
+
+    def save(self, fn):
+        np.savez(fn, mean=self.mean_, components=self.components_)
+
+    def transform(self, X):
+        return np.dot(np.asarray(X) - self.mean_, self.components_.T)
+
+
 def get_waveform_amplitudes(waves):
     '''Returns array of waveform amplitudes
 
@@ -260,7 +391,41 @@ def scale_waveforms(waves, energy=None):
     return scaled_slices
 
 
-def get_mahalanobis_distances_to_cluster(data, model, clusters, target_cluster):
+def get_mahalanobis_distances(data, mean, covariance, chunk_size=None):
+    '''computes mahalanobis distance of every row in data from a
+    distribution with the given mean and covariance. Uses a single Cholesky
+    factorization of the covariance and a triangular solve on the centered
+    data rather than computing distances one point at a time
+
+    Parameters
+    ----------
+    data : np.array, row for each data point
+    mean : np.array
+    covariance : np.array, covariance matrix
+    chunk_size : int (optional)
+        number of rows to process at a time, all at once if None
+
+    Returns
+    -------
+    np.array
+    '''
+    chol = linalg.cholesky(covariance, lower=True)
+    n_points = data.shape[0]
+    if chunk_size is None or chunk_size <= 0:
+        chunk_size = max(n_points, 1)
+
+    out = np.zeros((n_points,))
+    for start in range(0, n_points, chunk_size):
+        centered = data[start:start+chunk_size] - mean
+        z = linalg.solve_triangular(chol, centered.T, lower=True,
+                                    check_finite=False)
+        out[start:start+chunk_size] = np.sqrt(np.sum(z**2, axis=0))
+
+    return out
+
+
+def get_mahalanobis_distances_to_cluster(data, model, clusters, target_cluster,
+                                         chunk_size=None):
     '''computes mahalanobis distance from spikes in target_cluster to all clusters
     in GMM model
 
@@ -270,6 +435,8 @@ def get_mahalanobis_distances_to_cluster(data, model, clusters, target_cluster):
     model : fitted GMM model
     clusters : np.array, maps data points to clusters
     target_cluster : int, cluster for which to compute distances
+    chunk_size : int (optional)
+        number of spikes to process at a time, all at once if None
 
     Returns
     -------
@@ -277,21 +444,43 @@ def get_mahalanobis_distances_to_cluster(data, model, clusters, target_cluster):
     '''
     unique_clusters = np.unique(abs(clusters))
     out_distances = dict.fromkeys(unique_clusters)
-    cluster_idx = np.where(clusters == target_cluster)[0]
+    cluster_data = data[clusters == target_cluster]
     for other_cluster in unique_clusters:
-        mahalanobis_dist = np.zeros((len(cluster_idx),))
-        other_cluster_mean = model.means_[other_cluster, :]
-        other_cluster_covar_I = linalg.inv(model.covariances_[other_cluster, :, :])
-        for i, idx in enumerate(cluster_idx):
-            mahalanobis_dist[i] = mahalanobis(data[idx, :],
-                                              other_cluster_mean,
-                                              other_cluster_covar_I)
-
-        out_distances[other_cluster] = mahalanobis_dist
+        out_distances[other_cluster] = \
+                get_mahalanobis_distances(cluster_data,
+                                          model.means_[other_cluster, :],
+                                          model.covariances_[other_cluster, :, :],
+                                          chunk_size=chunk_size)
 
     return out_distances
 
 
+def get_gmm_log_probabilities(data, weights, means, covariances):
+    '''Returns the weighted log probability of each data point under each
+    component of a full covariance gaussian mixture model
+
+    Parameters
+    ----------
+    data : np.array, row for each data point
+    weights : np.array, mixture weights
+    means : np.array, component x feature
+    covariances : np.array, component x feature x feature
+
+    Returns
+    -------
+    np.array, data point x component
+    '''
+    n_features = data.shape[1]
+    out = np.zeros((data.shape[0], len(weights)))
+    for i, (w, mu, cov) in enumerate(zip(weights, means, covariances)):
+        log_det = 2 * np.sum(np.log(np.diag(linalg.cholesky(cov, lower=True))))
+        dist = get_mahalanobis_distances(data, mu, cov)
+        out[:, i] = (np.log(w) - 0.5 * (dist**2 + log_det +
+                                        n_features * np.log(2 * np.pi)))
+
+    return out
+
+
 def get_recording_cutoff(filt_el, sampling_rate, voltage_cutoff,
                          max_breach_rate, max_secs_above_cutoff,
                          max_mean_breach_rate_persec, **kwargs):
@@ -322,8 +511,13 @@ def get_recording_cutoff(filt_el, sampling_rate, voltage_cutoff,
     return recording_cutoff
 
 
-def UMAP_METRICS(waves, n_pc):
-    return compute_waveform_metrics(waves, n_pc, umap=True)
+def UMAP_METRICS(waves, n_pc, umap_cache=None):
+    return compute_waveform_metrics(waves, n_pc, umap=True,
+                                    umap_cache=umap_cache)
+
+
+# Names under which BlechClust records the feature transform it clustered with
+DATA_TRANSFORMS = {'pca': compute_waveform_metrics, 'umap': UMAP_METRICS}
 
 
 class SpikeDetection(object):
@@ -350,6 +544,10 @@ class SpikeDetection(object):
                        'slopes' : os.path.join(self._data_dir, 'spike_slopes.npy'),
                        'recording_cutoff' : os.path.join(self._data_dir, 'cutoff_time.txt'),
                        'detection_threshold' : os.path.join(self._data_dir, 'detection_threshold.txt')}
+        # Native rate snippets and alignment, used instead of spike_waveforms
+        # when compact waveforms are enabled
+        self._compact_files = {'spike_snippets': os.path.join(self._data_dir, 'spike_snippets.npy'),
+                               'spike_alignment': os.path.join(self._data_dir, 'spike_alignment.npy')}
 
         self._status = dict.fromkeys(self._files.keys(), False)
         self._referenced = True
@@ -408,6 +606,7 @@ class SpikeDetection(object):
             snapshot_post = params['spike_snapshot']['Time after spike (ms)']
             self.params['spike_snapshot'] = [snapshot_pre, snapshot_post]
             self.params['sampling_rate'] = params['sampling_rate']
+            self.params['compact_waveforms'] = params['data_params'].get('Compact waveform dtype')
             # Write params to json file
             wt.write_dict_to_json(self.params, self._files['params'])
             self._status['params'] = True
@@ -422,6 +621,14 @@ class SpikeDetection(object):
             else:
                 self._status[k] = False
 
+        if self.is_compact():
+            self._status['spike_waveforms'] = True
+
+    def is_compact(self):
+        '''Returns True if waveforms are stored as native rate snippets
+        '''
+        return all(os.path.isfile(x) for x in self._compact_files.values())
+
     def run(self):
         status = self._status
         file_dir = self._file_dir
@@ -473,19 +680,28 @@ class SpikeDetection(object):
             status['detection_threshold'] = True
 
         if status['spike_waveforms'] and status['spike_times']:
-            waves = np.load(self._files['spike_waveforms'])
+            waves = self.get_spike_waveforms()
             times = np.load(self._files['spike_times'])
         else:
             # Detect spikes and get dejittered times and waveforms
             # detect_spikes returns waveforms upsampled by 10x and times in units
             # of samples
-            waves, times, threshold = detect_spikes(filt_el, params['spike_snapshot'], fs, thresh=self.detection_threshold)
+            compact = params.get('compact_waveforms')
+            waves, times, threshold = detect_spikes(filt_el, params['spike_snapshot'], fs,
+                                                    thresh=self.detection_threshold,
+                                                    compact=compact)
             if waves is None:
                 print('No waveforms detected on electrode %i' % electrode)
                 return electrode, 0, self.recording_cutoff
 
             # Save waveforms and times
-            np.save(self._files['spike_waveforms'], waves)
+            if compact is not None:
+                np.save(self._compact_files['spike_snippets'], waves[0])
+                np.save(self._compact_files['spike_alignment'], waves[1])
+                waves = self.get_spike_waveforms()
+            else:
+                np.save(self._files['spike_waveforms'], waves)
+
             np.save(self._files['spike_times'], times)
             status['spike_waveforms'] = True
             status['spike_times'] = True
@@ -520,19 +736,55 @@ class SpikeDetection(object):
 
         return electrode, 1, self.recording_cutoff
 
-    def get_spike_waveforms(self):
+    def get_spike_waveforms(self, mmap_mode=None):
         '''Returns spike waveforms if they have been extracted, None otherwise
-        Dejittered waveforms upsampled to 10 x sampling_rate
+        Dejittered waveforms upsampled to 10 x sampling_rate. If waveforms are
+        stored compactly they are upsampled from the native rate snippets.
+
+        Parameters
+        ----------
+        mmap_mode : str (optional)
+            passed to np.load. For compact waveforms the snippets are
+            memory-mapped and a clustering.CompactWaveforms view is returned
+            that upsamples only the rows that are read
 
         Returns
         -------
-        numpy.array
+        numpy.array or clustering.CompactWaveforms
         '''
         if os.path.isfile(self._files['spike_waveforms']):
-            return np.load(self._files['spike_waveforms'])
+            return np.load(self._files['spike_waveforms'], mmap_mode=mmap_mode)
+        elif self.is_compact():
+            snippets, offsets = self.get_compact_waveforms(mmap_mode=mmap_mode)
+            waves = clustering.CompactWaveforms(snippets, offsets,
+                                                self.get_n_waveform_samples())
+            if mmap_mode is None:
+                return np.asarray(waves)
+
+            return waves
         else:
             return None
 
+    def get_compact_waveforms(self, mmap_mode=None):
+        '''Returns native rate spike snippets and their sub-sample alignment
+        (in 1/10 samples) if waveforms are stored compactly, otherwise None,
+        None
+        '''
+        if not self.is_compact():
+            return None, None
+
+        return (np.load(self._compact_files['spike_snippets'], mmap_mode=mmap_mode),
+                np.load(self._compact_files['spike_alignment'], mmap_mode=mmap_mode))
+
+    def get_n_waveform_samples(self):
+        '''Returns the number of samples in each upsampled waveform
+        '''
+        fs = self.params['sampling_rate']
+        snapshot = self.params['spike_snapshot']
+        before = int((fs/1000.0)*snapshot[0])
+        after = int((fs/1000.0)*snapshot[1])
+        return 10*(before + after)
+
     def get_spike_times(self):
         '''Returns spike times if they have been extracted, None otherwise
         In units of samples.
@@ -631,8 +883,16 @@ class SpikeDetection(object):
 class BlechClust(object):
     def __init__(self, rec_dirs, electrode, out_dir=None, params=None,
                  overwrite=False, no_write=False, n_pc=3,
-                 data_transform=compute_waveform_metrics):
+                 data_transform=compute_waveform_metrics, incremental=False):
         '''Recording directories should be ordered to make spike sorting easier later on
+
+        If incremental is True, rec_dirs may include recordings that were not
+        part of an existing clustering. They are appended to the rec_key and
+        their spikes can be assigned to the existing solutions with
+        update_clusters instead of re-clustering all recordings. The rec_key
+        and params files are only rewritten once update_clusters (or run)
+        succeeds, and the feature transform and n_pc the electrode was
+        clustered with are used in place of data_transform and n_pc.
         '''
         if isinstance(rec_dirs, str):
             rec_dirs = [rec_dirs]
@@ -641,6 +901,7 @@ class BlechClust(object):
         self.rec_dirs = rec_dirs
         self.electrode = electrode
         self._data_transform = data_transform
+        self._incremental = incremental
         self._n_pc = n_pc
         if out_dir is None:
             if len(rec_dirs) > 1:
@@ -670,10 +931,21 @@ class BlechClust(object):
         map_file = os.path.join(self._data_dir, 'spike_id.npy')
         key_file = os.path.join(self._data_dir, 'rec_key.json')
         results_file = os.path.join(self._data_dir, 'clustering_results.json')
+        pca_file = os.path.join(self._data_dir, 'pca_model.npz')
         self._files = {'params': params_file, 'spike_map': map_file,
-                       'rec_key': key_file, 'clustering_results': results_file}
+                       'rec_key': key_file, 'clustering_results': results_file,
+                       'pca_model': pca_file}
         self.params = params
+        self._predictions = {}
+        self._pending_write = False
         self._load_existsing_data()
+        if incremental:
+            # Added spikes must get the features the clustering used
+            transform = DATA_TRANSFORMS.get(self.params.get('data_transform'))
+            if transform is not None:
+                self._data_transform = transform
+
+            self._n_pc = self.params.get('n_pc', n_pc)
 
         if self._rec_key is None and not no_write:
             # Create new rec key
@@ -690,6 +962,11 @@ class BlechClust(object):
             error_str = '\n\t'.join(invalid)
             raise ValueError('Spike detection has not been run on:\n\t%s' % error_str)
 
+        self._spike_cache = SpikeDataCache(os.path.join(self._data_dir, 'spike_data_cache'),
+                                           self._rec_key, electrode)
+        self._umap_cache = UmapCache(os.path.join(self._data_dir, 'umap_cache'),
+                                     self._spike_cache)
+
     def _load_existsing_data(self):
         params = self.params
         file_check = self._check_existing_files()
@@ -708,28 +985,47 @@ class BlechClust(object):
             self.params['threshold'] = params['clustering_params']['Convergence Criterion']
             self.params['num_restarts'] = params['clustering_params']['GMM random restarts']
             self.params['wf_amplitude_sd_cutoff'] = params['data_params']['Intra-cluster waveform amp SD cutoff']
-            wt.write_dict_to_json(self.params, self._files['params'])
+            self.params['gmm_subsample'] = params['clustering_params'].get('GMM subsample size')
+            self.params['check_subsample_agreement'] = params['clustering_params'].get('Check GMM subsample agreement', False)
+            self.params['chunk_size'] = params['clustering_params'].get('Waveform chunk size')
+            if self._incremental:
+                self._pending_write = True
+            else:
+                wt.write_dict_to_json(self.params, self._files['params'])
 
         # Deal with existing rec key
         if file_check['rec_key']:
             rec_dirs = self.rec_dirs
             rec_key = wt.read_dict_from_json(self._files['rec_key'])
             rec_key = {int(x): y for x,y in rec_key.items()}
-            if len(rec_key) != len(rec_dirs):
+            if (len(rec_key) != len(rec_dirs) and
+                not (self._incremental and len(rec_dirs) > len(rec_key))):
                 raise ValueError('Rec key does not match rec dirs')
 
             # Correct rec key in case rec_dir roots have changed
+            new_recs = []
             for rd in rec_dirs:
                 rn = os.path.basename(rd)
                 dn = os.path.dirname(rd)
                 kd = [(x, y) for x,y in rec_key.items() if rn in y]
-                if len(kd) == 0:
+                if len(kd) == 0 and self._incremental:
+                    new_recs.append(rd)
+                    continue
+                elif len(kd) == 0:
                     raise ValueError('%s not found in rec_key' % rn)
 
                 kd = kd[0]
                 if kd[1] != rd:
                     rec_key[kd[0]] = rd
 
+            # Added recordings go after existing ones so that spike indices
+            # and offsets of clustered recordings are unchanged
+            for rd in new_recs:
+                rec_key[max(rec_key.keys()) + 1] = rd
+
+            if len(new_recs) > 0:
+                self._pending_write = True
+
             inverted = {v:k for k,v in rec_key.items()}
             self.rec_dirs = sorted(self.rec_dirs, key=lambda i: inverted[i])
             self._rec_key = rec_key
@@ -749,6 +1045,16 @@ class BlechClust(object):
             self.results = None
             self.clustered = False
 
+    def _write_pending(self):
+        '''Writes params and rec_key changes deferred in incremental mode
+        '''
+        if not self._pending_write:
+            return
+
+        wt.write_dict_to_json(self.params, self._files['params'])
+        wt.write_dict_to_json(self._rec_key, self._files['rec_key'])
+        self._pending_write = False
+
     def _check_existing_files(self):
         out = dict.fromkeys(self._files.keys(), False)
         for k,v in self._files.items():
@@ -781,8 +1087,14 @@ class BlechClust(object):
         if n_pc is None:
             n_pc = self._n_pc
 
+        # With a chunk size set, features are computed and spikes predicted
+        # chunk by chunk from the memory-mapped waveforms
+        chunk_size = self.params.get('chunk_size')
         GMM = ClusterGMM(self.params['max_iterations'],
-                         self.params['num_restarts'], self.params['threshold'])
+                         self.params['num_restarts'], self.params['threshold'],
+                         subsample=self.params.get('gmm_subsample'),
+                         chunk_size=chunk_size or 100000,
+                         check_agreement=self.params.get('check_subsample_agreement', False))
 
         # Collect data from all recordings
         waveforms, spike_times, spike_map, fs, offsets = self.get_spike_data()
@@ -790,8 +1102,27 @@ class BlechClust(object):
         # Save array to map spikes and predictions back to original recordings
         np.save(self._files['spike_map'], spike_map)
 
-        data, data_columns = self._data_transform(waveforms, n_pc)
-        amplitudes = get_waveform_amplitudes(waveforms)
+        pca = None
+        if self._data_transform is UMAP_METRICS:
+            data, data_columns = self._data_transform(waveforms, n_pc,
+                                                      umap_cache=self._umap_cache)
+            amplitudes = get_waveform_amplitudes(waveforms)
+        elif chunk_size and self._data_transform is compute_waveform_metrics:
+            data, data_columns, pca = compute_waveform_metrics_chunked(waveforms, n_pc,
+                                                                       chunk_size=chunk_size,
+                                                                       return_pca=True)
+            amplitudes = data[:, 0]
+        elif self._data_transform is compute_waveform_metrics:
+            data, data_columns, pca = compute_waveform_metrics(waveforms, n_pc,
+                                                               return_pca=True)
+            amplitudes = data[:, 0]
+        else:
+            data, data_columns = self._data_transform(waveforms, n_pc)
+            amplitudes = get_waveform_amplitudes(waveforms)
+
+        # Keep the PCA so spikes added later get the same features
+        if pca is not None:
+            PCAProjection(pca.mean_, pca.components_[:n_pc]).save(self._files['pca_model'])
 
         # Run GMM for each number of clusters from 2 to max_clusters
         tested_clusters = np.arange(2, self.params['max_clusters']+1)
@@ -804,6 +1135,8 @@ class BlechClust(object):
             wave_plot_dir = os.path.join(self._plot_dir, '%i_clusters_waveforms_ISIs' % n_clust)
             bic_file = os.path.join(data_dir, 'bic.npy')
             pred_file = os.path.join(data_dir, 'predictions.npy')
+            model_file = os.path.join(data_dir, 'gmm_model.npz')
+            agreement_file = os.path.join(data_dir, 'subsample_agreement.json')
 
             if os.path.isfile(bic_file) and os.path.isfile(pred_file) and not overwrite:
                 bic = np.load(bic_file)
@@ -884,6 +1217,10 @@ class BlechClust(object):
             # Save data
             np.save(bic_file, bic)
             np.save(pred_file, predictions)
+            np.savez(model_file, weights=model.weights_, means=model.means_,
+                     covariances=model.covariances_)
+            if GMM.agreement is not None:
+                wt.write_dict_to_json(GMM.agreement, agreement_file)
 
         # Save results table
         self.results = clust_results
@@ -891,48 +1228,240 @@ class BlechClust(object):
                                  self._files['clustering_results'],
                                  overwrite=True)
         self.clustered = True
+
+        # Record the features used so spikes can be added incrementally
+        transform = [k for k, v in DATA_TRANSFORMS.items()
+                     if v is self._data_transform]
+        self.params['data_transform'] = transform[0] if transform else None
+        self.params['n_pc'] = int(n_pc)
+        self._pending_write = True
+        self._write_pending()
         return True
 
-    def get_spike_data(self):
-        # Collect data from all recordings
-        tmp_waves = []
-        tmp_times = []
-        tmp_id = []
-        fs = dict.fromkeys(self._rec_key.keys())
-        offsets = dict.fromkeys(self._rec_key.keys())
-        offset = 0
-        for i in sorted(self._rec_key.keys()):
-            rec = self._rec_key[i]
-            spike_detect = SpikeDetection(rec, self.electrode)
-            t = spike_detect.get_spike_times()
-            fs[i] = spike_detect.params['sampling_rate']
-            if t is None:
-                offsets[i] = int(offset)
-                offset = offset + 3*fs[i]
+    def _get_gmm_model(self, n_clusters, data, predictions):
+        '''Returns cluster labels, weights, means and covariances of a
+        solution. Uses the saved model if available, otherwise reconstructs
+        it from the spikes assigned to each cluster.
+        '''
+        fn = os.path.join(self._data_dir, '%i_clusters' % n_clusters, 'gmm_model.npz')
+        if os.path.isfile(fn):
+            model = np.load(fn)
+            return (np.arange(len(model['weights'])), model['weights'],
+                    model['means'], model['covariances'])
+
+        labels = []
+        weights = []
+        means = []
+        covs = []
+        n_features = data.shape[1]
+        for c in range(n_clusters):
+            idx = np.where(predictions == c)[0]
+            if len(idx) <= n_features:
                 continue
 
-            tmp_waves.append(spike_detect.get_spike_waveforms())
-            tmp_times.append(t)
-            tmp_id.append(np.ones((t.shape[0],))*i)
-            offsets[i] = int(offset)
-            offset = offset + max(t) + 3*fs[i]
+            labels.append(c)
+            weights.append(len(idx))
+            means.append(np.mean(data[idx], axis=0))
+            covs.append(np.cov(data[idx], rowvar=False) +
+                        1e-6 * np.eye(n_features))
+
+        weights = np.array(weights) / np.sum(weights)
+        return np.array(labels), weights, np.array(means), np.array(covs)
+
+    def update_clusters(self, n_pc=None, max_outlier_fraction=0.05):
+        '''Assigns spikes from recordings added since clustering (see
+        incremental) to the existing GMM solutions without refitting. New
+        spikes are projected into the feature space of the original spikes
+        (same PCA) and assigned with the stored models, then the amplitude
+        cutoff of each cluster is applied. A solution fits the new data poorly
+        if more than max_outlier_fraction of new spikes lie outside the 99%%
+        Mahalanobis ellipsoid of their assigned cluster; the electrode should
+        then be re-clustered from scratch.
+
+        Returns
+        -------
+        dict
+            new_spikes, refit_needed and per solution statistics. Also written
+            to clustering_results/incremental_update.json
+        '''
+        if not self.clustered:
+            raise ValueError('Recordings must be clustered before they can be updated')
+
+        if n_pc is None:
+            n_pc = self._n_pc
+
+        waveforms, spike_times, spike_map, fs, offsets = self.get_spike_data()
+        n_old = len(np.load(self._files['spike_map']))
+        out = {'new_spikes': int(len(spike_map) - n_old),
+               'refit_needed': False, 'solutions': {}}
+        out_file = os.path.join(self._data_dir, 'incremental_update.json')
+        if out['new_spikes'] == 0:
+            self._write_pending()
+            return out
+
+        if self._data_transform is not compute_waveform_metrics:
+            # UMAP and custom features can't be projected, must refit
+            out['refit_needed'] = True
+            wt.write_dict_to_json(out, out_file)
+            return out
+
+        # Project all spikes with the PCA the clustering used, or for older
+        # clusterings without a saved PCA, one fit to the original spikes
+        pca = None
+        if os.path.isfile(self._files['pca_model']):
+            pca = PCAProjection.load(self._files['pca_model'])
+
+        chunk_size = self.params.get('chunk_size') or 50000
+        data, _ = compute_waveform_metrics_chunked(waveforms, n_pc, pca=pca,
+                                                   n_fit=n_old,
+                                                   chunk_size=chunk_size)
+        old_data = data[:n_old]
+        new_data = data[n_old:]
+        old_amplitudes = old_data[:, 0]
+        new_amplitudes = new_data[:, 0]
+        max_dist = np.sqrt(chi2.ppf(0.99, old_data.shape[1]))
+
+        results = self.results.copy()
+        for n_clust in results.index:
+            predictions = self.get_predictions(n_clust)
+            if predictions is None or len(predictions) != n_old:
+                continue
+
+            labels, weights, means, covs = self._get_gmm_model(n_clust, old_data,
+                                                               predictions)
+            old_lp = get_gmm_log_probabilities(old_data, weights, means, covs)
+            new_lp = get_gmm_log_probabilities(new_data, weights, means, covs)
+            best = np.argmax(new_lp, axis=1)
+            new_pred = labels[best]
+
+            # Distance of each new spike to its assigned cluster
+            outliers = np.zeros(new_pred.shape, dtype=bool)
+            for i in np.unique(best):
+                idx = np.where(best == i)[0]
+                dist = get_mahalanobis_distances(new_data[idx], means[i], covs[i])
+                outliers[idx] = dist > max_dist
+
+            # Apply amplitude cutoff using the original clusters' amplitudes
+            for c in labels:
+                old_idx = np.where(predictions == c)[0]
+                cutoff_amp = (np.mean(old_amplitudes[old_idx]) -
+                              np.std(old_amplitudes[old_idx]) *
+                              self.params['wf_amplitude_sd_cutoff'])
+                new_pred[(new_pred == c) & (new_amplitudes <= cutoff_amp)] = -1
+
+            all_pred = np.concatenate((predictions, new_pred))
+            all_lp = np.vstack((old_lp, new_lp))
+            max_lp = np.max(all_lp, axis=1, keepdims=True)
+            log_likelihood = np.sum(max_lp[:, 0] + np.log(np.sum(np.exp(all_lp - max_lp), axis=1)))
+            n_features = old_data.shape[1]
+            n_params = len(labels) * (n_features + n_features*(n_features+1)/2) + len(labels) - 1
+            bic = -2 * log_likelihood + n_params * np.log(len(all_pred))
+
+            outlier_fraction = float(np.mean(outliers))
+            poor_fit = outlier_fraction > max_outlier_fraction
+            out['refit_needed'] = out['refit_needed'] or poor_fit
+            out['solutions'][str(n_clust)] = {
+                'outlier_fraction': outlier_fraction,
+                'old_mean_log_likelihood': float(np.mean(np.max(old_lp, axis=1))),
+                'new_mean_log_likelihood': float(np.mean(np.max(new_lp, axis=1))),
+                'poor_fit': bool(poor_fit)}
+
+            data_dir = os.path.join(self._data_dir, '%i_clusters' % n_clust)
+            np.save(os.path.join(data_dir, 'predictions.npy'), all_pred)
+            np.save(os.path.join(data_dir, 'bic.npy'), bic)
+            results.at[n_clust, 'BIC'] = bic
+            results.at[n_clust, 'spikes_per_cluster'] = str([int(np.sum(all_pred == c))
+                                                             for c in range(n_clust)])
+
+        np.save(self._files['spike_map'], spike_map)
+        self.results = results
+        wt.write_pandas_to_table(results, self._files['clustering_results'],
+                                 overwrite=True)
+        wt.write_dict_to_json(out, out_file)
+        self._write_pending()
+        return out
 
-        waveforms = np.vstack(tmp_waves)
-        spike_times = np.hstack(tmp_times)
-        spike_map = np.hstack(tmp_id)
+    def estimate_cost(self, n_pc=None):
+        '''Estimates the relative compute cost and peak memory of running
+        clustering on this electrode from the number of detected spikes and
+        the feature dimension, without loading waveforms.
+
+        Returns
+        -------
+        dict
+            n_spikes, n_samples (per waveform), n_features, cost (arbitrary
+            units, scales with runtime) and memory (bytes)
+        '''
+        if n_pc is None:
+            n_pc = self._n_pc
+
+        n_spikes = 0
+        n_samples = 0
+        for rec in self.rec_dirs:
+            data_dir = os.path.join(rec, 'spike_detection',
+                                    'electrode_%i' % self.electrode, 'data')
+            fn = os.path.join(data_dir, 'spike_waveforms.npy')
+            compact_fn = os.path.join(data_dir, 'spike_snippets.npy')
+            if os.path.isfile(fn):
+                shape = np.load(fn, mmap_mode='r').shape
+                n_spikes += shape[0]
+                n_samples = shape[1]
+            elif os.path.isfile(compact_fn):
+                # snippets have 2 extra native samples, upsampled 10x
+                shape = np.load(compact_fn, mmap_mode='r').shape
+                n_spikes += shape[0]
+                n_samples = 10 * (shape[1] - 2)
+
+        n_features = 3 + n_pc
+        max_clusters = self.params['max_clusters']
+        n_fit = n_spikes
+        if self.params.get('gmm_subsample'):
+            n_fit = min(n_spikes, self.params['gmm_subsample'])
+
+        # EM cost per spike scales with clusters * features^2 for each
+        # solution and restart
+        gmm_units = self.params['num_restarts'] * sum(k * n_features**2
+                                                      for k in range(2, max_clusters+1))
+        transform_units = n_samples
+        if self._data_transform is UMAP_METRICS:
+            transform_units *= 30  # approximate nearest neighbour search
+
+        cost = n_fit * gmm_units + n_spikes * transform_units
+        # waveforms, scaled waveforms and PCA plus feature data and responsibilities
+        chunk_size = self.params.get('chunk_size')
+        n_loaded = n_spikes
+        if chunk_size and self._data_transform is compute_waveform_metrics:
+            # waveforms are memory-mapped and transformed chunk by chunk
+            n_loaded = min(n_spikes, chunk_size)
+
+        memory = 8 * (3 * n_loaded * n_samples +
+                      n_spikes * n_features * (max_clusters + 2))
+        return {'n_spikes': int(n_spikes), 'n_samples': int(n_samples),
+                'n_features': int(n_features), 'cost': float(cost),
+                'memory': int(memory)}
+
+    def get_spike_data(self):
+        # Collect data from all recordings, built once into a memory-mapped
+        # cache that is only rebuilt when spike detection changes
+        waveforms, spike_times, spike_map, fs, offsets = self._spike_cache.get_spike_data()
 
         # Double check that spike_map matches up with existing spike_map
         if os.path.isfile(self._files['spike_map']):
             orig_map = np.load(self._files['spike_map'])
-            if len(orig_map) != len(spike_map):
+            # In incremental mode spikes from added recordings are appended
+            appended = (self._incremental and len(orig_map) < len(spike_map) and
+                        np.array_equal(orig_map, spike_map[:len(orig_map)]))
+            if len(orig_map) != len(spike_map) and not appended:
                 raise ValueError('Spike detection has changed, please re-cluster with overwrite=True')
 
-        return waveforms, spike_times, spike_map, fs, offsets
+        return waveforms, spike_times, spike_map, fs.copy(), offsets.copy()
 
     def get_clusters(self, solution_num, cluster_nums):
         if not isinstance(cluster_nums, list):
             cluster_nums = [cluster_nums]
 
+        # Clusters index into the shared spike data cache rather than
+        # holding copies of their waveforms
         waveforms, times, spike_map, fs, offsets = self.get_spike_data()
         predictions = self.get_predictions(solution_num)
         out = []
@@ -946,13 +1475,15 @@ class BlechClust(object):
                                      solution_num,
                                      c,
                                      1,
-                                     waveforms[idx],
-                                     times[idx],
-                                     spike_map[idx],
+                                     None,
+                                     None,
+                                     None,
                                      self._rec_key.copy(),
                                      fs.copy(),
                                      offsets.copy(),
-                                     manipulations='')
+                                     manipulations='',
+                                     store=self._spike_cache,
+                                     spike_idx=idx)
             out.append(tmp_clust)
 
         return out
@@ -960,17 +1491,703 @@ class BlechClust(object):
     def get_predictions(self, n_clusters):
         fn = os.path.join(self._data_dir, '%i_clusters' % n_clusters,
                           'predictions.npy')
-        if os.path.isfile(fn):
-            return np.load(fn)
-        else:
+        if not os.path.isfile(fn):
             return None
 
+        # Keep loaded predictions so switching solutions doesn't hit disk
+        mtime = os.stat(fn).st_mtime_ns
+        cached = self._predictions.get(n_clusters)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, np.load(fn))
+            self._predictions[n_clusters] = cached
+
+        return cached[1]
+
+
+def get_stratified_subsample(n_spikes, n_samples, n_strata=100, random_state=0):
+    '''Returns sorted indices of a random subsample of spikes, stratified
+    over time so that each portion of the recording(s) is represented in
+    proportion to its spike count. Spikes are assumed to be ordered in time
+    (as returned by BlechClust.get_spike_data).
+
+    Parameters
+    ----------
+    n_spikes : int, total number of spikes
+    n_samples : int, number of spikes to draw
+    n_strata : int (optional), number of equal sized blocks of consecutive
+        spikes to sample from. default is 100
+    random_state : int (optional), seed for random number generator
+
+    Returns
+    -------
+    np.array
+    '''
+    if n_samples >= n_spikes:
+        return np.arange(n_spikes)
+
+    rng = np.random.RandomState(random_state)
+    n_strata = max(1, min(n_strata, n_samples))
+    edges = np.linspace(0, n_spikes, n_strata + 1).astype('int64')
+    counts = np.diff(edges)
+    # Number of spikes drawn from each stratum, proportional to its size
+    n_draw = np.floor(counts * n_samples / n_spikes).astype('int64')
+    remainder = n_samples - np.sum(n_draw)
+    if remainder > 0:
+        n_draw[rng.choice(n_strata, remainder, replace=False)] += 1
+
+    out = [start + rng.choice(n, k, replace=False)
+           for start, n, k in zip(edges[:-1], counts, n_draw) if k > 0]
+    return np.sort(np.concatenate(out))
+
+
+def predict_in_chunks(model, data, chunk_size=100000):
+    '''Returns GMM predictions for data, computed in chunks of rows to limit
+    memory usage on large data sets
+    '''
+    predictions = np.zeros((data.shape[0],), dtype='int64')
+    for start in range(0, data.shape[0], chunk_size):
+        stop = start + chunk_size
+        predictions[start:stop] = model.predict(data[start:stop])
+
+    return predictions
+
+
+def get_bic_in_chunks(model, data, chunk_size=100000):
+    '''Returns Bayesian information criterion of a fitted GMM on data,
+    computing the log-likelihood in chunks of rows. Equivalent to
+    model.bic(data)
+    '''
+    log_likelihood = 0.0
+    for start in range(0, data.shape[0], chunk_size):
+        log_likelihood += np.sum(model.score_samples(data[start:start+chunk_size]))
+
+    return (-2 * log_likelihood +
+            get_gmm_n_parameters(model) * np.log(data.shape[0]))
+
+
+def get_gmm_n_parameters(model):
+    '''Returns the number of free parameters of a fitted GaussianMixture:
+    weights, means and covariances for its covariance_type
+    '''
+    n_components, n_features = model.means_.shape
+    cov_params = {'full': n_components * n_features * (n_features + 1) / 2,
+                  'diag': n_components * n_features,
+                  'tied': n_features * (n_features + 1) / 2,
+                  'spherical': n_components}
+    return int(cov_params[model.covariance_type] +
+               n_components * n_features + n_components - 1)
+
+
+def _run_timed_clustering(clust):
+    '''Runs a BlechClust object and returns the result and elapsed time. Top
+    level so it can be sent to worker processes
+    '''
+    previously_clustered = clust.clustered
+    start = time.time()
+    res = clust.run()
+    return res, time.time() - start, previously_clustered
+
+
+def get_cost_calibration(log_file, default=5e-6):
+    '''Returns seconds per cost unit estimated from previously logged
+    clustering runtimes, or default if no log exists
+    '''
+    if log_file is None or not os.path.isfile(log_file):
+        return default
+
+    log = wt.read_pandas_from_table(log_file)
+    log = log[(log['cost'] > 0) & (log['actual_s'] > 0)]
+    if len(log) == 0:
+        return default
+
+    return float(np.median(log['actual_s'] / log['cost']))
+
+
+def schedule_clustering(clust_objs, n_cores, memory_budget=None, log_file=None,
+                        callback=None):
+    '''Runs BlechClust objects in a process pool, dispatching the most
+    expensive electrodes (by estimated cost from spike counts and feature
+    dimension) first so that one busy electrode does not stretch the total
+    runtime. Predicted and actual runtimes are appended to log_file and used
+    to calibrate later predictions.
+
+    Parameters
+    ----------
+    clust_objs : list of BlechClust
+    n_cores : int, number of worker processes
+    memory_budget : float (optional)
+        memory budget per worker in GB. This is enforced as a pooled budget
+        of memory_budget * n_cores, not per worker: jobs are only started
+        while the estimated memory of all running jobs stays within it, so
+        a large job may use more than its share while the other running
+        jobs are small. A job exceeding the pooled budget runs alone.
+    log_file : str (optional)
+        tab-separated runtime log, defaults to clustering_runtimes.tsv next
+        to the BlechClust electrode directories
+    callback : function (optional)
+        called with the result of each job as it finishes
+
+    Returns
+    -------
+    list
+        result of each BlechClust.run in the order of clust_objs
+
+    Raises
+    ------
+    RuntimeError
+        if any job raised an error, once all other jobs have finished
+    '''
+    if len(clust_objs) == 0:
+        return []
+
+    if log_file is None:
+        log_file = os.path.join(os.path.dirname(clust_objs[0].out_dir),
+                                'clustering_runtimes.tsv')
+
+    sec_per_unit = get_cost_calibration(log_file)
+    costs = [c.estimate_cost() for c in clust_objs]
+    pending = sorted(range(len(clust_objs)), key=lambda i: -costs[i]['cost'])
+    total_budget = None
+    if memory_budget is not None:
+        total_budget = memory_budget * n_cores * 2**30
+
+    results = [None] * len(clust_objs)
+    errors = {}
+    log_rows = []
+    running = {}
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=n_cores, mp_context=ctx) as pool:
+        while pending or running:
+            in_use = sum(costs[i]['memory'] for i in running.values())
+            while pending and len(running) < n_cores:
+                i = pending[0]
+                # Wait for memory rather than letting smaller jobs jump ahead
+                if (total_budget is not None and len(running) > 0 and
+                    in_use + costs[i]['memory'] > total_budget):
+                    break
+
+                running[pool.submit(_run_timed_clustering, clust_objs[i])] = i
+                in_use += costs[i]['memory']
+                pending.pop(0)
+
+            done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+            for fut in done:
+                i = running.pop(fut)
+                electrode = clust_objs[i].electrode
+                try:
+                    res, elapsed, skipped = fut.result()
+                except Exception as e:
+                    print('Clustering failed for electrode %i: %s' % (electrode, e))
+                    errors[electrode] = e
+                    res = None
+                    skipped = True
+
+                results[i] = res
+                if not skipped:
+                    row = costs[i].copy()
+                    row['electrode'] = electrode
+                    row['predicted_s'] = costs[i]['cost'] * sec_per_unit
+                    row['actual_s'] = elapsed
+                    row['date'] = dt.datetime.today().strftime('%m/%d/%y %H:%M')
+                    log_rows.append(row)
+
+                if callback is not None:
+                    callback(res)
+
+    if len(log_rows) > 0:
+        log = pd.DataFrame(log_rows)
+        print('Electrode  Spikes  Predicted (s)  Actual (s)')
+        for _, row in log.iterrows():
+            print('  {:<9}{:<8}{:<15.1f}{:.1f}'.format(row['electrode'],
+                                                       row['n_spikes'],
+                                                       row['predicted_s'],
+                                                       row['actual_s']))
+
+        if os.path.isfile(log_file):
+            log = pd.concat([wt.read_pandas_from_table(log_file), log],
+                            ignore_index=True)
+
+        wt.write_pandas_to_table(log, log_file, overwrite=True)
+
+    if len(errors) > 0:
+        failed = sorted(errors)
+        raise RuntimeError('Clustering failed for electrodes %s'
+                           % ', '.join(str(x) for x in failed)) from errors[failed[0]]
+
+    return results
+
+
+class SpikeDataCache(object):
+    '''Concatenated spike waveforms, times and recording map for a single
+    electrode across all recordings. Arrays are built once into .npy files in
+    cache_dir and re-opened memory-mapped, so repeated calls (e.g. switching
+    solutions in the sorting GUI) share a single copy of the data. The cache
+    is rebuilt only when the spike detection files of any recording change.
+    This is checked the first time data is loaded, call reload to check
+    again after rerunning spike detection.
+
+    If all recordings store compact waveforms the cache keeps the native rate
+    snippets and alignment and waveforms are upsampled as they are read (see
+    clustering.CompactWaveforms). If only some do, waveforms are cached as
+    float32.
+    '''
+
+    def __init__(self, cache_dir, rec_key, electrode):
+        self.cache_dir = cache_dir
+        self.rec_key = rec_key
+        self.electrode = electrode
+        self._files = {'waveforms': os.path.join(cache_dir, 'spike_waveforms.npy'),
+                       'snippets': os.path.join(cache_dir, 'spike_snippets.npy'),
+                       'alignment': os.path.join(cache_dir, 'spike_alignment.npy'),
+                       'times': os.path.join(cache_dir, 'spike_times.npy'),
+                       'spike_map': os.path.join(cache_dir, 'spike_map.npy'),
+                       'info': os.path.join(cache_dir, 'cache_info.json')}
+        self._data = None
+        self._signature = None
+
+    def __getstate__(self):
+        # Don't pickle loaded arrays when sent to other processes
+        state = self.__dict__.copy()
+        state['_data'] = None
+        state['_signature'] = None
+        return state
+
+    def _get_spike_detectors(self):
+        return {i: SpikeDetection(self.rec_key[i], self.electrode)
+                for i in sorted(self.rec_key.keys())}
+
+    def get_signature(self):
+        '''Returns size and modification time of the spike detection output
+        for each recording, used to check whether the cache is stale
+        '''
+        out = {}
+        for i in sorted(self.rec_key.keys()):
+            data_dir = os.path.join(self.rec_key[i], 'spike_detection',
+                                    'electrode_%i' % self.electrode, 'data')
+            sig = []
+            for fn in ['spike_waveforms.npy', 'spike_snippets.npy', 'spike_times.npy']:
+                fn = os.path.join(data_dir, fn)
+                if os.path.isfile(fn):
+                    st = os.stat(fn)
+                    sig.append([st.st_size, st.st_mtime_ns])
+                else:
+                    sig.append(None)
+
+            out[str(i)] = sig
+
+        return out
+
+    def _get_data_files(self, compact):
+        keys = ['snippets', 'alignment'] if compact else ['waveforms']
+        return [self._files[k] for k in keys + ['times', 'spike_map']]
+
+    def is_valid(self, signature=None):
+        if not os.path.isfile(self._files['info']):
+            return False
+
+        if signature is None:
+            signature = self.get_signature()
+
+        info = wt.read_dict_from_json(self._files['info'])
+        files = self._get_data_files(info.get('compact', False))
+        if not all(os.path.isfile(x) for x in files):
+            return False
+
+        return info.get('signature') == signature
+
+    def _write_array(self, key, shape, dtype, arrays, chunk_size=50000):
+        '''Writes arrays into a single memory-mapped .npy file chunk by chunk,
+        replacing the cache file only once it is complete
+        '''
+        tmp_file = self._files[key] + '.tmp'
+        out = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=dtype,
+                                        shape=shape)
+        start = 0
+        for arr in arrays:
+            for i in range(0, len(arr), chunk_size):
+                chunk = np.asarray(arr[i:i+chunk_size])
+                out[start:start+len(chunk)] = chunk
+                start += len(chunk)
+
+        out.flush()
+        del out
+        os.replace(tmp_file, self._files[key])
+
+    def build(self):
+        '''Concatenates spike detection output from all recordings into the
+        cache files without holding all waveforms in memory at once
+        '''
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        signature = self.get_signature()
+        detectors = self._get_spike_detectors()
+        fs = {}
+        offsets = {}
+        times = []
+        spike_map = []
+        has_spikes = []
+        offset = 0
+        n_samples = None
+        for i, sd in detectors.items():
+            t = sd.get_spike_times()
+            fs[i] = sd.params['sampling_rate']
+            offsets[i] = int(offset)
+            if t is None:
+                offset = offset + 3*fs[i]
+                continue
+
+            has_spikes.append(i)
+            if sd.is_compact():
+                n_samples = sd.get_n_waveform_samples()
+            else:
+                n_samples = np.load(sd._files['spike_waveforms'],
+                                    mmap_mode='r').shape[1]
+
+            times.append(t)
+            spike_map.append(np.ones((t.shape[0],))*i)
+            offset = offset + max(t) + 3*fs[i]
+
+        spike_times = np.hstack(times)
+        spike_map = np.hstack(spike_map)
+
+        # Write waveforms recording by recording into memory-mapped files
+        compact = all(detectors[i].is_compact() for i in has_spikes)
+        if compact:
+            data = [detectors[i].get_compact_waveforms(mmap_mode='r')
+                    for i in has_spikes]
+            snippets = [x[0] for x in data]
+            alignment = [x[1] for x in data]
+            self._write_array('snippets', (len(spike_times), snippets[0].shape[1]),
+                              np.result_type(*snippets), snippets)
+            self._write_array('alignment', (len(spike_times),),
+                              np.result_type(*alignment), alignment)
+        else:
+            waves = [detectors[i].get_spike_waveforms(mmap_mode='r')
+                     for i in has_spikes]
+            if any(isinstance(w, clustering.CompactWaveforms) for w in waves):
+                dtype = np.dtype('float32')
+            else:
+                dtype = np.result_type(*waves)
+
+            self._write_array('waveforms', (len(spike_times), n_samples),
+                              dtype, waves)
+
+        # Remove the cache files of the other format
+        for k in (['waveforms'] if compact else ['snippets', 'alignment']):
+            if os.path.isfile(self._files[k]):
+                os.remove(self._files[k])
+
+        np.save(self._files['times'], spike_times)
+        np.save(self._files['spike_map'], spike_map)
+        info = {'signature': signature, 'compact': compact,
+                'n_samples': int(n_samples),
+                'fs': {str(k): v for k, v in fs.items()},
+                'offsets': {str(k): v for k, v in offsets.items()}}
+        wt.write_dict_to_json(info, self._files['info'])
+        self._data = None
+
+    def get_spike_data(self):
+        '''Returns waveforms (memory-mapped, read-only), spike_times,
+        spike_map, fs and offsets, building the cache if needed
+
+        Returns
+        -------
+        np.memmap or clustering.CompactWaveforms, np.array, np.array, dict, dict
+        '''
+        if self._data is not None:
+            return self._data
+
+        signature = self.get_signature()
+        if not self.is_valid(signature):
+            self.build()
+
+        info = wt.read_dict_from_json(self._files['info'])
+        fs = {int(k): v for k, v in info['fs'].items()}
+        offsets = {int(k): v for k, v in info['offsets'].items()}
+        if info.get('compact', False):
+            waveforms = clustering.CompactWaveforms(
+                np.load(self._files['snippets'], mmap_mode='r'),
+                np.load(self._files['alignment'], mmap_mode='r'),
+                info['n_samples'])
+        else:
+            waveforms = np.load(self._files['waveforms'], mmap_mode='r')
+
+        spike_times = np.load(self._files['times'])
+        spike_map = np.load(self._files['spike_map'])
+        self._data = (waveforms, spike_times, spike_map, fs, offsets)
+        self._signature = signature
+        return self._data
+
+    def get_data_signature(self):
+        '''Returns the signature of the spike detection output the loaded
+        data was built from
+        '''
+        self.get_spike_data()
+        return self._signature
+
+    def reload(self):
+        '''Drops loaded data so the cache is checked against the spike
+        detection files, and rebuilt if needed, on next access
+        '''
+        self._data = None
+        self._signature = None
+
+    def get_waveforms(self, idx):
+        '''Returns waveforms for the spike indices in idx
+        '''
+        return self.get_spike_data()[0][idx]
+
+    def get_compact_waveforms(self, idx):
+        '''Returns native rate snippets and sub-sample alignment for the
+        spike indices in idx if all their recordings store compact waveforms,
+        otherwise None, None
+        '''
+        waveforms, _, spike_map, _, _ = self.get_spike_data()
+        idx = np.asarray(idx)
+        if isinstance(waveforms, clustering.CompactWaveforms):
+            return (np.asarray(waveforms.snippets[idx]),
+                    np.asarray(waveforms.alignment[idx]))
+
+        snippets = None
+        alignment = None
+        for i in np.unique(spike_map[idx]):
+            sd = SpikeDetection(self.rec_key[int(i)], self.electrode)
+            if not sd.is_compact():
+                return None, None
+
+            rec_snippets, rec_alignment = sd.get_compact_waveforms()
+            rec_start = np.argmax(spike_map == i)
+            sub = np.where(spike_map[idx] == i)[0]
+            if snippets is None:
+                snippets = np.zeros((len(idx), rec_snippets.shape[1]),
+                                    dtype=rec_snippets.dtype)
+                alignment = np.zeros((len(idx),), dtype=rec_alignment.dtype)
+
+            snippets[sub] = rec_snippets[idx[sub] - rec_start]
+            alignment[sub] = rec_alignment[idx[sub] - rec_start]
+
+        return snippets, alignment
+
+    def get_spike_index(self, spike_map, spike_times):
+        '''Returns indices into the cached spike data of the spikes given by
+        spike_map and spike_times, or None if any spike is not found
+
+        Returns
+        -------
+        np.array or None
+        '''
+        _, all_times, all_map, _, _ = self.get_spike_data()
+        out = np.zeros((len(spike_times),), dtype='int64')
+        for i in np.unique(spike_map):
+            rec_idx = np.where(all_map == i)[0]
+            if len(rec_idx) == 0:
+                return None
+
+            # spike times are sorted within each recording
+            rec_times = all_times[rec_idx]
+            idx = np.where(spike_map == i)[0]
+            pos = np.searchsorted(rec_times, spike_times[idx])
+            pos = np.clip(pos, 0, len(rec_times)-1)
+            if not np.array_equal(rec_times[pos], spike_times[idx]):
+                return None
+
+            out[idx] = rec_idx[pos]
+
+        return out
+
+
+def _umap_supports_precomputed_knn():
+    '''precomputed_knn was added to umap.UMAP in umap-learn 0.5.2
+    '''
+    version = re.findall(r'\d+', getattr(umap, '__version__', '0'))
+    return tuple(int(x) for x in version[:3]) >= (0, 5, 2)
+
+
+class UmapCache(object):
+    '''UMAP embeddings of sets of spikes on an electrode (all spikes, or a
+    cluster's spikes given by their indices in the electrode's spike data),
+    stored per number of components along with the k-nearest-neighbour
+    graph used to build them. The kNN graph of each spike set is computed
+    once and reused for embeddings with different numbers of components.
+    Invalidated when the underlying spike data changes.
+    '''
+
+    def __init__(self, cache_dir, spike_cache, n_neighbors=30, min_dist=0.0):
+        self.cache_dir = cache_dir
+        self.spike_cache = spike_cache
+        self.n_neighbors = n_neighbors
+        self.min_dist = min_dist
+        self._files = {'info': os.path.join(cache_dir, 'umap_info.json')}
+        self._embeddings = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_embeddings'] = {}
+        return state
+
+    def _get_set_key(self, idx):
+        if idx is None:
+            return 'all'
+
+        idx = np.asarray(idx, dtype='int64')
+        return hashlib.sha1(idx.tobytes()).hexdigest()[:16]
+
+    def _embedding_file(self, key, n_components):
+        return os.path.join(self.cache_dir, 'embedding_%s_%id.npy'
+                            % (key, n_components))
+
+    def _knn_files(self, key):
+        return (os.path.join(self.cache_dir, 'knn_%s_indices.npy' % key),
+                os.path.join(self.cache_dir, 'knn_%s_dists.npy' % key))
+
+    def _get_info(self):
+        return {'signature': self.spike_cache.get_data_signature(),
+                'n_neighbors': self.n_neighbors,
+                'min_dist': self.min_dist}
+
+    def _check_valid(self):
+        '''Clears cached embeddings if spike data or UMAP parameters have
+        changed
+        '''
+        info = self._get_info()
+        if (os.path.isfile(self._files['info']) and
+            wt.read_dict_from_json(self._files['info']) == info):
+            return
+
+        self.clear()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        wt.write_dict_to_json(info, self._files['info'])
+
+    def clear(self):
+        '''Deletes cached embeddings and kNN graphs, leaving any other
+        files in cache_dir alone
+        '''
+        self._embeddings = {}
+        if not os.path.isdir(self.cache_dir):
+            return
+
+        for fn in os.listdir(self.cache_dir):
+            if fn.startswith(('embedding_', 'knn_')) and fn.endswith('.npy'):
+                os.remove(os.path.join(self.cache_dir, fn))
+
+    def get_knn(self, idx=None):
+        '''Returns cached kNN indices and distances of a spike set, or None
+        if not computed
+        '''
+        ind_file, dist_file = self._knn_files(self._get_set_key(idx))
+        if os.path.isfile(ind_file) and os.path.isfile(dist_file):
+            return np.load(ind_file), np.load(dist_file)
+
+        return None
+
+    def fit(self, n_components, waves=None, idx=None):
+        '''Fits a UMAP embedding with n_components on a set of spikes,
+        reusing its cached kNN graph if available
+
+        Parameters
+        ----------
+        n_components : int, number of UMAP components
+        waves : np.array (optional)
+            waveforms of the spikes, read from the spike data if not given
+        idx : np.array (optional)
+            indices of the spikes in the electrode's spike data, default is
+            all spikes
+        '''
+        self._check_valid()
+        key = self._get_set_key(idx)
+        if waves is None and idx is None:
+            waves = self.spike_cache.get_spike_data()[0]
+        elif waves is None:
+            waves = self.spike_cache.get_waveforms(idx)
+
+        knn = self.get_knn(idx)
+        kwargs = {}
+        if knn is not None and _umap_supports_precomputed_knn():
+            kwargs['precomputed_knn'] = (knn[0], knn[1], None)
+
+        reducer = umap.UMAP(n_components=n_components,
+                            n_neighbors=self.n_neighbors,
+                            min_dist=self.min_dist, **kwargs)
+        embedding = reducer.fit_transform(waves)
+        knn_indices = getattr(reducer, '_knn_indices', None)
+        knn_dists = getattr(reducer, '_knn_dists', None)
+        if knn is None and knn_indices is not None and knn_dists is not None:
+            ind_file, dist_file = self._knn_files(key)
+            np.save(ind_file, knn_indices)
+            np.save(dist_file, knn_dists)
+
+        np.save(self._embedding_file(key, n_components), embedding)
+        self._embeddings[(key, n_components)] = embedding
+        return embedding
+
+    def get_embedding(self, waves=None, n_components=2, idx=None,
+                      electrode_wide=False):
+        '''Returns the UMAP embedding of a set of spikes on the electrode,
+        fitting it if not yet cached. If idx is given the spikes at those
+        indices are embedded on their own, otherwise waves (if given) must be
+        all waveforms on the electrode.
+
+        Parameters
+        ----------
+        waves : np.array (optional), waveforms to embed if not yet cached
+        n_components : int (optional), number of UMAP components
+        idx : np.array (optional), indices of spikes to embed
+        electrode_wide : bool (optional)
+            if True the rows for idx are taken from the embedding of all
+            spikes on the electrode rather than fitting the spikes on their
+            own. Default False
+
+        Returns
+        -------
+        np.array
+        '''
+        if idx is not None and electrode_wide:
+            return self.get_embedding(n_components=n_components)[idx]
+
+        self._check_valid()
+        key = self._get_set_key(idx)
+        embedding = self._embeddings.get((key, n_components))
+        fn = self._embedding_file(key, n_components)
+        if embedding is None and os.path.isfile(fn):
+            embedding = np.load(fn)
+            self._embeddings[(key, n_components)] = embedding
+
+        if embedding is None:
+            embedding = self.fit(n_components, waves=waves, idx=idx)
+
+        return embedding
+
 
 class ClusterGMM(object):
-    def __init__(self, n_iters, n_restarts, thresh):
+    def __init__(self, n_iters, n_restarts, thresh, subsample=None,
+                 chunk_size=100000, check_agreement=False):
+        '''Fits full covariance gaussian mixture models with random restarts
+        and keeps the model with the lowest BIC
+
+        Parameters
+        ----------
+        n_iters : int, max number of EM iterations
+        n_restarts : int, number of random restarts
+        thresh : float, convergence threshold
+        subsample : int (optional)
+            if provided and data has more rows than this, models are fit on a
+            time-stratified random subsample of this many spikes and then
+            predictions and BIC are computed on the full data set
+        chunk_size : int (optional)
+            number of spikes to predict at a time on the full data set
+        check_agreement : bool (optional)
+            if True and data is subsampled, the best model is also refined
+            on the full data set and the agreement between the subsample and
+            full-data fits is stored in self.agreement
+        '''
         self.params = {'iterations': n_iters,
                        'restarts': n_restarts,
-                       'thresh': thresh}
+                       'thresh': thresh,
+                       'subsample': subsample,
+                       'chunk_size': chunk_size,
+                       'check_agreement': check_agreement}
+        self.agreement = None
 
     def fit(self, data, n_clusters):
         min_bic = None
@@ -978,31 +2195,102 @@ class ClusterGMM(object):
         if n_clusters is not None:
             self.params['clusters'] = n_clusters
 
+        subsample = self.params['subsample']
+        chunk_size = self.params['chunk_size']
+        if subsample is not None and data.shape[0] > subsample:
+            sub_idx = get_stratified_subsample(data.shape[0], subsample)
+            fit_data = data[sub_idx]
+        else:
+            sub_idx = None
+            fit_data = data
+
+        self.agreement = None
         for i in range(self.params['restarts']):
             model = GaussianMixture(n_components = self.params['clusters'],
                                     covariance_type = 'full',
                                     tol = self.params['thresh'],
                                     random_state = i,
                                     max_iter = self.params['iterations'])
-            model.fit(data)
+            model.fit(fit_data)
             if model.converged_:
-                new_bic = model.bic(data)
-                if min_bic is None:
-                    min_bic = model.bic(data)
-                    best_model = model
-                elif new_bic < min_bic:
+                new_bic = model.bic(fit_data)
+                if min_bic is None or new_bic < min_bic:
                     best_model = model
                     min_bic = new_bic
 
-        predictions = best_model.predict(data)
+        predictions = predict_in_chunks(best_model, data, chunk_size)
+        if sub_idx is not None:
+            min_bic = get_bic_in_chunks(best_model, data, chunk_size)
+            if self.params['check_agreement']:
+                self.agreement = self.get_subsample_agreement(best_model,
+                                                              data,
+                                                              predictions,
+                                                              len(sub_idx))
+
         self._model = best_model
         self._predictions = predictions
         self._bic = min_bic
         return best_model, predictions, min_bic
 
+    def get_subsample_agreement(self, model, data, predictions, n_subsample):
+        '''Refines a model fit on a subsample using the full data set and
+        compares the two. The full-data fit is initialized from the subsample
+        model so that cluster labels correspond.
+
+        Returns
+        -------
+        dict
+            subsample_size, total_spikes, label_agreement (fraction of spikes
+            with identical labels), adjusted_rand_index, subsample_bic (on
+            full data) and full_bic
+        '''
+        full_model = GaussianMixture(n_components = self.params['clusters'],
+                                     covariance_type = 'full',
+                                     tol = self.params['thresh'],
+                                     max_iter = self.params['iterations'],
+                                     weights_init = model.weights_,
+                                     means_init = model.means_,
+                                     precisions_init = model.precisions_)
+        full_model.fit(data)
+        full_predictions = predict_in_chunks(full_model, data,
+                                             self.params['chunk_size'])
+        out = {'subsample_size': int(n_subsample),
+               'total_spikes': int(data.shape[0]),
+               'label_agreement': float(np.mean(predictions == full_predictions)),
+               'adjusted_rand_index': float(adjusted_rand_score(full_predictions,
+                                                                predictions)),
+               'subsample_bic': float(get_bic_in_chunks(model, data,
+                                                        self.params['chunk_size'])),
+               'full_bic': float(get_bic_in_chunks(full_model, data,
+                                                   self.params['chunk_size']))}
+        userIO.tell_user('GMM subsample agreement (%i of %i spikes, %i '
+                         'clusters): %0.3f labels, ARI %0.3f'
+                         % (n_subsample, data.shape[0],
+                            self.params['clusters'], out['label_agreement'],
+                            out['adjusted_rand_index']), shell=True)
+        return out
+
 
 class SpikeSorter(object):
-    def __init__(self, rec_dirs, electrode, clustering_dir=None, shell=False):
+    def __init__(self, rec_dirs, electrode, clustering_dir=None, shell=False,
+                 resume=True, autosave=True):
+        '''Interface for manually sorting clustered spikes
+
+        Parameters
+        ----------
+        rec_dirs : str or list of str
+        electrode : int
+        clustering_dir : str (optional)
+            BlechClust output directory, default is BlechClust/electrode_N
+            in the recording directory or the parent of multiple recordings
+        shell : bool (optional)
+        resume : bool (optional)
+            True (default) reopens the sorting session saved in
+            clustering_dir if there is one
+        autosave : bool (optional)
+            True (default) writes the session file after every change so it
+            survives the GUI closing or crashing
+        '''
         if isinstance(rec_dirs, str):
             rec_dirs = [rec_dirs]
 
@@ -1030,16 +2318,27 @@ class SpikeSorter(object):
         self.clustering = clust
         self._current_solution = None
         self._active = None
-        self._last_saved = None
         self._previous = None
         self._shell = shell
         self._split_results = None
         self._split_starter = None
         self._split_index = None
         self._last_umap_embedding = None
-        self._last_action = None
-        self._last_popped = None  # Dict of indices to clusters
-        self._last_added = None  # List of indices
+        # Results of view computations (PCA, UMAP, wavelets, correlograms)
+        # keyed on the clusters they were computed from, so a result
+        # computed ahead of time in a background thread can be reused. Worker
+        # and prefetch threads share it, so it is only touched under the lock
+        self._view_cache = OrderedDict()
+        self._view_cache_size = 16
+        self._view_cache_lock = threading.Lock()
+        # Undo/redo log. Each entry records the clusters removed from the
+        # active list (by index) and the clusters appended to it. Entries
+        # share unchanged clusters by reference, so each step only costs the
+        # index arrays of the clusters it creates.
+        self._history = []
+        self._redo_history = []
+        self._session_file = os.path.join(clustering_dir, 'sorting_session.npz')
+        self._autosave = autosave
 
         thresh = []
         for rd in rec_dirs:
@@ -1047,27 +2346,105 @@ class SpikeSorter(object):
             thresh.append(sd.detection_threshold)
 
         self._detection_thresholds = thresh
+        if resume and os.path.isfile(self._session_file):
+            try:
+                self.load_history(self._session_file)
+                print('Resumed sorting session from %s' % self._session_file)
+            except (ValueError, KeyError, IndexError, OSError,
+                    zipfile.BadZipFile) as error:
+                # Corrupt or stale session, start from the clustering
+                print('Could not resume sorting session: %s' % error)
+
+    def _save_session(self):
+        '''Writes the current session to the session file if autosave is on
+        '''
+        if not self._autosave or self._active is None:
+            return
+
+        self.save_history(self._session_file)
+
+    def clear_session(self):
+        '''Deletes the saved sorting session for this electrode
+        '''
+        if os.path.isfile(self._session_file):
+            os.remove(self._session_file)
+
+    def _apply_action(self, action, removed, added, saved=None):
+        '''Removes the active clusters at indices removed, appends the
+        clusters in added and records the change in the undo log
+        '''
+        popped = {i: self._active[i] for i in removed}
+        self._active = [c for i, c in enumerate(self._active) if i not in popped]
+        self._active.extend(added)
+        self._history.append({'action': action, 'popped': popped,
+                              'added': list(added), 'saved': saved})
+        self._redo_history = []
+        self._save_session()
+
+    def get_undo_action(self):
+        '''Returns name of the action that undo would revert, or None
+        '''
+        if len(self._history) == 0:
+            return None
+
+        return self._history[-1]['action']
+
+    def get_redo_action(self):
+        '''Returns name of the action that redo would re-apply, or None
+        '''
+        if len(self._redo_history) == 0:
+            return None
+
+        return self._redo_history[-1]['action']
 
     def undo(self):
-        if self._last_action is None:
+        '''Reverts the most recent action. Can be called repeatedly to step
+        back through the session. Undoing a save deletes the saved units from
+        the recordings' h5 files and cannot be redone.
+        '''
+        if len(self._history) == 0:
             return
 
-        if self._last_action == 'save':
-            self.undo_last_save()
-            return
+        entry = self._history.pop()
+        if entry['action'] == 'save':
+            self._delete_saved_units(entry)
 
-        # Remove last added
-        for k in reversed(sorted(self._last_added)):
-            self._active.pop(k)
+        # Remove added clusters
+        self._active = [c for c in self._active
+                        if not any(c is x for x in entry['added'])]
 
         # Insert previous clusters
-        for k in sorted(self._last_popped.keys()):
-            self._active.insert(k, self._last_popped[k])
+        for k in sorted(entry['popped'].keys()):
+            self._active.insert(k, entry['popped'][k])
+
+        if entry['action'] != 'save':
+            self._redo_history.append(entry)
+
+        self._save_session()
+
+    def _delete_saved_units(self, entry):
+        '''Deletes the units written by a save from the recordings' h5 files
+        '''
+        rec_key = self.clustering._rec_key
+        for i, rec in rec_key.items():
+            if entry['saved'].get(i) is None:
+                continue
+
+            for unit in reversed(np.sort(entry['saved'][i])):
+                h5io.delete_unit(rec, unit)
+
+    def redo(self):
+        '''Re-applies the most recently undone action
+        '''
+        if len(self._redo_history) == 0:
+            return
 
-        # reset
-        self._last_action = None
-        self._last_popped = None
-        self._last_added = None
+        entry = self._redo_history.pop()
+        redo_history = self._redo_history
+        self._apply_action(entry['action'], list(entry['popped'].keys()),
+                           entry['added'])
+        self._redo_history = redo_history
+        self._save_session()
 
     def set_active_clusters(self, solution_num):
         self._current_solution = solution_num
@@ -1077,9 +2454,135 @@ class SpikeSorter(object):
             raise ValueError('Solution or clusters not found')
 
         self._active = clusters
-        self._last_action = None
-        self._last_popped = None
-        self._last_added = None
+        self._history = []
+        self._redo_history = []
+        self._split_starter = None
+        self._split_index = None
+        self._split_results = None
+        self._save_session()
+
+    def save_history(self, filename):
+        '''Writes the active clusters, the undo/redo log and any split
+        waiting for set_split to a .npz file so that a sorting session can
+        be resumed with load_history. Each cluster is stored once as its
+        indices into the electrode's spike data, no matter how many log
+        entries reference it.
+
+        Parameters
+        ----------
+        filename : str, path to .npz file
+        '''
+        clusters = {}
+        arrays = {}
+
+        def cluster_key(clust):
+            k = id(clust)
+            if k not in clusters:
+                idx = self._get_spike_index(clust)
+                if idx is None:
+                    raise ValueError('Cluster %s is not in the electrode spike data'
+                                     % clust['Cluster_Name'])
+
+                key = 'cluster_%i' % len(clusters)
+                arrays[key] = idx
+                clusters[k] = (key, {'Cluster_Name': clust['Cluster_Name'],
+                                     'solution_num': int(clust['solution_num']),
+                                     'cluster_num': int(clust['cluster_num']),
+                                     'cluster_id': int(clust['cluster_id']),
+                                     'manipulations': clust['manipulations']})
+
+            return clusters[k][0]
+
+        def entry_info(entry):
+            saved = None
+            if entry['saved'] is not None:
+                saved = {str(k): v for k, v in entry['saved'].items()}
+
+            return {'action': entry['action'],
+                    'popped': {str(k): cluster_key(v)
+                               for k, v in entry['popped'].items()},
+                    'added': [cluster_key(x) for x in entry['added']],
+                    'saved': saved}
+
+        log = {'solution': self._current_solution,
+               'active': [cluster_key(x) for x in self._active],
+               'history': [entry_info(x) for x in self._history],
+               'redo_history': [entry_info(x) for x in self._redo_history],
+               'signature': self.clustering._spike_cache.get_data_signature()}
+        if self._split_starter is not None:
+            # split waiting for set_split
+            log['split'] = {'index': self._split_index,
+                            'starter': cluster_key(self._split_starter),
+                            'results': [cluster_key(x) for x in
+                                        (self._split_results or [])]}
+
+        log['clusters'] = {v[0]: v[1] for v in clusters.values()}
+
+        # Write to a temporary file first so a crash can't corrupt the log
+        tmp_file = filename + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, log=json.dumps(log), **arrays)
+
+        os.replace(tmp_file, filename)
+
+    def load_history(self, filename):
+        '''Restores active clusters and the undo/redo log written by
+        save_history
+
+        Parameters
+        ----------
+        filename : str, path to .npz file
+        '''
+        _, _, _, fs, offsets = self.clustering.get_spike_data()
+        spike_cache = self.clustering._spike_cache
+        with np.load(filename) as dat:
+            log = json.loads(str(dat['log']))
+            if log.get('signature', spike_cache.get_data_signature()) != spike_cache.get_data_signature():
+                raise ValueError('Spike detection has changed since %s was saved'
+                                 % filename)
+
+            clusters = {}
+            for key, info in log['clusters'].items():
+                clusters[key] = SpikeCluster(info['Cluster_Name'],
+                                             self.electrode,
+                                             info['solution_num'],
+                                             info['cluster_num'],
+                                             info['cluster_id'],
+                                             None, None, None,
+                                             self.clustering._rec_key.copy(),
+                                             fs.copy(), offsets.copy(),
+                                             manipulations=info['manipulations'],
+                                             store=spike_cache,
+                                             spike_idx=dat[key])
+
+        def make_entry(info):
+            saved = None
+            if info['saved'] is not None:
+                saved = {int(k): v for k, v in info['saved'].items()}
+
+            return {'action': info['action'],
+                    'popped': {int(k): clusters[v]
+                               for k, v in info['popped'].items()},
+                    'added': [clusters[x] for x in info['added']],
+                    'saved': saved}
+
+        # Read everything before changing the session, so a corrupt log
+        # leaves it untouched
+        active = [clusters[x] for x in log['active']]
+        history = [make_entry(x) for x in log['history']]
+        redo_history = [make_entry(x) for x in log['redo_history']]
+        split = log.get('split')
+        if split is not None:
+            split = (split['index'], clusters[split['starter']],
+                     [clusters[x] for x in split['results']])
+        else:
+            split = (None, None, None)
+
+        self._current_solution = log['solution']
+        self._active = active
+        self._history = history
+        self._redo_history = redo_history
+        self._split_index, self._split_starter, self._split_results = split
 
     def save_clusters(self, target_clusters, single_unit, pyramidal, interneuron):
         '''Saves active clusters as cells, write them to the h5_files in the
@@ -1106,78 +2609,194 @@ class SpikeSorter(object):
             raise ValueError('Length of input lists must match number of '
                              'active clusters. Expected %i' % n_clusters)
 
-        self._last_action = 'save'
-        self._last_popped = {i: self._active[i] for i in target_clusters}
-        self._last_added = []
         clusters = [self._active[i] for i in target_clusters]
         rec_key = self.clustering._rec_key
-        self._last_saved = dict.fromkeys(rec_key.keys(), None)
+        saved = dict.fromkeys(rec_key.keys(), None)
 
+        # Gather all units first so each recording's h5 file is written once
+        spike_cache = self.clustering._spike_cache
+        units = []
+        unit_clusters = []
         for clust, single, pyr, intr in zip(clusters, single_unit,
                                             pyramidal, interneuron):
+            clust_map = clust['spike_map']
+            clust_times = clust['spike_times']
+            clust_idx = self._get_spike_index(clust)
             for i, rec in rec_key.items():
-                idx = np.where(clust['spike_map'] == i)[0]
+                idx = np.where(clust_map == i)[0]
                 if len(idx) == 0:
                     continue
 
-                waves = clust['spike_waveforms'][idx]
-                times = clust['spike_times'][idx]
-                unit_name = h5io.add_new_unit(rec, self.electrode, waves,
-                                              times, single, pyr, intr)
-                if self._last_saved[i] is None:
-                    self._last_saved[i] = [unit_name]
+                if clust_idx is not None:
+                    waves = spike_cache.get_waveforms(clust_idx[idx])
                 else:
-                    self._last_saved[i].append(unit_name)
-
-                metrics_dir = os.path.join(rec,'sorted_unit_metrics', unit_name)
-                if not os.path.isdir(metrics_dir):
-                    os.makedirs(metrics_dir)
-
-                # Write cluster info to file
-                print_clust = clust.copy()
-                for k,v in clust.items():
-                    if isinstance(v, np.ndarray):
-                        print_clust.pop(k)
-
-                print_clust.pop('rec_key')
-                print_clust.pop('fs')
-                clust_info_file = os.path.join(metrics_dir, 'cluster.info')
-                with open(clust_info_file, 'a+') as log:
-                    print('%s sorted on %s'
-                          % (unit_name,
-                             dt.datetime.today().strftime('%m/%d/%y %H:%M')),
-                          file=log)
-                    print('Cluster info: \n----------', file=log)
-                    print(pt.print_dict(print_clust), file=log)
-                    print('Saved metrics to %s' % metrics_dir, file=log)
-                    print('--------------\n', file=log)
+                    waves = clust['spike_waveforms'][idx]
+
+                # Store native rate snippets if spike detection kept them
+                snippets, alignment = None, None
+                if clust_idx is not None:
+                    snippets, alignment = spike_cache.get_compact_waveforms(clust_idx[idx])
+
+                units.append({'rec_dir': rec, 'electrode': self.electrode,
+                              'waves': waves, 'times': clust_times[idx],
+                              'single_unit': single, 'pyramidal': pyr,
+                              'interneuron': intr, 'snippets': snippets,
+                              'alignment': alignment})
+                unit_clusters.append((i, clust))
+
+        unit_names = h5io.add_new_units(units)
+        for unit_name, unit, (i, clust) in zip(unit_names, units, unit_clusters):
+            rec = unit['rec_dir']
+            if saved[i] is None:
+                saved[i] = [unit_name]
+            else:
+                saved[i].append(unit_name)
+
+            metrics_dir = os.path.join(rec,'sorted_unit_metrics', unit_name)
+            if not os.path.isdir(metrics_dir):
+                os.makedirs(metrics_dir)
+
+            # Write cluster info to file
+            print_clust = clust.copy()
+            for k,v in clust.items():
+                if isinstance(v, np.ndarray):
+                    print_clust.pop(k)
+
+            print_clust.pop('rec_key')
+            print_clust.pop('fs')
+            clust_info_file = os.path.join(metrics_dir, 'cluster.info')
+            with open(clust_info_file, 'a+') as log:
+                print('%s sorted on %s'
+                      % (unit_name,
+                         dt.datetime.today().strftime('%m/%d/%y %H:%M')),
+                      file=log)
+                print('Cluster info: \n----------', file=log)
+                print(pt.print_dict(print_clust), file=log)
+                print('Saved metrics to %s' % metrics_dir, file=log)
+                print('--------------\n', file=log)
 
         userIO.tell_user('Target clusters successfully saved to recording '
                          'directories.', shell=True)
-        self._active = [self._active[i] for i in range(len(self._active))
-                        if i not in target_clusters]
+        self._apply_action('save', target_clusters, [], saved=saved)
 
     def undo_last_save(self):
-        if self._last_saved is None:
-            return
+        '''Undoes the most recent save, deleting its units from the
+        recordings' h5 files. If it was the last action the saved clusters
+        return to their original places, otherwise they are appended to the
+        active clusters, since later actions have rearranged the rest.
+        Returns True if a save was undone.
+        '''
+        saves = [i for i, x in enumerate(self._history) if x['action'] == 'save']
+        if len(saves) == 0:
+            return False
 
-        rec_key = self.clustering._rec_key
-        last_saved = self._last_saved
-        for i, rec in rec_key.items():
-            for unit in reversed(np.sort(last_saved[i])):
-                h5io.delete_unit(rec, unit)
+        if saves[-1] == len(self._history) - 1:
+            self.undo()
+            return True
 
-        for k in sorted(self._last_popped.keys()):
-            self._active.insert(k, self._last_popped[k])
+        entry = self._history.pop(saves[-1])
+        self._delete_saved_units(entry)
+        self._active.extend(entry['popped'][k] for k in sorted(entry['popped']))
+        self._save_session()
+        return True
 
-        self._last_saved = None
-        self._last_popped = None
-        self._last_added = None
-        self._last_action = None
+    def get_clusters(self, target_clusters):
+        '''Returns the active clusters at the given indices. Since clusters
+        are replaced rather than modified by sorting actions, the returned
+        list is a snapshot that can be handed to computations running in
+        another thread.
+        '''
+        if any([i >= len(self._active) for i in target_clusters]):
+            raise ValueError('Target cluster is out of range.')
+
+        return [self._active[i] for i in target_clusters]
+
+    def _resolve_clusters(self, target_clusters):
+        # Accept indices of active clusters or the clusters themselves
+        return [self._active[c] if isinstance(c, (int, np.integer)) else c
+                for c in target_clusters]
+
+    def _get_view_result(self, name, clusters, func):
+        '''Returns func() cached on the identity and size of clusters'''
+        key = (name,) + tuple((id(c), c.get_n_spikes()) for c in clusters)
+        with self._view_cache_lock:
+            if key in self._view_cache:
+                self._view_cache.move_to_end(key)
+                return self._view_cache[key][1]
+
+        # Computed outside the lock so other views aren't held up
+        out = func()
+        with self._view_cache_lock:
+            # Keep clusters referenced so their ids stay unique
+            self._view_cache[key] = (clusters, out)
+            while len(self._view_cache) > self._view_cache_size:
+                self._view_cache.popitem(last=False)
+
+        return out
+
+    def compute_split(self, target_clust, n_iter, n_restart, thresh, n_clust,
+                      umap=False, progress=None):
+        '''Fits a GMM to the target cluster and returns the sub-clusters.
+        Does not change the active clusters, so it can run in a background
+        thread.
+
+        Parameters
+        ----------
+        target_clust : int or SpikeCluster
+            index of active cluster or the cluster itself
+        n_iter, n_restart, thresh, n_clust : GMM parameters
+        umap : bool (optional), whether to include UMAP features
+        progress : callable (optional)
+            called with a str describing each stage of the computation
+
+        Returns
+        -------
+        list of SpikeCluster
+        '''
+        cluster = self._resolve_clusters([target_clust])[0]
+        if progress is not None:
+            progress('Computing waveform metrics')
+
+        GMM = ClusterGMM(n_iter, n_restart, thresh)
+        waves = cluster['spike_waveforms']
+        umap_cache = None
+        spike_idx = None
+        if umap:
+            spike_idx = self._get_spike_index(cluster)
+            if spike_idx is not None:
+                umap_cache = self.clustering._umap_cache
+
+        data, data_columns = compute_waveform_metrics(waves, umap=umap,
+                                                      umap_cache=umap_cache,
+                                                      spike_idx=spike_idx)
+        if progress is not None:
+            progress('Fitting GMM')
+
+        model, predictions, bic = GMM.fit(data, n_clust)
+        if progress is not None:
+            progress('Building sub-clusters')
+
+        new_clusts = []
+        for i in np.unique(predictions):
+            idx = np.where(predictions == i)[0]
+            edit_str = (cluster['manipulations'] + '\nSplit %s into %i '
+                        'clusters. This is sub-cluster %i'
+                        % (cluster['Cluster_Name'], n_clust, i))
+            tmp_clust = cluster.subset(idx,
+                                       name=cluster['Cluster_Name'] + '-%i' % i,
+                                       cluster_id=cluster['cluster_id']*10+i,
+                                       manipulations=edit_str)
+            new_clusts.append(tmp_clust)
+
+        # PCA for the split plots
+        self.get_pca_coordinates(new_clusts)
+        return new_clusts
 
     def split_cluster(self, target_clust, n_iter, n_restart, thresh, n_clust,
-                      store_split=False, umap=False):
-        '''splits the target active cluster using a GMM
+                      store_split=False, umap=False, new_clusts=None):
+        '''splits the target active cluster using a GMM. new_clusts can be
+        passed to skip the fit if compute_split was already run on the
+        cluster at target_clust.
         '''
         if target_clust >= len(self._active):
             raise ValueError('Invalid target. Only %i active clusters' % len(self._active))
@@ -1187,29 +2806,9 @@ class SpikeSorter(object):
         self._split_index = target_clust
 
         try:
-            GMM = ClusterGMM(n_iter, n_restart, thresh)
-            waves = cluster['spike_waveforms']
-            data, data_columns = compute_waveform_metrics(waves, umap=umap)
-            model, predictions, bic = GMM.fit(data, n_clust)
-            new_clusts = []
-            for i in np.unique(predictions):
-                idx = np.where(predictions == i)[0]
-                edit_str = (cluster['manipulations'] + '\nSplit %s into %i '
-                            'clusters. This is sub-cluster %i'
-                            % (cluster['Cluster_Name'], n_clust, i))
-                tmp_clust = SpikeCluster(cluster['Cluster_Name'] + '-%i' % i,
-                                         cluster['electrode_num'],
-                                         cluster['solution_num'],
-                                         cluster['cluster_num'],
-                                         cluster['cluster_id']*10+i,
-                                         waves[idx],
-                                         cluster['spike_times'][idx],
-                                         cluster['spike_map'][idx],
-                                         cluster['rec_key'].copy(),
-                                         cluster['fs'].copy(),
-                                         cluster['offsets'].copy(),
-                                         manipulations=edit_str)
-                new_clusts.append(tmp_clust)
+            if new_clusts is None:
+                new_clusts = self.compute_split(cluster, n_iter, n_restart,
+                                                thresh, n_clust, umap=umap)
 
             # Plot cluster and ask to choose which to keep
             figs = []
@@ -1222,7 +2821,8 @@ class SpikeSorter(object):
                 figs.append(tmp_fig)
                 tmp_fig.show()
 
-            f2 = dplt.plot_waveforms_pca([c['spike_waveforms'] for c in new_clusts])
+            f2 = dplt.plot_waveforms_pca([c['spike_waveforms'] for c in new_clusts],
+                                         coordinates=self.get_pca_coordinates(new_clusts))
             figs.append(f2)
             f2.show()
         except:
@@ -1234,6 +2834,7 @@ class SpikeSorter(object):
 
         if store_split:
             self._split_results = new_clusts
+            self._save_session()
             return new_clusts
         else:
             self._split_starter = None
@@ -1247,11 +2848,8 @@ class SpikeSorter(object):
                 self._active.insert(target_clust, cluster)
             else:
                 keepers = [new_clusts[int(i)] for i in ans]
-                start_idx = len(self._active)
-                self._last_added = list(range(start_idx, start_idx+len(keepers)))
-                self._last_popped = {target_clust: cluster}
-                self._last_action = 'split'
-                self._active.extend(keepers)
+                self._active.insert(target_clust, cluster)
+                self._apply_action('split', [target_clust], keepers)
 
             return True
 
@@ -1263,82 +2861,27 @@ class SpikeSorter(object):
             self._active.insert(self._split_index, self._split_starter)
         else:
             keepers = [self._split_results[i] for i in choices]
-            start_idx = len(self._active)
-            self._last_added = list(range(start_idx, start_idx+len(keepers)))
-            self._last_popped = {self._split_index: self._split_starter}
-            self._last_action = 'split'
-            self._active.extend(keepers)
+            self._active.insert(self._split_index, self._split_starter)
+            self._apply_action('split', [self._split_index], keepers)
 
         self._split_index = None
         self._split_results = None
         self._split_starter = None
+        self._save_session()
 
     def merge_clusters(self, target_clusters):
         if any([i >= len(self._active) for i in target_clusters]):
             raise ValueError('Target cluster is out of range.')
 
-        new_clust = []
-        self._last_popped = {}
-        self._last_action = 'merge'
-        self._last_added = []
+        new_clust = None
         for c in target_clusters:
-            self._last_popped[c] = self._active[c]
-
-            if len(new_clust) == 0:
+            if new_clust is None:
                 new_clust = deepcopy(self._active[c])
                 continue
 
-            clust = self._active[c]
-            sm1 = new_clust['spike_map']
-            sm2 = clust['spike_map']
-            st1 = new_clust['spike_times']
-            st2 = clust['spike_times']
-            sw1 = new_clust['spike_waveforms']
-            sw2 = clust['spike_waveforms']
-
-            spike_map = np.hstack((sm1, sm2))
-            spike_times = np.hstack((st1, st2))
-            spike_waveforms = np.vstack((sw1, sw2))
-
-            # Re-order to spike_map
-            idx = np.argsort(spike_map)
-            spike_map = spike_map[idx]
-            spike_times = spike_times[idx]
-            spike_waveforms = spike_waveforms[idx]
-
-            # Re-order so spike_times within a reocrding are in order
-            times = []
-            waves = []
-            new_map = []
-            for i in np.unique(spike_map):
-                idx = np.where(spike_map == i)[0]
-                st = spike_times[idx]
-                sw = spike_waveforms[idx]
-                sm = spike_map[idx]
-                idx2 = np.argsort(st)
-                st = st[idx2]
-                sw = sw[idx2]
-                sm = sm[idx2]
-                times.append(st)
-                waves.append(sw)
-                new_map.append(sm)
-
-            times = np.hstack(times)
-            waves = np.vstack(waves)
-            spike_map = np.hstack(new_map)
-            del new_map, spike_times, spike_waveforms
-
-            new_clust['spike_map'] = spike_map
-            new_clust['spike_times'] = times
-            new_clust['spike_waveforms'] = waves
-            new_clust['manipulations'] += '\nMerged with %s.' % clust['Cluster_Name']
-            new_clust['Cluster_Name'] += '+' + clust['Cluster_Name'].replace('Cluster_','')
-
-        self._active = [self._active[i] for i in range(len(self._active))
-                        if i not in target_clusters]
-
-        self._last_added = [len(self._active)]
-        self._active.append(new_clust)
+            new_clust = new_clust.merge(self._active[c])
+
+        self._apply_action('merge', target_clusters, [new_clust])
 
     def discard_clusters(self, target_clusters):
         if isinstance(target_clusters, int):
@@ -1347,11 +2890,7 @@ class SpikeSorter(object):
         if len(target_clusters) == 0:
             return
 
-        self._last_action = 'discard'
-        self._last_popped = {i: self._active[i] for i in target_clusters}
-        self._last_added = []
-        self._active = [self._active[i] for i in range(len(self._active))
-                        if i not in target_clusters]
+        self._apply_action('discard', target_clusters, [])
 
     def plot_clusters_waveforms(self, target_clusters):
         if len(target_clusters) == 0:
@@ -1379,25 +2918,14 @@ class SpikeSorter(object):
         if len(sm) == 1:
             return
         else:
-            clust = self._active.pop(target_cluster)
-            st = clust['spike_times']
-            sw = clust['spike_waveforms']
             keepers = []
             for i in recs:
                 idx = np.where(sm == i)[0]
-                new_clust = deepcopy(clust)
-                new_clust['spike_times'] = st[idx]
-                new_clust['spike_waveforms'] = sw[idx, :]
-                new_clust['cluster_id'] = clust['cluster_id']*10 + i
-                new_clust['spike_map'] = sm[idx]
-                new_clust['manipulations'] = '\nSplit by recording'
+                new_clust = clust.subset(idx, cluster_id=clust['cluster_id']*10 + i,
+                                         manipulations='\nSplit by recording')
                 keepers.append(new_clust)
 
-        start_idx = len(self._active)
-        self._last_added = list(range(start_idx, start_idx+len(keepers)))
-        self._last_popped = {target_cluster: clust}
-        self._last_action = 'split'
-        self._active.extend(keepers)
+        self._apply_action('split', [target_cluster], keepers)
 
     def plot_cluster_waveforms_by_rec(self, target_cluster):
         if isinstance(target_cluster, list) and len(target_cluster) != 1:
@@ -1444,30 +2972,112 @@ class SpikeSorter(object):
                                           threshold=self._detection_thresholds[0])
             fig.show()
 
+    def get_pca_coordinates(self, target_clusters):
+        '''Returns the first 3 PCs of the waveforms of each target cluster,
+        with PCA fit on all of their waveforms together
+
+        Parameters
+        ----------
+        target_clusters : list of int or SpikeCluster
+
+        Returns
+        -------
+        list of np.array
+        '''
+        clusters = self._resolve_clusters(target_clusters)
+
+        def fit():
+            waves = [c['spike_waveforms'] for c in clusters]
+            pca = PCA(n_components=3)
+            pca.fit(np.vstack(waves))
+            return [pca.transform(x) for x in waves]
+
+        return self._get_view_result('pca', clusters, fit)
+
     def plot_clusters_pca(self, target_clusters):
         if len(target_clusters) == 0:
             return
 
         waves = [self._active[i]['spike_waveforms'] for i in target_clusters]
-        fig = dplt.plot_waveforms_pca(waves, cluster_ids=target_clusters)
+        coords = self.get_pca_coordinates(target_clusters)
+        fig = dplt.plot_waveforms_pca(waves, cluster_ids=target_clusters,
+                                      coordinates=coords)
         fig.show()
 
+    def get_umap_coordinates(self, target_clusters, progress=None):
+        '''Returns 2D UMAP coordinates of the waveforms of each target
+        cluster from a UMAP fit on the waveforms of all target clusters. The
+        embedding is cached when every cluster can be located in the
+        electrode's spike data.
+
+        Parameters
+        ----------
+        target_clusters : list of int or SpikeCluster
+        progress : callable (optional)
+            called with a str describing the step being computed
+
+        Returns
+        -------
+        list of np.array
+        '''
+        clusters = self._resolve_clusters(target_clusters)
+
+        def fit():
+            idx = [self._get_spike_index(c) for c in clusters]
+            if all(x is not None for x in idx):
+                if progress is not None:
+                    progress('Fitting UMAP')
+
+                umap_cache = self.clustering._umap_cache
+                embedding = umap_cache.get_embedding(n_components=2,
+                                                     idx=np.concatenate(idx))
+                return np.split(embedding, np.cumsum([len(x) for x in idx])[:-1])
+
+            if progress is not None:
+                progress('Fitting UMAP')
+
+            waves = [c['spike_waveforms'] for c in clusters]
+            reducer = umap.UMAP(n_neighbors=30, min_dist=0.0, n_components=2)
+            embedding = reducer.fit(np.vstack(waves))
+            return [embedding.transform(x) for x in waves]
+
+        return self._get_view_result('umap', clusters, fit)
+
     def plot_clusters_umap(self, target_clusters):
         if len(target_clusters) == 0:
             return
 
         waves = [self._active[i]['spike_waveforms'] for i in target_clusters]
-        fig = dplt.plot_waveforms_umap(waves, cluster_ids=target_clusters)
+        coords = self.get_umap_coordinates(target_clusters)
+        fig = dplt.plot_waveforms_umap(waves, cluster_ids=target_clusters,
+                                       coordinates=coords)
         fig.show()
 
+    def get_wavelet_index(self, target_clusters, n_pc=4):
+        '''Returns the indices of the n_pc least normally distributed wavelet
+        coefficients of the waveforms of the target clusters
+        '''
+        clusters = self._resolve_clusters(target_clusters)
+
+        def rank():
+            waves = np.vstack([c['spike_waveforms'] for c in clusters])
+            coeffs = clustering.get_wavelet_coefficients(waves)
+            return clustering.rank_wavelet_coefficients(coeffs,
+                                                     constant_pval=1)[:n_pc]
+
+        return self._get_view_result('wavelets_%i' % n_pc, clusters, rank)
+
     def plot_clusters_wavelets(self, target_clusters):
         if len(target_clusters) == 0:
             return
 
+        n_pc = 4
         waves = [self._active[i]['spike_waveforms'] for i in target_clusters]
+        coeff_idx = self.get_wavelet_index(target_clusters, n_pc=n_pc)
         fig, ax = dplt.plot_waveforms_wavelet_tranform(waves,
                                                        cluster_ids=target_clusters,
-                                                       n_pc=4)
+                                                       n_pc=n_pc,
+                                                       coeff_idx=coeff_idx)
         fig.show()
 
     def plot_clusters_raster(self, target_clusters):
@@ -1507,14 +3117,25 @@ class SpikeSorter(object):
             ax.set_title(title)
             fig.show()
 
+    def get_correlograms(self, target_clusters):
+        '''Returns all auto- and cross-correlograms of the target clusters,
+        see spike_analysis.spike_time_correlograms
+        '''
+        clusters = self._resolve_clusters(target_clusters)
+
+        def compute():
+            spike_times = [c.get_spike_time_vector(units='ms') for c in clusters]
+            return sas.spike_time_correlograms(spike_times)
+
+        return self._get_view_result('correlograms', clusters, compute)
+
     def plot_clusters_acorr(self, target_clusters):
         if len(target_clusters) == 0 or not all([x < len(self._active) for x in target_clusters]):
             return
 
-        for i in target_clusters:
-            cluster = self._active[i]
-            acf, bin_centers, edges = sas.spike_time_acorr(cluster.get_spike_time_vector(units='ms'))
-            fig, ax = dplt.plot_correlogram(acf, bin_centers, edges)
+        counts, bin_centers, edges = self.get_correlograms(target_clusters)
+        for k, i in enumerate(target_clusters):
+            fig, ax = dplt.plot_correlogram(counts[k, k], bin_centers, edges)
             title = 'Index: %i\nAutocorrelogram' % (i)
             ax.set_title(title)
             fig.show()
@@ -1523,17 +3144,27 @@ class SpikeSorter(object):
         if len(target_clusters) == 0 or not all([x < len(self._active) for x in target_clusters]):
             return
 
-        pairs = it.combinations(target_clusters, 2)
-        for x, y in pairs:
-            clust1 = self._active[x]
-            clust2 = self._active[y]
-            xcf, bin_centers, edges = sas.spike_time_xcorr(clust1.get_spike_time_vector(units='ms'),
-                                                    clust2.get_spike_time_vector(units='ms'))
-            fig, ax = dplt.plot_correlogram(xcf, bin_centers, edges)
+        counts, bin_centers, edges = self.get_correlograms(target_clusters)
+        pairs = it.combinations(range(len(target_clusters)), 2)
+        for k1, k2 in pairs:
+            x = target_clusters[k1]
+            y = target_clusters[k2]
+            fig, ax = dplt.plot_correlogram(counts[k1, k2], bin_centers, edges)
             title = 'Cross-correlogram\n%i vs %i' % (x, y)
             ax.set_title(title)
             fig.show()
 
+    def _get_spike_index(self, cluster):
+        '''Returns indices of the cluster's spikes in the electrode's spike
+        data cache, or None if they can't all be found
+        '''
+        spike_cache = self.clustering._spike_cache
+        if cluster.is_index_backed() and cluster._store is spike_cache:
+            return cluster['spike_idx']
+
+        return spike_cache.get_spike_index(cluster['spike_map'],
+                                           cluster['spike_times'])
+
     def get_mean_waveform(self, target_cluster):
         '''Returns mean waveform of target_cluster in active clusters. Also
         returns St. Dev. of waveforms
@@ -1541,6 +3172,43 @@ class SpikeSorter(object):
         cluster = self._active[target_cluster]
         return cluster.get_mean_waveform()
 
+    def get_waveform_image(self, target_cluster, width=300, height=200):
+        '''Returns shaded density image of all waveforms in target_cluster,
+        rasterized in memory, and the voltage range it spans
+
+        Returns
+        -------
+        np.array, tuple
+            (height, width, 3) uint8 image with top row at y_range[1],
+            (min, max) voltage
+        '''
+        return self.get_waveform_images([target_cluster], width=width,
+                                        height=height)[0]
+
+    def get_waveform_images(self, target_clusters, width=300, height=200):
+        '''Returns the shaded density image and voltage range of each target
+        cluster, as for get_waveform_image. Images are cached per cluster, so
+        after a sorting action only new clusters are rasterized.
+
+        Parameters
+        ----------
+        target_clusters : list of int or SpikeCluster
+
+        Returns
+        -------
+        list of (np.array, tuple)
+        '''
+        def rasterize(cluster):
+            counts, y_range = blech_waveforms_datashader.rasterize_waveforms(cluster['spike_waveforms'],
+                                                                             width=width,
+                                                                             height=height)
+            img = blech_waveforms_datashader.shade_counts(counts[::-1])
+            return img, y_range
+
+        return [self._get_view_result(('waveform_image', width, height), [c],
+                                      lambda: rasterize(c))
+                for c in self._resolve_clusters(target_clusters)]
+
     def get_possible_solutions(self):
         results = self.clustering.results.dropna()
         converged = list(results[results['converged']].index)
@@ -1548,8 +3216,42 @@ class SpikeSorter(object):
 
 
 class SpikeCluster(dict):
+    '''Dictionary of spike waveforms, times and recording map for a cluster
+    along with its metadata. If store and spike_idx are passed the cluster is
+    index-backed: it only holds spike_idx, integer indices into a shared
+    per-electrode SpikeDataCache, and spike_waveforms, spike_times and
+    spike_map are read from the store when accessed. Splitting, merging and
+    deleting spikes from index-backed clusters only manipulates indices.
+    Reading spike data raises a ValueError if the store was rebuilt from
+    different spike detection output since the cluster was created, since
+    its indices would then point at the wrong spikes.
+
+    Index-backed clusters hold spike_idx as their only spike data key, so
+    keys(), values(), items() and iteration list spike_idx and not
+    spike_waveforms, spike_times or spike_map. Those are only available
+    through indexing, get and `in`.
+    '''
+    _store_keys = ('spike_waveforms', 'spike_times', 'spike_map')
+
     def __init__(self, name, electrode, solution, cluster, cluster_id, waves, times,
-                 spike_map, rec_key, fs={0: 30000}, offsets={0:0}, manipulations=''):
+                 spike_map, rec_key, fs={0: 30000}, offsets={0:0}, manipulations='',
+                 store=None, spike_idx=None):
+        self._store = None
+        self._store_signature = None
+        if store is not None and spike_idx is not None:
+            spike_idx = np.asarray(spike_idx, dtype='int64')
+            spike_map = store.get_spike_data()[2][spike_idx]
+            self._store = store
+            self._store_signature = store.get_data_signature()
+            data = dict(spike_idx=spike_idx)
+        else:
+            # Confirm same number of waves, times and map entries
+            if waves.shape[0] != len(times) or len(times) != len(spike_map):
+                raise ValueError('Must have same number of waves, times and map entries')
+
+            data = dict(spike_waveforms=waves, spike_times=times,
+                        spike_map=spike_map)
+
         # Confirm spike_map, rec_key, fs and offsets are all in sync
         rec_nums = np.unique(spike_map)
         if (not all([x in rec_key.keys() for x in rec_nums]) or
@@ -1558,35 +3260,203 @@ class SpikeCluster(dict):
             raise ValueError('rec_key, fs and offsets must have entries for '
                              'each unique element of spike_map')
 
-        # Confirm same number of waves, times and map entries
-        if waves.shape[0] != len(times) or len(times) != len(spike_map):
-            raise ValueError('Must have same number of waves, times and map entries')
-
         super(SpikeCluster, self).__init__(Cluster_Name=name,
                                            electrode_num=electrode,
                                            solution_num=solution,
                                            cluster_num = cluster,
                                            cluster_id=cluster_id,
-                                           spike_waveforms=waves,
-                                           spike_times=times,
-                                           spike_map=spike_map,
                                            rec_key=rec_key,
                                            fs=fs,
                                            offsets=offsets,
-                                           manipulations=manipulations)
+                                           manipulations=manipulations,
+                                           **data)
+
+    def is_index_backed(self):
+        return self._store is not None
+
+    def _check_store(self):
+        if self._store.get_data_signature() != self._store_signature:
+            raise ValueError('Spike data for %s has changed since the cluster '
+                             'was created' % dict.__getitem__(self, 'Cluster_Name'))
+
+    def __getitem__(self, key):
+        if self._store is not None and key in self._store_keys:
+            self._check_store()
+            idx = dict.__getitem__(self, 'spike_idx')
+            waves, times, spike_map, _, _ = self._store.get_spike_data()
+            if key == 'spike_waveforms':
+                return waves[idx]
+            elif key == 'spike_times':
+                return times[idx]
+            else:
+                return spike_map[idx]
+
+        return dict.__getitem__(self, key)
+
+    def __setitem__(self, key, value):
+        self._clear_cache()
+        if self._store is not None and key in self._store_keys:
+            # Assigning spike data directly detaches the cluster from the store
+            self._materialize()
+
+        dict.__setitem__(self, key, value)
+
+    def _clear_cache(self):
+        self.__dict__.pop('_time_cache', None)
+
+    def __contains__(self, key):
+        if self._store is not None and key in self._store_keys:
+            return True
+
+        return dict.__contains__(self, key)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+
+        return default
+
+    def _materialize(self):
+        data = {k: self[k] for k in self._store_keys}
+        dict.pop(self, 'spike_idx')
+        self._store = None
+        self._store_signature = None
+        dict.update(self, data)
+
+    def __copy__(self):
+        out = SpikeCluster.__new__(SpikeCluster)
+        dict.update(out, self)
+        out._store = self._store
+        out._store_signature = self._store_signature
+        return out
+
+    def __deepcopy__(self, memo):
+        # The spike store is shared, not copied
+        out = SpikeCluster.__new__(SpikeCluster)
+        memo[id(self)] = out
+        for k, v in dict.items(self):
+            dict.__setitem__(out, k, deepcopy(v, memo))
+
+        out._store = self._store
+        out._store_signature = self._store_signature
+        return out
+
+    def __reduce__(self):
+        return (_rebuild_spike_cluster, (dict(dict.items(self)), self._store,
+                                         self._store_signature))
+
+    def get_n_spikes(self):
+        if self._store is not None:
+            return len(dict.__getitem__(self, 'spike_idx'))
+
+        return len(dict.__getitem__(self, 'spike_times'))
+
+    def subset(self, idx, name=None, cluster_id=None, manipulations=None):
+        '''Returns a new SpikeCluster with only the spikes at idx. For
+        index-backed clusters no spike data is copied.
+
+        Parameters
+        ----------
+        idx : np.array
+            indices of spikes within this cluster to keep
+        name, cluster_id, manipulations : (optional)
+            metadata for new cluster, defaults to this cluster's
+
+        Returns
+        -------
+        SpikeCluster
+        '''
+        new_clust = copy(self)
+        if self._store is not None:
+            dict.__setitem__(new_clust, 'spike_idx',
+                             dict.__getitem__(self, 'spike_idx')[idx])
+        else:
+            for k in self._store_keys:
+                dict.__setitem__(new_clust, k, dict.__getitem__(self, k)[idx])
+
+        new_clust['rec_key'] = self['rec_key'].copy()
+        new_clust['fs'] = self['fs'].copy()
+        new_clust['offsets'] = self['offsets'].copy()
+        if name is not None:
+            new_clust['Cluster_Name'] = name
+
+        if cluster_id is not None:
+            new_clust['cluster_id'] = cluster_id
+
+        if manipulations is not None:
+            new_clust['manipulations'] = manipulations
+
+        return new_clust
+
+    def merge(self, other):
+        '''Returns a new SpikeCluster with the spikes of both clusters,
+        ordered by recording and then spike time. Index-backed clusters
+        sharing a store are merged with a union of their indices.
+
+        Parameters
+        ----------
+        other : SpikeCluster
+
+        Returns
+        -------
+        SpikeCluster
+        '''
+        new_clust = deepcopy(self)
+        if self._store is not None and self._store is other._store:
+            # store is ordered by recording then spike time
+            idx = np.union1d(dict.__getitem__(self, 'spike_idx'),
+                             dict.__getitem__(other, 'spike_idx'))
+            dict.__setitem__(new_clust, 'spike_idx', idx)
+        else:
+            spike_map = np.hstack((self['spike_map'], other['spike_map']))
+            spike_times = np.hstack((self['spike_times'], other['spike_times']))
+            spike_waveforms = np.vstack((self['spike_waveforms'],
+                                         other['spike_waveforms']))
+
+            # Re-order to spike_map, then spike times within a recording
+            idx = np.lexsort((spike_times, spike_map))
+            new_clust['spike_map'] = spike_map[idx]
+            new_clust['spike_times'] = spike_times[idx]
+            new_clust['spike_waveforms'] = spike_waveforms[idx]
+
+        new_clust['manipulations'] += '\nMerged with %s.' % other['Cluster_Name']
+        new_clust['Cluster_Name'] += '+' + other['Cluster_Name'].replace('Cluster_','')
+        return new_clust
 
     def delete_spikes(self, idx, msg=None):
-        self['spike_waveforms'] = np.delete(self['spike_waveforms'],
-                                               idx, axis=0)
-        self['spike_times'] = np.delete(self['spike_times'], idx)
-        self['spike_map'] = np.delete(self['spike_map'], idx)
+        self._clear_cache()
+        if self._store is not None:
+            dict.__setitem__(self, 'spike_idx',
+                             np.delete(dict.__getitem__(self, 'spike_idx'), idx))
+        else:
+            self['spike_waveforms'] = np.delete(self['spike_waveforms'],
+                                                   idx, axis=0)
+            self['spike_times'] = np.delete(self['spike_times'], idx)
+            self['spike_map'] = np.delete(self['spike_map'], idx)
+
         print('deleted %i spikes.' % len(idx))
         if msg is not None:
             self['manipulations'] += '/n' + msg + '\n-Removed %i spikes' % len(idx)
 
+    def _get_rec_arrays(self):
+        '''Returns offsets and sampling rates as arrays indexed by recording
+        number
+        '''
+        n_recs = int(max(max(self['offsets'].keys()), max(self['fs'].keys()))) + 1
+        offsets = np.zeros((n_recs,), dtype='int64')
+        fs = np.ones((n_recs,), dtype='float64')
+        for k, v in self['offsets'].items():
+            offsets[int(k)] = v
+
+        for k, v in self['fs'].items():
+            fs[int(k)] = v
+
+        return offsets, fs
+
     def get_spike_time_vector(self, units='samples'):
         '''Return vector of all spike times with offsets added if multiple
-        recordings are present
+        recordings are present. Vectors are cached until the cluster is
+        changed, the returned array is read-only.
 
         Parameters
         ----------
@@ -1596,20 +3466,30 @@ class SpikeCluster(dict):
         -------
         numpy.ndarray
         '''
-        if units.lower() == 'ms':
-            times = np.array([(a + self['offsets'][b]) / (self['fs'][b] / 1000)
-                              for a, b in
-                              zip(self['spike_times'].astype('float64'), self['spike_map'])])
-        elif units.lower() == 's':
-            times = np.array([(a + self['offsets'][b]) / self['fs'][b]
-                              for a, b in
-                              zip(self['spike_times'].astype('float64'), self['spike_map'])])
-        elif units.lower() == 'samples':
-            times = np.array([(a + self['offsets'][b]) for a, b in
-                              zip(self['spike_times'], self['spike_map'])])
-        else:
+        units = units.lower()
+        if units not in ['samples', 'ms', 's']:
             raise ValueError('units must be either samples or ms')
 
+        # offsets and fs are mutable dicts so are part of the cache key
+        key = (units, tuple(sorted(self['offsets'].items())),
+               tuple(sorted(self['fs'].items())))
+        cache = self.__dict__.setdefault('_time_cache', {})
+        if key in cache:
+            return cache[key]
+
+        offsets, fs = self._get_rec_arrays()
+        spike_map = self['spike_map'].astype('int64')
+        spike_times = self['spike_times']
+        if units == 'samples':
+            times = spike_times.astype('int64') + offsets[spike_map]
+        else:
+            if units == 'ms':
+                fs = fs / 1000
+
+            times = (spike_times.astype('float64') + offsets[spike_map]) / fs[spike_map]
+
+        times.flags.writeable = False
+        cache[key] = times
         return times
 
     def __eq__(self, other):
@@ -1657,3 +3537,11 @@ class SpikeCluster(dict):
         ''' greater than?'''
         pass
 
+
+
+def _rebuild_spike_cluster(data, store, store_signature=None):
+    out = SpikeCluster.__new__(SpikeCluster)
+    dict.update(out, data)
+    out._store = store
+    out._store_signature = store_signature
+    return out
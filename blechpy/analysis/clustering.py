@@ -1,7 +1,9 @@
 import numpy as np
+import pywt
 from scipy.signal import butter
 from scipy.signal import filtfilt
 from scipy.interpolate import interp1d
+from scipy.stats import norm
 
 
 def get_filtered_electrode(data, freq = [300.0, 3000.0], sampling_rate = 30000.0):
@@ -11,37 +13,175 @@ def get_filtered_electrode(data, freq = [300.0, 3000.0], sampling_rate = 30000.0
     return filt_el
 
 
+def upsample_waveforms(snippets, offsets, n_samples, factor=10):
+    '''Linearly interpolates native-rate waveform snippets onto a grid
+    upsampled by factor, starting each row at its sub-sample alignment
+    offset. Vectorized over all snippets.
+
+    Parameters
+    ----------
+    snippets : np.array, row for each spike (any numeric dtype)
+    offsets : np.array of int
+        position of the first upsampled point of each row in units of
+        1/factor samples from the start of the snippet
+    n_samples : int, number of upsampled points to return per row
+    factor : int (optional), upsampling factor. default is 10
+
+    Returns
+    -------
+    np.array, float64, spike x n_samples
+    '''
+    snippets = np.asarray(snippets)
+    offsets = np.asarray(offsets, dtype='int64')
+    pos = (offsets[:, None] + np.arange(n_samples)[None, :]) * (1.0/factor)
+    idx = np.floor(pos).astype('int64')
+    frac = pos - idx
+    idx = np.minimum(idx, snippets.shape[1] - 1)
+    idx_hi = np.minimum(idx + 1, snippets.shape[1] - 1)
+    rows = np.arange(snippets.shape[0])[:, None]
+    lo = snippets[rows, idx].astype('float64')
+    hi = snippets[rows, idx_hi].astype('float64')
+    return lo + (hi - lo) * frac
+
+
+class CompactWaveforms(object):
+    '''Read-only array-like view of compactly stored waveforms. Only the
+    rows that are indexed are upsampled, so slicing a chunk or a cluster out
+    of a memory-mapped recording never upsamples all of its spikes.
+    Converting the whole view with np.asarray upsamples chunk by chunk.
+
+    Parameters
+    ----------
+    snippets : np.array or np.memmap, native rate snippets, row for each spike
+    alignment : np.array or np.memmap, sub-sample alignment of each snippet
+    n_samples : int, number of upsampled points per waveform
+    factor : int (optional), upsampling factor. default is 10
+    chunk_size : int (optional)
+        number of rows upsampled at a time when iterating or converting
+    '''
+
+    def __init__(self, snippets, alignment, n_samples, factor=10,
+                 chunk_size=50000):
+        self.snippets = snippets
+        self.alignment = alignment
+        self.n_samples = int(n_samples)
+        self.factor = factor
+        self.chunk_size = chunk_size
+        self.shape = (snippets.shape[0], self.n_samples)
+        self.ndim = 2
+        self.dtype = np.dtype('float64')
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows, cols = key[0], key[1:]
+        else:
+            rows, cols = key, ()
+
+        single = np.ndim(rows) == 0 and not isinstance(rows, slice)
+        if single:
+            rows = [rows]
+
+        out = upsample_waveforms(self.snippets[rows], self.alignment[rows],
+                                 self.n_samples, factor=self.factor)
+        if single:
+            out = out[0]
+            return out[cols] if cols else out
+
+        return out[(slice(None),) + cols] if cols else out
+
+    def __iter__(self):
+        for start in range(0, len(self), self.chunk_size):
+            for wave in self[start:start+self.chunk_size]:
+                yield wave
+
+    def __array__(self, dtype=None, copy=None):
+        out = np.zeros(self.shape, dtype=dtype or self.dtype)
+        for start in range(0, len(self), self.chunk_size):
+            out[start:start+self.chunk_size] = self[start:start+self.chunk_size]
+
+        return out
+
+
+def _align_spikes(slices, spike_snapshot, sampling_rate, chunk_size=10000):
+    '''Finds the minimum of each 10x upsampled slice, returns a mask of
+    accepted spikes and the index of the upsampled minimum
+    '''
+    slices = np.asarray(slices)
+    n_up = (slices.shape[1] - 1) * 10
+    before = int((sampling_rate/1000.0)*(spike_snapshot[0]))
+    after = int((sampling_rate/1000.0)*(spike_snapshot[1]))
+    minima = np.zeros((slices.shape[0],), dtype='int64')
+    for start in range(0, slices.shape[0], chunk_size):
+        chunk = slices[start:start+chunk_size]
+        ynew = upsample_waveforms(chunk, np.zeros((chunk.shape[0],)), n_up)
+        minima[start:start+chunk_size] = np.argmin(ynew, axis=1)
+
+    orig_min = np.argmin(slices, axis=1)
+    orig_min_time = orig_min / (sampling_rate/1000)
+    min_time = minima * 0.1 / (sampling_rate/1000)
+    # Only accept spikes if the interpolated minimum has shifted by less
+    # than 1/10th of a ms and a full snapshot fits around it
+    accept = ((np.abs(min_time - orig_min_time) <= 0.1) &
+              (minima + after*10 < n_up) & (minima - before*10 >= 0))
+    return accept, minima, before, after
+
+
 def dejitter(slices, spike_times, spike_snapshot = [0.5, 1.0], sampling_rate = 30000.0):
     '''Upsamples (by 10) and aligns spike waveforms to minima. Returns the
     upsampled waveforms are correct spike_times
     '''
-    x = np.arange(0,len(slices[0]),1)
-    xnew = np.arange(0,len(slices[0])-1,0.1)
+    accept, minima, before, after = _align_spikes(slices, spike_snapshot,
+                                                  sampling_rate)
+    idx = np.where(accept)[0]
+    snippets, offsets = _cut_snippets(slices, minima, idx, before, after)
+    slices_dejittered = upsample_waveforms(snippets, offsets, (before+after)*10)
+    return slices_dejittered, np.asarray(spike_times)[idx]
 
-    # Calculate the number of samples to be sliced out around each spike's minimum
-    before = int((sampling_rate/1000.0)*(spike_snapshot[0]))
-    after = int((sampling_rate/1000.0)*(spike_snapshot[1]))
 
-    slices_dejittered = []
-    spike_times_dejittered = []
-    for i in range(len(slices)):
-        f = interp1d(x, slices[i])
-        # 10-fold interpolated spike
-        ynew = f(xnew)
-        orig_min = np.where(slices[i] == np.min(slices[i]))[0][0]
-        orig_min_time = x[orig_min] / (sampling_rate/1000)
-        minimum = np.where(ynew == np.min(ynew))[0][0]
-        min_time = xnew[minimum] / (sampling_rate/1000)
-        # Only accept spikes if the interpolated minimum has shifted by
-        # less than 1/10th of a ms (3 samples for a 30kHz recording, 30
-        # samples after interpolation)
-        if np.abs(min_time - orig_min_time) <= 0.1:
-            # If minimum is too close to the end for a full snapshot then toss out spike
-            if minimum + after*10 < len(ynew) and minimum - before*10 >= 0:
-                slices_dejittered.append(ynew[minimum - before*10 : minimum + after*10])
-                spike_times_dejittered.append(spike_times[i])
-
-    return np.array(slices_dejittered), np.array(spike_times_dejittered)
+def _cut_snippets(slices, minima, idx, before, after):
+    '''Cuts the native-rate samples needed to interpolate the dejittered
+    window around each accepted minimum
+    '''
+    slices = np.asarray(slices)
+    start = minima[idx] - before*10
+    first = start // 10
+    offsets = start - first*10
+    width = before + after + 2
+    cols = np.minimum(first[:, None] + np.arange(width)[None, :],
+                      slices.shape[1] - 1)
+    return slices[idx[:, None], cols], offsets
+
+
+def compact_dejitter(slices, spike_times, spike_snapshot=[0.5, 1.0],
+                     sampling_rate=30000.0, dtype='float32'):
+    '''Aligns spike waveforms to minima like dejitter but returns native-rate
+    snippets and their sub-sample alignment instead of 10x upsampled
+    waveforms. upsample_waveforms(snippets, offsets, n_samples) reproduces
+    the output of dejitter, with n_samples = 10 * samples in spike_snapshot.
+
+    Parameters
+    ----------
+    dtype : {'float32', 'int16'}
+        storage type of snippets. int16 rounds to the nearest microvolt
+
+    Returns
+    -------
+    np.array : snippets, spike x (samples in snapshot + 2)
+    np.array : offsets, int8 alignment in 1/10 samples
+    np.array : spike_times
+    '''
+    accept, minima, before, after = _align_spikes(slices, spike_snapshot,
+                                                  sampling_rate)
+    idx = np.where(accept)[0]
+    snippets, offsets = _cut_snippets(slices, minima, idx, before, after)
+    if np.dtype(dtype) == np.int16:
+        snippets = np.clip(np.round(snippets), -32768, 32767)
+
+    return (snippets.astype(dtype), offsets.astype('int8'),
+            np.asarray(spike_times)[idx])
 
 
 def get_waveforms(el_trace, spike_times, snapshot = [0.5, 1.0],
@@ -61,3 +201,73 @@ def get_waveforms(el_trace, spike_times, snapshot = [0.5, 1.0],
     slices_dj, times_dj = dejitter(slices, spike_times, snapshot, sampling_rate)
 
     return slices_dj, sampling_rate*10
+
+
+def get_wavelet_coefficients(waves):
+    '''Returns all Haar wavelet coefficients of each waveform, a row for
+    each waveform
+    '''
+    coeffs = pywt.wavedec(waves, 'haar', axis=1)
+    return np.column_stack(coeffs)
+
+
+def get_normality_scores(data):
+    '''Returns the Kolmogorov-Smirnov statistic of each column of data
+    against a normal distribution with the column's mean and standard
+    deviation (the Lilliefors test statistic), computed on all columns at
+    once. Higher values are less normally distributed. Constant columns get
+    a statistic of 0.
+    '''
+    n = data.shape[0]
+    std = np.std(data, axis=0, ddof=1)
+    constant = ~(std > 0)
+    std[constant] = 1.0
+    z = (np.sort(data, axis=0) - np.mean(data, axis=0)) / std
+    cdf = norm.cdf(z)
+    ranks = np.arange(1, n+1)[:, None]
+    d_plus = np.max(ranks/n - cdf, axis=0)
+    d_minus = np.max(cdf - (ranks-1)/n, axis=0)
+    stats = np.maximum(d_plus, d_minus)
+    stats[constant] = 0.0
+    return stats
+
+
+def _get_lilliefors_table():
+    # statsmodels only exposes the lilliefors p-value table privately, as
+    # lilliefors_table_norm before 0.14 and get_lilliefors_table after
+    from statsmodels.stats import _lilliefors
+    if hasattr(_lilliefors, 'get_lilliefors_table'):
+        return _lilliefors.get_lilliefors_table(dist='norm')
+
+    return _lilliefors.lilliefors_table_norm
+
+
+def get_lilliefors_pvalues(data):
+    '''Returns the Lilliefors test p-value of every column of data, as
+    statsmodels.stats.diagnostic.lilliefors(column, dist='norm') does. The
+    p-values come from statsmodels' table, so they are clipped at 0.001.
+    Constant columns get NaN, as with lilliefors.
+    '''
+    stats = get_normality_scores(data)
+    table = _get_lilliefors_table()
+    n = data.shape[0]
+    p_vals = np.array([table.prob(d, n) for d in stats])
+    p_vals[stats == 0] = np.nan
+    return p_vals
+
+
+def rank_wavelet_coefficients(coeffs, constant_pval=np.nan):
+    '''Returns indices of wavelet coefficient columns ordered from least to
+    most normally distributed by Lilliefors p-value. Columns far from normal
+    all have a p-value of 0.001 and tie, and are ordered as np.argsort
+    orders them, the same as sorting lilliefors p-values column by column.
+
+    Parameters
+    ----------
+    coeffs : np.array, row for each waveform
+    constant_pval : float (optional)
+        p-value given to constant columns, default NaN (sorted last)
+    '''
+    p_vals = get_lilliefors_pvalues(coeffs)
+    p_vals[np.isnan(p_vals)] = constant_pval
+    return np.argsort(p_vals)
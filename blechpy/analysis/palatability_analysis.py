@@ -120,11 +120,12 @@ def palatability_identity_calculations(rec_dir, pal_ranks=None,
             idx = range(num_trials*i, num_trials*(i+1))
             palatability[:, :, idx] = row.palatability_rank * onesies
             identity[:, :, idx] = row.channel * onesies
+            spike_array = h5io.read_spike_array(trains_dig_in[i])
             for j, u in enumerate(chosen_units):
                 for k,t in enumerate(bin_times):
                     t_idx = np.where((time >= t) & (time <= t+win_size))[0]
                     unscaled_response[k, j, idx] = \
-                            np.mean(trains_dig_in[i].spike_array[:, u, t_idx],
+                            np.mean(spike_array[:, u, t_idx],
                                     axis=1)
                     try:
                         lasers[k, j, idx] = \
@@ -1,11 +1,15 @@
+import os
+import hashlib
 import numpy as np
 import pyBAKS
 import tables
-import pyBAKS
+from blechpy.dio import h5io
 from scipy.ndimage.filters import gaussian_filter1d
 from scipy.interpolate import interp1d
 from scipy.stats import mannwhitneyu, sem
-from joblib import Parallel, delayed
+from joblib import Parallel, delayed, effective_n_jobs
+from numba import njit
+from collections import OrderedDict
 
 def interpolate_waves(waves, fs, fs_new, axis=1):
     end_time = waves.shape[axis] / (fs/1000)
@@ -14,58 +18,83 @@ def interpolate_waves(waves, fs, fs_new, axis=1):
     f = interp1d(x, waves, axis=axis)
     return f(x_new)
 
-def make_single_trial_psth(spike_train, win_size, win_step, time=None):
-    '''Takes a spike train and returns firing rate trace in Hz
+def make_psths(spike_array, win_size, win_step, time=None,
+               smoothing_width=None):
+    '''Computes firing rate traces for every spike train in an N-D array at
+    once. The spikes in each window are found as differences of cumulative
+    sums along the time axis, so the cost does not grow with window size.
 
     Parameters
     ----------
-    spike_train : 1D numpy.array
-        spike train with 1s in bins with spikes and 0s elsewhere
+    spike_array : numpy.array
+        spike trains along the last axis (e.g. Trial x Unit x Time) with 1s
+        in bins with spikes and 0s elsewhere
     win_size : float, window size of psth in ms
     win_step : float, step size of psth in ms
     time : numpy.array (optional)
-        time array with times corresponding to bins in spike_train
-        if not provided then on is created starting at 0 and assuming 1ms bins
+        increasing time array with times corresponding to bins in
+        spike_array, if not provided then one is created starting at 0 and
+        assuming 1ms bins
+    smoothing_width : float (optional)
+        if provided, traces are smoothed with a gaussian filter with this
+        sigma (in psth bins)
 
     Returns
     -------
-    psth : numpy.array, firing rate vector with units of Hz
-    psth_time: numpy.array, time vector corresponding to the psth
+    psth : numpy.array
+        firing rates in Hz, same shape as spike_array except the last axis
+    psth_time : numpy.array, time vector corresponding to the psth
     '''
+    spike_array = np.asarray(spike_array)
     if time is None:
-        time = np.arange(0, len(spike_train), 1)  # assume 1ms bins
+        time = np.arange(0, spike_array.shape[-1], 1)  # assume 1ms bins
 
     psth_time = np.arange(np.min(time) + (win_size/2),
                           np.max(time) - (win_size/2),
                           win_step)
-    psth = np.zeros(psth_time.shape)
-    window = np.array([-win_size/2, win_size/2])
 
-    for i, t in enumerate(psth_time):
-        t_win = t + window
-        idx = np.where((time >= t_win[0]) & (time <= t_win[1]))[0]
-        psth[i] = np.sum(spike_train[idx]) / (win_size/1000.0)  # in Hz
+    # Bins in each window, time >= t - win_size/2 and time <= t + win_size/2
+    lo = np.searchsorted(time, psth_time - win_size/2, side='left')
+    hi = np.searchsorted(time, psth_time + win_size/2, side='right')
+    csum = np.zeros(spike_array.shape[:-1] + (spike_array.shape[-1] + 1,))
+    np.cumsum(spike_array, axis=-1, out=csum[..., 1:])
+    psth = (csum[..., hi] - csum[..., lo]) / (win_size/1000.0)  # in Hz
+    if smoothing_width is not None:
+        psth = gaussian_filter1d(psth, sigma=smoothing_width, axis=-1)
 
     return psth, psth_time
 
+
+def make_single_trial_psth(spike_train, win_size, win_step, time=None):
+    '''Takes a spike train and returns firing rate trace in Hz
+
+    Parameters
+    ----------
+    spike_train : 1D numpy.array
+        spike train with 1s in bins with spikes and 0s elsewhere
+    win_size : float, window size of psth in ms
+    win_step : float, step size of psth in ms
+    time : numpy.array (optional)
+        time array with times corresponding to bins in spike_train
+        if not provided then on is created starting at 0 and assuming 1ms bins
+
+    Returns
+    -------
+    psth : numpy.array, firing rate vector with units of Hz
+    psth_time: numpy.array, time vector corresponding to the psth
+    '''
+    return make_psths(spike_train, win_size, win_step, time=time)
+
 def make_mean_PSTHs(h5_file, win_size, win_step, dig_in_ch):
 
     with tables.open_file(h5_file, 'r') as hf5:
         spike_data = hf5.root.spike_trains['dig_in_%i' % dig_in_ch]
-        spike_array = spike_data.spike_array[:]
+        spike_array = h5io.read_spike_array(spike_data)
         time = spike_data.array_time[:]
 
-        psth_time = np.arange(np.min(time) - (win_size/2),
-                              np.max(time) + (win_size/2),
-                              win_step)
-        PSTHs = np.zeros((len(psth_time), spike_array.shape[1]))
-
-        for trial in spike_array:
-            for i, unit in enumerate(trial):
-                tmp, tmp_time = make_single_trial_psth(unit, win_size,
-                                                       win_step, time)
-                PSTHs[:, i] += tmp
-        PSTHs /= spike_array.shape[0]
+    # Time x Unit mean over trials
+    PSTHs, psth_time = make_psths(spike_array, win_size, win_step, time)
+    PSTHs = np.mean(PSTHs, axis=0).T
 
     return PSTHs, psth_time
 
@@ -73,26 +102,13 @@ def make_psths_for_tastant(h5_file, win_size, win_step, dig_in_ch, smoothing_wid
     dig_str = 'dig_in_%i' % dig_in_ch
     with tables.open_file(h5_file, 'r+') as hf5:
         spike_data = hf5.root.spike_trains[dig_str]
-        spike_array = spike_data.spike_array[:]
+        spike_array = h5io.read_spike_array(spike_data)
         time = spike_data.array_time[:]
 
-        psth_time = None
-        PSTHs = None
-
-        for ti, trial in enumerate(spike_array):
-            for ui, unit in enumerate(trial):
-                tmp, tmp_time = make_single_trial_psth(unit, win_size,
-                                                       win_step, time)
-                if psth_time is None:
-                    psth_time = tmp_time
-                    PSTHs = np.zeros((spike_array.shape[1],
-                                     spike_array.shape[0],
-                                     len(psth_time)))
-
-                # Smooth firing rate trace
-                tmp = gaussian_filter1d(tmp, sigma=smoothing_width)
-
-                PSTHs[ui, ti, :] = tmp
+        # Smoothed firing rate traces as Unit x Trial x Time
+        PSTHs, psth_time = make_psths(spike_array, win_size, win_step, time,
+                                      smoothing_width=smoothing_width)
+        PSTHs = np.swapaxes(PSTHs, 0, 1)
 
         if '/PSTHs' not in hf5:
             hf5.create_group('/', 'PSTHs')
@@ -108,72 +124,420 @@ def make_psths_for_tastant(h5_file, win_size, win_step, dig_in_ch, smoothing_wid
         hf5.flush()
 
     return PSTHs, psth_time
-#TODO: make_psths_for_tastant errors out when din is empty/has no activity
 
-def make_rate_arrays(h5_file, dinlist, mode='BAKS', output=False):
-    if mode == 'BAKS':
-        spike_arrays = []
-        dinidxs = []
-        with tables.open_file(h5_file, 'r') as hf5:
-            for i in dinlist:
-                dig_str = 'dig_in_%i' % i
-                spike_data = hf5.root.spike_trains[dig_str]
-                spike_array = spike_data.spike_array[:]
-                spike_array = np.swapaxes(spike_array, 0, 1)  # swap trials and units
-                spike_arrays.append(spike_array)
-                time = spike_data.array_time[:]
-                dinidx = np.ones(spike_array.shape[1]) * i
-                dinidxs.append(dinidx)
-            hf5.flush()
+def _baks_rates(spikes, time, dt):
+    # joblib passes large arrays as memmaps, which pyBAKS does not accept
+    spikes = np.asarray(spikes)
+    rates, _ = pyBAKS.optimize_alpha_MLE(spikes, time, dt=dt, output_df=False,
+                                         kind=np.ndarray, ndim=2)
+    return rates
+
+
+def _get_spike_fingerprint(hf5, dinlist, shapes):
+    '''Returns a hash of the spikes in the spike arrays of dinlist, read one
+    unit at a time
+    '''
+    h = hashlib.sha1()
+    for i in dinlist:
+        group = hf5.root.spike_trains['dig_in_%i' % i]
+        n_trials, n_units, n_time = shapes[i]
+        h.update(repr((i, [int(x) for x in shapes[i]])).encode())
+        for u in range(n_units):
+            trials, _, time_idx, _ = h5io.read_sparse_spike_array(group, u)
+            # Same hash whichever order the storage format lists spikes in
+            idx = np.sort(trials.astype('int64') * n_time + time_idx)
+            h.update(idx.tobytes())
+
+    return h.hexdigest()
+
+
+def _get_finished_rate_units(hf5, dinlist, shapes, time, dt, dtype,
+                             fingerprint):
+    '''Returns the number of units with rates already stored by a previous
+    run with the same parameters and spike arrays, 0 if there are none or
+    they don't match
+    '''
+    if '/Rates' not in hf5:
+        return 0
+
+    n_units = shapes[dinlist[0]][1]
+    attrs = hf5.root.Rates._v_attrs
+    if (getattr(attrs, 'baks_dt', None) != dt or
+        getattr(attrs, 'rate_dtype', None) != np.dtype(dtype).name or
+        getattr(attrs, 'spike_fingerprint', None) != fingerprint or
+        getattr(attrs, 'n_units', None) != n_units):
+        return 0
+
+    n_done = None
+    for i in dinlist:
+        dig_str = 'dig_in_%i' % i
+        if '/Rates/%s' % dig_str not in hf5:
+            return 0
+
+        st = hf5.root.Rates[dig_str]
+        rate_array = st['rate_array']
+        if (not isinstance(rate_array, tables.EArray) or
+            rate_array.shape[1:] != shapes[i][::2] or
+            not np.array_equal(st['time'][:], time)):
+            return 0
+
+        n_done = rate_array.nrows if n_done is None else min(n_done, rate_array.nrows)
+
+    if n_done > n_units:
+        return 0
+
+    # Drop units only stored for some tastants
+    for i in dinlist:
+        rate_array = hf5.root.Rates['dig_in_%i' % i]['rate_array']
+        if rate_array.nrows > n_done:
+            rate_array.truncate(n_done)
+
+    return n_done
+
+
+def make_rate_arrays(h5_file, dinlist, mode='BAKS', output=False, n_jobs=6,
+                     dt=0.001, dtype='float64', resume=False):
+    '''Computes firing rates for each unit with BAKS, fitting each unit on
+    its trials of all tastants, and stores them in /Rates/dig_in_#/rate_array
+    as Unit x Trial x Time arrays. Units are computed in batches and each
+    batch is appended to the arrays as it finishes, so only a few units are
+    held in memory at a time.
 
-        full_spike_array = np.concatenate((spike_arrays), axis=1)
-        del spike_array, spike_arrays
-        full_dinidx = np.concatenate((dinidxs))
-        full_dinidx = full_dinidx.astype(int)
-        #make array "rates" with the same shape as spike_array
-        results=Parallel(n_jobs=6)(
-            delayed(pyBAKS.optimize_alpha_MLE)(full_spike_array[i,:,:], time, dt=0.001, output_df=False, kind=np.ndarray, ndim=2) for i in range(full_spike_array.shape[0])) #TODO remove hard coded dt
-
-        rates = np.zeros(full_spike_array.shape)
-        del full_spike_array
-        i = 0
-        for tmp, _ in results:
-            rates[i,:,:] = tmp
-            i += 1
-        del results, tmp
-
-        with tables.open_file(h5_file, 'r+') as hf5:
+    Parameters
+    ----------
+    h5_file : str, path to hdf5 store
+    dinlist : list of int, digital inputs with spike arrays
+    mode : {'BAKS'}
+    output : bool (optional)
+        if True rates for all tastants (Unit x Trial x Time) and the time
+        vector are returned
+    n_jobs : int (optional), number of parallel BAKS jobs, default 6
+    dt : float (optional), BAKS time step in seconds, default 0.001
+    dtype : str (optional), 'float64' (default) or 'float32' for the rates
+    resume : bool (optional)
+        if True units already stored by an interrupted run with the same
+        parameters are kept and skipped, otherwise all rates are recomputed
+    '''
+    if mode != 'BAKS':
+        raise ValueError('additional modes not yet developed, please use BAKS')
+
+    dtype = np.dtype(dtype)
+    with tables.open_file(h5_file, 'r+') as hf5:
+        time = None
+        shapes = {}
+        for i in dinlist:
+            spike_data = hf5.root.spike_trains['dig_in_%i' % i]
+            time = spike_data.array_time[:]
+            if h5io.get_spike_array_storage(spike_data) == 'sparse':
+                shapes[i] = tuple(spike_data.spike_events._v_attrs.shape)
+            else:
+                shapes[i] = spike_data.spike_array.shape
+
+        n_units = shapes[dinlist[0]][1]
+        fingerprint = _get_spike_fingerprint(hf5, dinlist, shapes)
+        n_done = 0
+        if resume:
+            n_done = _get_finished_rate_units(hf5, dinlist, shapes, time, dt,
+                                              dtype, fingerprint)
+
+        if n_done == 0:
             if '/Rates' not in hf5:
                 hf5.create_group('/', 'Rates')
 
             for i in dinlist:
                 dig_str = 'dig_in_%i' % i
-
                 if '/Rates/%s' % dig_str in hf5:
                     hf5.remove_node('/Rates', dig_str, recursive=True)
 
-                idx = full_dinidx == int(i)
-                dinrates = rates[:, idx, :]
                 hf5.create_group('/Rates', dig_str)
                 hf5.create_array('/Rates/%s' % dig_str, 'time', time)
-                hf5.create_array('/Rates/%s' % dig_str, 'rate_array', dinrates)
+                n_trials, _, n_time = shapes[i]
+                hf5.create_earray('/Rates/%s' % dig_str, 'rate_array',
+                                  atom=tables.Atom.from_dtype(dtype),
+                                  shape=(0, n_trials, n_time),
+                                  expectedrows=n_units)
+
+            hf5.root.Rates._v_attrs.baks_dt = dt
+            hf5.root.Rates._v_attrs.rate_dtype = dtype.name
+            hf5.root.Rates._v_attrs.spike_fingerprint = fingerprint
+            hf5.root.Rates._v_attrs.n_units = n_units
             hf5.flush()
-    else:
-        raise ValueError('additional modes not yet developed, please use BAKS')
+        else:
+            print('Resuming rate arrays, %i of %i units already done'
+                  % (n_done, n_units))
+
+        batch_size = 2 * effective_n_jobs(n_jobs)
+        trial_splits = np.cumsum([shapes[i][0] for i in dinlist])[:-1]
+        with Parallel(n_jobs=n_jobs) as parallel:
+            for start in range(n_done, n_units, batch_size):
+                units = range(start, min(start + batch_size, n_units))
+                # Trial x Time spikes of each unit for all tastants
+                spikes = [np.concatenate([h5io.read_spike_array(hf5.root.spike_trains['dig_in_%i' % i], u)
+                                          for i in dinlist], axis=0)
+                          for u in units]
+                results = parallel(delayed(_baks_rates)(x, time, dt)
+                                   for x in spikes)
+                del spikes
+
+                for i, rates in zip(dinlist, zip(*[np.split(r, trial_splits)
+                                                   for r in results])):
+                    rate_array = hf5.root.Rates['dig_in_%i' % i]['rate_array']
+                    rate_array.append(np.array(rates, dtype=dtype))
+
+                hf5.flush()
+                print('Rates computed for %i of %i units' % (units[-1] + 1, n_units))
 
     if output:
+        with tables.open_file(h5_file, 'r') as hf5:
+            rates = np.concatenate([hf5.root.Rates['dig_in_%i' % i]['rate_array'][:]
+                                    for i in dinlist], axis=1)
+
         return rates, time
-    else:
-        del rates, time
+
+
+class RateCache(object):
+    '''Least recently used cache of firing rates computed by get_rates,
+    bounded by the memory the arrays take up. If cache_dir is given, rates
+    are also saved there as .npz files and reloaded in later sessions.
+    Entries are keyed by a hash of the spikes they were computed from and
+    the rate parameters, so rates are recomputed when spike arrays change.
+    '''
+
+    def __init__(self, max_bytes=256e6, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self._entries = OrderedDict()
+        self._nbytes = 0
+
+    def __getstate__(self):
+        # Don't pickle cached arrays
+        state = self.__dict__.copy()
+        state['_entries'] = OrderedDict()
+        state['_nbytes'] = 0
+        return state
+
+    def _file(self, key):
+        return os.path.join(self.cache_dir, 'rates_%s.npz' % key)
+
+    def _store(self, key, value):
+        if key in self._entries:
+            old = self._entries.pop(key)
+            self._nbytes -= sum(x.nbytes for x in old)
+
+        nbytes = sum(x.nbytes for x in value)
+        if nbytes > self.max_bytes:
+            return
+
+        self._entries[key] = value
+        self._nbytes += nbytes
+        while self._nbytes > self.max_bytes:
+            _, old = self._entries.popitem(last=False)
+            self._nbytes -= sum(x.nbytes for x in old)
+
+    def get(self, key):
+        '''Returns (rates, time) stored under key, or None if not cached
+        '''
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+        if self.cache_dir is not None and os.path.isfile(self._file(key)):
+            with np.load(self._file(key)) as dat:
+                value = (dat['rates'], dat['time'])
+
+            self._store(key, value)
+            return value
+
+        return None
+
+    def put(self, key, rates, time):
+        '''Stores rates and time under key, in memory and in cache_dir
+        '''
+        self._store(key, (rates, time))
+        if self.cache_dir is None:
+            return
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_file = self._file(key) + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, rates=rates, time=time)
+
+        os.replace(tmp_file, self._file(key))
+
+    def clear(self, disk=False):
+        '''Empties the in-memory cache, and the cache_dir if disk is True
+        '''
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        if disk and self.cache_dir is not None and os.path.isdir(self.cache_dir):
+            for fn in os.listdir(self.cache_dir):
+                if fn.startswith('rates_') and fn.endswith('.npz'):
+                    os.remove(os.path.join(self.cache_dir, fn))
+
+
+_rate_caches = {}
+
+
+def get_rate_cache(h5_file, cache_dir=None, max_bytes=256e6):
+    '''Returns the in-memory RateCache shared by get_rates calls on h5_file,
+    creating it if needed, and sets its on-disk location to cache_dir (None
+    caches in memory only)
+    '''
+    key = os.path.abspath(h5_file)
+    cache = _rate_caches.get(key)
+    if cache is None:
+        cache = RateCache(max_bytes=max_bytes)
+        _rate_caches[key] = cache
+
+    cache.cache_dir = cache_dir
+
+    return cache
+
+
+def _get_rate_key(spikes, time, method, params):
+    h = hashlib.sha1()
+    h.update(repr((spikes.shape, method, sorted(params.items()))).encode())
+    h.update(np.flatnonzero(spikes).astype('int64').tobytes())
+    h.update(np.asarray(time, dtype='float64').tobytes())
+    return h.hexdigest()
+
+
+def _compute_rates(spikes, time, method, params):
+    if method == 'psth':
+        return make_psths(spikes, params['window_size'], params['window_step'],
+                          time, smoothing_width=params['smoothing_width'])
+
+    if method == 'baks':
+        return _baks_rates(spikes, time, params['dt']), time
+
+    raise ValueError('method must be psth or baks, not %s' % method)
+
+
+def get_rates(h5_file, units=None, din=None, window=None, method='psth',
+              params=None, cache=None):
+    '''Computes firing rates from the spike arrays on demand rather than
+    reading the precomputed /PSTHs or /Rates arrays, so any window or rate
+    parameters can be used without regenerating arrays. Rates are computed
+    one unit at a time and kept in an LRU cache.
+
+    Parameters
+    ----------
+    h5_file : str, path to hdf5 store
+    units : str or int or list of str/int (optional)
+        unit names or unit numbers, default is all units
+    din : int or list of int (optional)
+        digital inputs, default is all with spike arrays
+    window : tuple (optional)
+        (start, end) in ms relative to stimulus onset, default is the whole
+        spike array
+    method : {'psth' (default), 'baks'}
+        psth computes smoothed windowed rates as make_psths_for_tastant,
+        baks fits BAKS to each unit's trials of all requested digital inputs
+        together, as make_rate_arrays does for all digital inputs
+    params : dict (optional)
+        psth: window_size (ms, default 250), window_step (ms, default 25)
+        and smoothing_width (psth bins or None, default 3)
+        baks: dt (s, default 0.001)
+    cache : RateCache (optional)
+        default is the in-memory cache returned by get_rate_cache(h5_file)
+
+    Returns
+    -------
+    time : numpy.array
+    rates : numpy.array
+        Unit x Trial x Time firing rates in Hz, unit axis dropped for a
+        single unit, or a dict of these keyed by digital input if there
+        are several
+    '''
+    defaults = {'psth': {'window_size': 250, 'window_step': 25,
+                         'smoothing_width': 3},
+                'baks': {'dt': 0.001}}
+    if method not in defaults:
+        raise ValueError('method must be psth or baks, not %s' % method)
+
+    params = {**defaults[method], **(params or {})}
+    if cache is None:
+        cache = get_rate_cache(h5_file)
+
+    single_unit = units is not None and not isinstance(units, list)
+    if units is None:
+        units = h5io.get_unit_names(None, h5_file=h5_file)
+    elif not isinstance(units, list):
+        units = [units]
+
+    unit_nums = [u if isinstance(u, (int, np.integer)) else h5io.parse_unit_number(u)
+                 for u in units]
+
+    with tables.open_file(h5_file, 'r') as hf5:
+        if din is None:
+            dins = [x._v_name for x in hf5.list_nodes('/spike_trains')]
+        elif isinstance(din, list):
+            dins = ['dig_in_%i' % x for x in din]
+        else:
+            dins = ['dig_in_%i' % din]
+
+        groups = [hf5.root.spike_trains[x] for x in dins]
+        time = groups[0]['array_time'][:]
+        for st in groups[1:]:
+            if not np.array_equal(time, st['array_time'][:]):
+                raise ValueError('Misaligned time vectors encountered')
+
+        if window is None:
+            window = (time[0], time[-1] + 1)
+
+        idx = np.where((time >= window[0]) & (time < window[1]))[0]
+        if len(idx) == 0:
+            raise ValueError('window %s is outside of spike arrays from %g '
+                             'to %g ms' % (window, time[0], time[-1]))
+
+        time = time[idx]
+        out = {x: [] for x in dins}
+        rate_time = None
+        for u in unit_nums:
+            spikes = [h5io.read_spike_array(st, u)[:, idx] for st in groups]
+            if method == 'baks':
+                # Fit on the trials of all digital inputs then split back up
+                trial_splits = np.cumsum([x.shape[0] for x in spikes])[:-1]
+                spikes = np.concatenate(spikes, axis=0)
+            else:
+                trial_splits = None
+
+            for dig_str, x in zip(dins, spikes if trial_splits is None else [spikes]):
+                key = _get_rate_key(x, time, method, params)
+                value = cache.get(key)
+                if value is None:
+                    value = _compute_rates(x, time, method, params)
+                    cache.put(key, *value)
+
+                rates, rate_time = value
+                if trial_splits is None:
+                    out[dig_str].append(rates)
+                    continue
+
+                for k, r in zip(dins, np.split(rates, trial_splits)):
+                    out[k].append(r)
+
+    for dig_str in dins:
+        out[dig_str] = np.array(out[dig_str])
+        if single_unit:
+            out[dig_str] = out[dig_str][0]
+
+    if len(out) == 1:
+        out = out.popitem()[1]
+
+    return rate_time, out
 
 
 def get_binned_firing_rate(time, spikes, bin_size=250, bin_step=25):
-    '''Take a spike array and returns a firing rate array (row-wise)
+    '''Take a spike array and returns a firing rate array (row-wise). Bins
+    are summed as differences of cumulative sums along the time axis.
 
     Parameters
     ----------
-    time :  numpy.array, time vector in ms
-    spikes : numpy.array, Trial x Time array with 1s at spike times
+    time :  numpy.array, increasing time vector in ms
+    spikes : numpy.array
+        Trial x Time array with 1s at spike times, or any N-D array with time
+        along the last axis (e.g. Trial x Unit x Time)
     bin_size: int (optional), bin width in ms, default=250
     bin_step : int (optional), step size in ms, default=25
 
@@ -183,17 +547,19 @@ def get_binned_firing_rate(time, spikes, bin_size=250, bin_step=25):
         time vector for binned firing rate array, times correspond to center of
         bins in ms
     firing_rate : numpy.array
-        Trial x Time firing rate array in Hz
+        Trial x Time firing rate array in Hz, same shape as spikes except the
+        last axis
     '''
+    spikes = np.asarray(spikes)
     bin_start = np.arange(time[0], time[-1] - bin_size + bin_step, bin_step)
     bin_time = bin_start + int(bin_size/2)
-    n_trials = spikes.shape[0]
-    n_bins = len(bin_start)
 
-    firing_rate = np.zeros((n_trials, n_bins))
-    for i, start in enumerate(bin_start):
-        idx = np.where((time >= start) & (time <= start+bin_size))[0]
-        firing_rate[:, i] = np.sum(spikes[:, idx], axis=1) / (bin_size/1000)
+    # Bins with time >= start and time <= start+bin_size
+    lo = np.searchsorted(time, bin_start, side='left')
+    hi = np.searchsorted(time, bin_start + bin_size, side='right')
+    csum = np.zeros(spikes.shape[:-1] + (spikes.shape[-1] + 1,))
+    np.cumsum(spikes, axis=-1, out=csum[..., 1:])
+    firing_rate = (csum[..., hi] - csum[..., lo]) / (bin_size/1000)
 
     return bin_time, firing_rate
 
@@ -279,6 +645,54 @@ def remove_baseline(time, fr):
     norm_fr = fr - baseline
     return norm_fr
 
+@njit(nogil=True, cache=True)
+def _correlogram_counts(X, Y, edges, exclude_self):
+    '''Histogram of X[i] - Y[j] over edges for sorted X and Y. Pairs in the
+    window are found with a two-pointer sweep so cost scales with the number
+    of pairs within max_t rather than len(X)*len(Y). If exclude_self, pairs
+    with i == j are skipped (for autocorrelograms).
+    '''
+    n_bins = len(edges) - 1
+    lo = edges[0]
+    hi = edges[-1]
+    binsize = edges[1] - edges[0]
+    counts = np.zeros(n_bins)
+    start = 0
+    for i in range(len(X)):
+        x = X[i]
+        # first Y with x - y <= hi
+        while start < len(Y) and x - Y[start] > hi:
+            start += 1
+
+        j = start
+        while j < len(Y) and x - Y[j] >= lo:
+            if exclude_self and i == j:
+                j += 1
+                continue
+
+            d = x - Y[j]
+            # same binning as np.histogram: last bin includes right edge
+            k = int((d - lo) / binsize)
+            if k >= n_bins:
+                k = n_bins - 1
+
+            if d < edges[k]:
+                k -= 1
+            elif k < n_bins - 1 and d >= edges[k+1]:
+                k += 1
+
+            counts[k] += 1
+            j += 1
+
+    return counts
+
+
+def _get_correlogram_bins(binsize, max_t):
+    bin_edges = np.arange(-max_t, max_t+1, binsize)
+    bin_centers = (bin_edges+binsize/2)[:-1]
+    return bin_edges, bin_centers
+
+
 def spike_time_xcorr(X, Y, binsize=1, max_t=20):
     '''Compute cross-correlation histogram for 2 sets of spike times
 
@@ -294,48 +708,148 @@ def spike_time_xcorr(X, Y, binsize=1, max_t=20):
     np.array, np.array
     counts, bin_centers
     '''
-    bin_edges = np.arange(-max_t, max_t+1, binsize)
-    bin_centers = (bin_edges+binsize/2)[:-1]
-
-    counts = np.zeros(bin_centers.shape)
-    for spike in X:
-        rel_t = spike - Y
-        counts += np.histogram(rel_t, bins=bin_edges)[0]
+    bin_edges, bin_centers = _get_correlogram_bins(binsize, max_t)
+    X = np.sort(np.asarray(X, dtype='float64'))
+    Y = np.sort(np.asarray(Y, dtype='float64'))
+    counts = _correlogram_counts(X, Y, bin_edges.astype('float64'), False)
 
     # convert to spikes/s and adjust for number of spikes 
     counts = counts / (len(X) * binsize)
     return counts, bin_centers, bin_edges
 
 def spike_time_acorr(X, binsize=1, max_t=20):
-    bin_edges = np.arange(-max_t, max_t+1, binsize)
-    bin_centers = (bin_edges+binsize/2)[:-1]
+    '''Compute autocorrelation histogram of spike times, excluding each
+    spike's pairing with itself
+
+    Parameters
+    ----------
+    X : np.array, 1-D array of spike times in ms
+    binsize: int (optional), size of bins to use in histogram in ms(defualt=1)
+    max_t: int (optional), max time bin for histogram in ms(default=20)
 
-    counts = np.zeros(bin_centers.shape)
-    for i, spike in enumerate(X):
-        Y = np.append(X[:i], X[i+1:-1])  # Exclude current spike
-        rel_t = spike - Y
-        counts += np.histogram(rel_t, bins=bin_edges)[0]
+    Returns
+    -------
+    np.array, np.array, np.array
+    counts, bin_centers, bin_edges
+    '''
+    bin_edges, bin_centers = _get_correlogram_bins(binsize, max_t)
+    X = np.sort(np.asarray(X, dtype='float64'))
+    counts = _correlogram_counts(X, X, bin_edges.astype('float64'), True)
 
     # convert to spikes/s and adjust for number of spikes 
     counts = counts / (len(X) * binsize)
     return counts, bin_centers, bin_edges
 
 
+def spike_time_correlograms(spike_times, binsize=1, max_t=20, n_jobs=1):
+    '''Computes all auto- and cross-correlograms for a set of units, e.g.
+    the clusters on one electrode. Spike times are sorted once per unit.
+
+    Parameters
+    ----------
+    spike_times : list of np.array
+        1-D arrays of spike times in ms, one per unit
+    binsize: int (optional), size of bins to use in histogram in ms(defualt=1)
+    max_t: int (optional), max time bin for histogram in ms(default=20)
+    n_jobs : int (optional)
+        number of threads to compute correlograms with, default 1
+
+    Returns
+    -------
+    np.array, np.array, np.array
+        counts with shape (n_units, n_units, n_bins), where [i, i] is the
+        autocorrelogram of unit i and [i, j] the cross-correlogram of unit i
+        vs unit j, bin_centers and bin_edges
+    '''
+    bin_edges, bin_centers = _get_correlogram_bins(binsize, max_t)
+    edges = bin_edges.astype('float64')
+    sorted_times = [np.sort(np.asarray(x, dtype='float64')) for x in spike_times]
+    n_units = len(sorted_times)
+    pairs = [(i, j) for i in range(n_units) for j in range(n_units)]
+
+    def get_counts(i, j):
+        X = sorted_times[i]
+        counts = _correlogram_counts(X, sorted_times[j], edges, i == j)
+        return counts / (len(X) * binsize)
+
+    # kernel releases the GIL so threads run in parallel
+    results = Parallel(n_jobs=n_jobs, backend='threading')(delayed(get_counts)(i, j)
+                                                           for i, j in pairs)
+    out = np.zeros((n_units, n_units, len(bin_centers)))
+    for (i, j), counts in zip(pairs, results):
+        out[i, j] = counts
+
+    return out, bin_centers, bin_edges
+
+
 def check_taste_response(time, spikes, win_size=1500):
-    pre_idx = np.where((time >= -win_size) & (time < 0))[0]
-    post_idx = np.where((time >= 0) & (time < win_size))[0]
-    pre = 1000 * np.sum(spikes[:, pre_idx], axis=1) / win_size
-    post = 1000 * np.sum(spikes[:, post_idx], axis=1) / win_size
-    try:
-        stat, pval = mannwhitneyu(pre, post, alternative='two-sided')
-    except ValueError:
-        pval = 1.0
-        stat = 0.0
+    '''Compares firing rates win_size ms before and after stimulus delivery
+    with a Mann-Whitney U test
+
+    Parameters
+    ----------
+    time : numpy.array, time vector in ms
+    spikes : numpy.array, Trial x Time array with 1s at spike times
+    win_size : int (optional), ms before and after stimulus, default=1500
+
+    Returns
+    -------
+    pval : float
+    stats : dict
+    '''
+    pvals, stats = check_taste_responses(time, spikes[:, None, :],
+                                         win_size=win_size)
+    stats = {k: tuple(x[0] for x in v) if isinstance(v, tuple) else v[0]
+             for k, v in stats.items()}
+    return pvals[0], stats
+
 
+def check_taste_responses(time, spikes, win_size=1500):
+    '''Batched check_taste_response, compares firing rates win_size ms before
+    and after stimulus delivery for all units at once
 
-    mean_delta = get_mean_difference(pre, post)
+    Parameters
+    ----------
+    time : numpy.array, time vector in ms
+    spikes : numpy.array, Trial x Unit x Time array with 1s at spike times
+    win_size : int (optional), ms before and after stimulus, default=1500
 
-    stats = {'u-stat': stat, 'p-val': pval, 'baseline': (np.mean(pre), sem(pre)),
-             'response': (np.mean(post), sem(post)), 'delta': mean_delta}
+    Returns
+    -------
+    pvals : numpy.array, p-value for each unit
+    stats : dict
+        same keys as check_taste_response with an array of values per unit
+    '''
+    pre_idx = np.where((time >= -win_size) & (time < 0))[0]
+    post_idx = np.where((time >= 0) & (time < win_size))[0]
+    # Unit x Trial rates
+    pre = 1000 * np.sum(spikes[:, :, pre_idx], axis=2).T / win_size
+    post = 1000 * np.sum(spikes[:, :, post_idx], axis=2).T / win_size
+    pre = np.ascontiguousarray(pre)
+    post = np.ascontiguousarray(post)
+    try:
+        stat, pval = mannwhitneyu(pre, post, alternative='two-sided', axis=1)
+    except (TypeError, ValueError):
+        # scipy < 1.7 has no axis argument and raises when all values of a
+        # unit are identical, so test units one at a time
+        stat = np.zeros(pre.shape[0])
+        pval = np.ones(pre.shape[0])
+        for i, (x, y) in enumerate(zip(pre, post)):
+            try:
+                stat[i], pval[i] = mannwhitneyu(x, y, alternative='two-sided')
+            except ValueError:
+                pass
+
+    # Difference of means, as get_mean_difference for each unit
+    n1 = pre.shape[1]
+    n2 = post.shape[1]
+    SEM = np.sqrt((np.power(np.std(pre, axis=1), 2)/n1) +
+                  (np.power(np.std(post, axis=1), 2)/n2)) / np.sqrt(n1+n2)
+    mean_delta = (np.mean(post, axis=1) - np.mean(pre, axis=1), SEM)
+
+    stats = {'u-stat': stat, 'p-val': pval,
+             'baseline': (np.mean(pre, axis=1), sem(pre, axis=1)),
+             'response': (np.mean(post, axis=1), sem(post, axis=1)),
+             'delta': mean_delta}
 
     return pval, stats
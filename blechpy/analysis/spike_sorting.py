@@ -4,7 +4,76 @@ import numpy as np
 from blechpy.dio import h5io
 from numba import jit
 import itertools
-    
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+def get_trial_spike_events(spike_times, trial_on, pre_idx, post_idx, fs):
+    '''Finds the spikes of a unit in each trial window and returns their
+    trial and time in ms relative to the start of the window. A window spans
+    from trial_on - pre_idx to trial_on + post_idx samples, inclusive.
+
+    Parameters
+    ----------
+    spike_times : np.array, spike times of the unit in samples
+    trial_on : np.array, trial onset indices in samples
+    pre_idx : int, samples before trial onset
+    post_idx : int, samples after trial onset
+    fs : float, sampling rate in Hz
+
+    Returns
+    -------
+    np.array, np.array
+        index into trial_on and ms from start of window for each spike
+    '''
+    spike_times = np.sort(np.asarray(spike_times).astype('int64'))
+    starts = np.asarray(trial_on).astype('int64') - pre_idx
+    ends = starts + pre_idx + post_idx
+    lo = np.searchsorted(spike_times, starts, side='left')
+    hi = np.searchsorted(spike_times, ends, side='right')
+    counts = hi - lo
+    trials = np.repeat(np.arange(len(starts)), counts)
+    # Index of each spike, the runs lo[i]:hi[i] laid end to end
+    run_starts = np.cumsum(counts) - counts
+    spike_idx = np.arange(counts.sum()) - np.repeat(run_starts - lo, counts)
+    ms = ((spike_times[spike_idx] - starts[trials]) / (fs/1000)).astype(int)
+    return trials, ms
+
+
+def match_laser_trials(trial_on, laser_off, max_offset):
+    '''Matches each trial to the first laser trial (in the order given) that
+    turns off within max_offset samples of the trial onset
+
+    Parameters
+    ----------
+    trial_on : np.array, trial onset indices
+    laser_off : np.array, laser offset indices
+    max_offset : int, max samples between trial onset and laser offset
+
+    Returns
+    -------
+    np.array
+        index into laser_off of the matching laser trial for each trial, -1
+        where there is no match
+    '''
+    trial_on = np.asarray(trial_on).astype('int64')
+    laser_off = np.asarray(laser_off).astype('int64')
+    order = np.argsort(laser_off, kind='stable')
+    sorted_off = laser_off[order]
+    lo = np.searchsorted(sorted_off, trial_on - max_offset, side='left')
+    hi = np.searchsorted(sorted_off, trial_on + max_offset, side='right')
+    match = np.full(len(trial_on), -1, dtype='int64')
+    found = hi > lo
+    if not np.any(found):
+        return match
+
+    # First laser trial in each window, the minimum original position over
+    # order[lo:hi]. A sentinel at the end lets hi equal len(laser_off).
+    positions = np.append(order, len(order))
+    bounds = np.ravel(np.column_stack((lo[found], hi[found])))
+    match[found] = np.minimum.reduceat(positions, bounds)[::2]
+    return match
+
+
 def make_spike_arrays(h5_file, params):
     '''Makes stimulus triggered spike array for all sorted units
 
@@ -18,6 +87,11 @@ def make_spike_arrays(h5_file, params):
             sampling_rate : float, sampling rate of data in Hz
             pre_stimulus: : int, ms before stimulus to include in array
             post_stimulus : int, ms after stimulus to include in array
+            storage : {'dense' (default), 'sparse'} (optional)
+                dense stores Trial x Unit x Time arrays, sparse stores
+                lists of spike events (see h5io.write_sparse_spike_array)
+                which take a fraction of the space. h5io.get_spike_data
+                reads either.
     '''
     print('\n----------\nMaking Unit Spike Arrays\n----------\n')
     dig_in_ch = params['dig_ins_to_use']
@@ -28,6 +102,9 @@ def make_spike_arrays(h5_file, params):
     pre_idx = int(pre_stim * (fs/1000))
     post_idx = int(post_stim * (fs/1000))
     n_pts = pre_stim + post_stim
+    storage = params.get('storage') or 'dense'
+    if storage not in ['dense', 'sparse']:
+        raise ValueError('storage must be dense or sparse, not %s' % storage)
 
     if dig_in_ch is None or dig_in_ch == []:
         raise ValueError('Must provide dig_ins_to_use in params in '
@@ -50,11 +127,15 @@ def make_spike_arrays(h5_file, params):
     with tables.open_file(h5_file, 'r+') as hf5:
         n_units = len(hf5.list_nodes('/sorted_units'))
 
+        # Read each unit's spike times once
+        unit_times = {int(unit._v_name[-3:]): unit.times[:]
+                      for unit in hf5.root.sorted_units}
+
         # Get experiment end time from last spike time in case headstage fell
         # off
         exp_end_idx = 0
-        for unit in hf5.root.sorted_units:
-            tmp = np.max(unit.times)
+        for times in unit_times.values():
+            tmp = np.max(times)
             if tmp > exp_end_idx:
                 exp_end_idx = tmp
 
@@ -82,68 +163,75 @@ def make_spike_arrays(h5_file, params):
             on_idx.sort()
             n_trials = len(on_idx)
 
-            # loop through trials and get spike train array for each
-            spike_train = []
             cond_array = np.zeros(n_trials)
             laser_start = np.zeros(n_trials)
             laser_single = np.zeros((n_trials, n_lasers))
 
-            for ti, trial_off in enumerate(on_idx):
-                if trial_off >= trial_cutoff_idx:
-                    cond_array[ti] = -1
+            # Trials too close to the end of the experiment are left out
+            cond_array[on_idx >= trial_cutoff_idx] = -1
+            trial_on = on_idx[on_idx < trial_cutoff_idx]
+
+            # Bin all trials of each unit at once
+            shape = (len(trial_on), n_units, n_pts)
+            if storage == 'dense':
+                spike_train = np.zeros(shape)
+
+            events = []
+            for unit_num in range(n_units):
+                times = unit_times.get(unit_num, np.array([], dtype='int64'))
+                trials, ms = get_trial_spike_events(times, trial_on, pre_idx,
+                                                    post_idx, fs)
+                # Drop spikes that come too late after adjustment
+                keep = ms < n_pts
+                trials = trials[keep]
+                ms = ms[keep]
+                if storage == 'dense':
+                    spike_train[trials, unit_num, ms] = 1
                     continue
 
-                window = (trial_off - pre_idx, trial_off + post_idx)
-                spike_shift = pre_idx - trial_off
-                spike_array = np.zeros((n_units, n_pts))
-
-                # loop through units
-                for unit in hf5.root.sorted_units:
-                    unit_num = int(unit._v_name[-3:])
-                    spike_idx = np.where((unit.times[:] >= window[0]) &
-                                         (unit.times[:] <= window[1]))[0]
-                    spike_times = unit.times[spike_idx]
-
-                    # Shift to align to trial window and convert to ms
-                    spike_times = (spike_times + spike_shift) / (fs/1000)
-                    spike_times = spike_times.astype(int)
-
-                    #Drop spikes that come too late after adjustment
-                    spike_times = [x for x in spike_times if x < n_pts]
-                    spike_array[unit_num, spike_times] = 1
-
-                spike_train.append(spike_array)
-
-                if lasers:
-                    # figure out which laser trial matches with this dig_in
-                    # trial and get the duration and onset lag
-                    for li, l in enumerate(laser_ch):
-                        tmp_trial = laser_table.query('abs(off_index - '
-                                                      '@trial_off) <= '
-                                                      '@post_idx')
-                        if not tmp_trial.empty:
-                            # Mark which laser was on
-                            laser_single[ti, li] = 1.0
-
-                            # Get duration of laser
-                            duration = (tmp_trial['off_index'] -
-                                        tmp_trial['on_index']) / (fs/1000)
-                            # round duration down to nearest multiple of 10ms
-                            cond_array[ti] = 10*int(duration.iloc[0]/10)
-
-                            # Get onset lag of laser, time between laser start
-                            # and end of the trial
-                            lag = (tmp_trial['on_index'] -
-                                   trial_off) / (fs/1000)
-                            # Round lag down to nearest multiple of 10ms
-                            laser_start[ti] = 10*int(lag.iloc[0]/10)
+                # Events come sorted by trial and time, keep one per ms
+                new = np.ones(len(ms), dtype=bool)
+                new[1:] = (np.diff(trials) != 0) | (np.diff(ms) != 0)
+                events.append((trials[new], ms[new]))
+
+            if lasers:
+                # figure out which laser trial matches with each dig_in
+                # trial and get the duration and onset lag
+                laser_on = np.array(laser_table['on_index'])
+                laser_off = np.array(laser_table['off_index'])
+                valid = np.where(on_idx < trial_cutoff_idx)[0]
+                match = match_laser_trials(trial_on, laser_off, post_idx)
+                ti = valid[match >= 0]
+                match = match[match >= 0]
+
+                # Mark which laser was on
+                laser_single[ti, :] = 1.0
+
+                # Get duration of laser, rounded down to nearest multiple of
+                # 10ms
+                duration = (laser_off[match] - laser_on[match]) / (fs/1000)
+                cond_array[ti] = 10*np.trunc(duration/10)
+
+                # Get onset lag of laser, time between laser start and end of
+                # the trial, rounded down to nearest multiple of 10ms
+                lag = (laser_on[match] - on_idx[ti]) / (fs/1000)
+                laser_start[ti] = 10*np.trunc(lag/10)
 
             array_time = np.arange(-pre_stim, post_stim, 1)  # time array in ms
             hf5.create_group('/spike_trains', 'dig_in_%i' % i)
             time = hf5.create_array('/spike_trains/dig_in_%i' % i,
                                     'array_time', array_time)
-            tmp = hf5.create_array('/spike_trains/dig_in_%i' % i,
-                                   'spike_array', np.array(spike_train))
+            if storage == 'dense':
+                h5io.write_spike_array(hf5, '/spike_trains/dig_in_%i' % i,
+                                       spike_train)
+            else:
+                unit_ptr = np.cumsum([0] + [len(x[0]) for x in events])
+                h5io.write_sparse_spike_array(
+                    hf5, '/spike_trains/dig_in_%i' % i,
+                    np.concatenate([x[0] for x in events]),
+                    np.concatenate([x[1] for x in events]),
+                    unit_ptr, shape)
+
             hf5.flush()
 
             if lasers:
@@ -157,7 +245,27 @@ def make_spike_arrays(h5_file, params):
     print('Done with spike array creation!\n----------\n')
 
 
-@jit(nogil=True)
+@jit(nopython=True, nogil=True)
+def _count_similar_sorted(unit1_times, unit2_times):
+    '''Two-pointer count of spikes in sorted unit1_times within 1ms of a
+    spike in sorted unit2_times, O(N1 + N2)
+    '''
+    unit_counter = 0
+    j = 0
+    n2 = len(unit2_times)
+    for t1 in unit1_times:
+        # skip unit2 spikes more than 1ms before t1, they can't match any
+        # later spike of unit1 either
+        while j < n2 and t1 - unit2_times[j] > 1.0:
+            j += 1
+
+        if j < n2 and np.abs(unit2_times[j] - t1) <= 1.0:
+            unit_counter += 1
+
+    return unit_counter
+
+
+@jit(nopython=True, nogil=True)
 def count_similar_spikes(unit1_times, unit2_times):
     '''Compiled function to compute the number of spikes in unit1 that are
     within 1ms of a spike in unit2
@@ -171,17 +279,11 @@ def count_similar_spikes(unit1_times, unit2_times):
     -------
     int : number of spikes in unit1 within 1ms of a spike in unit2
     '''
-    unit_counter = 0
-    for t1 in unit1_times:
-        diff_arr = np.abs(unit2_times - t1)
-        if np.where(diff_arr <= 1.0)[0].size > 0:
-            unit_counter += 1
-
-    return unit_counter
+    return _count_similar_sorted(np.sort(unit1_times), np.sort(unit2_times))
 
 
 def calc_units_similarity(h5_file, fs, similarity_cutoff=50,
-                          violation_file=None):
+                          violation_file=None, n_jobs=1, callback=None):
     '''Creates an ixj similarity matrix with values being the percentage of
     spike in unit i within 1ms of spikes in unit j, and add it to the HDF5
     store
@@ -198,6 +300,11 @@ def calc_units_similarity(h5_file, fs, similarity_cutoff=50,
     violation_file : str (optional)
         full path to text file to write violations in default is
         unit_similarity_violations.txt saved in the same directory as the hf5
+    n_jobs : int (optional)
+        number of threads used to compute rows of the matrix, default 1
+    callback : function (optional)
+        called with the unit name each time a unit's row of the matrix is
+        done, e.g. to update a progress bar
 
     Returns
     -------
@@ -211,27 +318,37 @@ def calc_units_similarity(h5_file, fs, similarity_cutoff=50,
                                       'unit_similarity_violations.txt')
 
     with tables.open_file(h5_file, 'r+') as hf5:
+        # Read and sort each unit's spike times once
         units = hf5.list_nodes('/sorted_units')
+        unit_names = [u._v_name for u in units]
+        unit_nums = [h5io.parse_unit_number(x) for x in unit_names]
+        unit_times = [np.sort(u.times[:] / (fs/1000.0)) for u in units]
         unit_distances = np.zeros((len(units),
                                   len(units)))
 
-        for pair in itertools.product(units, repeat=2):
-            u1 = pair[0]
-            u2 = pair[1]
-            u1_idx = h5io.parse_unit_number(u1._v_name)
-            u2_idx = h5io.parse_unit_number(u2._v_name)
-            print('Computing similarity between Unit %i and Unit %i' %
-                  (u1_idx, u2_idx))
-            n_spikes = len(u1.times[:])
-            u1_times = u1.times[:] / (fs/1000.0)
-            u2_times = u2.times[:] / (fs/1000.0)
-            n_similar = count_similar_spikes(u1_times, u2_times)
-            tmp_dist = 100.0 * float(n_similar/n_spikes)
-            unit_distances[u1_idx, u2_idx] = tmp_dist
-
-            if u1_idx != u2_idx and tmp_dist >= similarity_cutoff:
+        def get_row(i):
+            u1_times = unit_times[i]
+            n_spikes = len(u1_times)
+            row = np.zeros((len(units),))
+            for j, u2_times in enumerate(unit_times):
+                n_similar = _count_similar_sorted(u1_times, u2_times)
+                row[unit_nums[j]] = 100.0 * float(n_similar/n_spikes)
+
+            return i, row
+
+        with ThreadPoolExecutor(max_workers=max(1, n_jobs)) as pool:
+            futures = [pool.submit(get_row, i) for i in range(len(units))]
+            for future in as_completed(futures):
+                i, row = future.result()
+                unit_distances[unit_nums[i]] = row
+                if callback is not None:
+                    callback(unit_names[i])
+
+        for i, j in itertools.product(range(len(units)), repeat=2):
+            tmp_dist = unit_distances[unit_nums[i], unit_nums[j]]
+            if i != j and tmp_dist >= similarity_cutoff:
                 violations += 1
-                violation_pairs.append((u1._v_name, u2._v_name))
+                violation_pairs.append((unit_names[i], unit_names[j]))
 
         print('\nSimilarity calculation done!')
         if '/unit_distances' in hf5:
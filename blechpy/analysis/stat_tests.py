@@ -1,6 +1,7 @@
 import numpy as np
+import pandas as pd
 from blechpy import dio
-from scipy.stats import mannwhitneyu, sem
+from blechpy.analysis import spike_analysis as sas
 
 
 def check_taste_response(rec_dir, unit_name, din, win_size=1500):
@@ -17,20 +18,62 @@ def check_taste_response(rec_dir, unit_name, din, win_size=1500):
 
     time, spikes = dio.h5io.get_spike_data(rec_dir, unit_num, din)
 
-    pre_idx = np.where((time >= -win_size) & (time < 0))[0]
-    post_idx = np.where((time >= 0) & (time < win_size))[0]
-    pre = 1000 * np.sum(spikes[:, pre_idx], axis=1) / win_size
-    post = 1000 * np.sum(spikes[:, post_idx], axis=1) / win_size
-    try:
-        stat, pval = mannwhitneyu(pre, post, alternative='two-sided')
-    except ValueError:
-        pval = 1.0
-        stat = 0.0
+    return sas.check_taste_response(time, spikes, win_size=win_size)
 
 
-    mean_delta = get_mean_difference(pre, post)
+def check_taste_responses(rec_dir, units=None, din=None, win_size=1500):
+    '''Tests all units for a response to each tastant at once, see
+    spike_analysis.check_taste_responses
 
-    stats = {'u-stat': stat, 'p-val': pval, 'baseline': (np.mean(pre), sem(pre)),
-             'response': (np.mean(post), sem(post)), 'delta': mean_delta}
+    Parameters
+    ----------
+    rec_dir : str, path to recording directory
+    units : list of str or int (optional), default is all units
+    din : int or list of int (optional), default is all digital inputs with
+        spike arrays
+    win_size : int (optional), ms before and after stimulus, default=1500
 
-    return pval, stats
+    Returns
+    -------
+    pandas.DataFrame
+        with columns unit, din, u-stat, p-val, baseline, baseline_sem,
+        response, response_sem, delta, delta_sem
+    '''
+    if units is None:
+        units = dio.h5io.get_unit_names(rec_dir)
+    elif not isinstance(units, list):
+        units = [units]
+
+    if din is None:
+        din = [int(x.replace('dig_in_', ''))
+               for x in dio.h5io.get_spike_train_names(rec_dir)]
+    elif not isinstance(din, list):
+        din = [din]
+
+    unit_names = ['unit%03i' % u if isinstance(u, int) else u for u in units]
+    time, spike_data = dio.h5io.get_spike_data(rec_dir, units=list(units),
+                                               din=din)
+    if not isinstance(spike_data, dict):
+        # a single digital input is returned as just its array
+        spike_data = {'dig_in_%i' % din[0]: spike_data}
+
+    out = []
+    for din_str, spikes in spike_data.items():
+        if spikes.ndim == 2:
+            spikes = spikes[:, None, :]
+
+        pvals, stats = sas.check_taste_responses(time, spikes,
+                                                 win_size=win_size)
+        df = pd.DataFrame({'unit': unit_names,
+                           'din': int(din_str.replace('dig_in_', '')),
+                           'u-stat': stats['u-stat'],
+                           'p-val': pvals,
+                           'baseline': stats['baseline'][0],
+                           'baseline_sem': stats['baseline'][1],
+                           'response': stats['response'][0],
+                           'response_sem': stats['response'][1],
+                           'delta': stats['delta'][0],
+                           'delta_sem': stats['delta'][1]})
+        out.append(df)
+
+    return pd.concat(out, ignore_index=True)
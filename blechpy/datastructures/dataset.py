@@ -834,7 +834,8 @@ class dataset(data_object):
         return results
 
     @Logger('Running Blech Clust')
-    def blech_clust_run(self, data_quality=None, multi_process=True, n_cores=None, umap=True):
+    def blech_clust_run(self, data_quality=None, multi_process=True, n_cores=None, umap=True,
+                        memory_budget=None):
         '''Write clustering parameters to file and
         Run blech_process on each electrode using GNU parallel
 
@@ -847,6 +848,10 @@ class dataset(data_object):
         accept_params : bool, False (default)
             set to True in order to skip popup confirmation of parameters when
             running
+        memory_budget : float (optional)
+            memory budget per worker in GB, pooled across workers to limit
+            how many large electrodes are clustered at once (see
+            blech_clustering.schedule_clustering)
         '''
         if self.process_status['spike_detection'] == False:
             raise FileNotFoundError('Must run spike detection before clustering.')
@@ -886,9 +891,8 @@ class dataset(data_object):
             if n_cores is None or n_cores > cpu_count():
                 n_cores = cpu_count() - 1
 
-            results = Parallel(n_jobs=n_cores, verbose=10)(delayed(run_joblib_process)
-                                                          (co) for co in clust_objs)
-
+            results = clust.schedule_clustering(clust_objs, n_cores,
+                                                memory_budget=memory_budget)
 
         else:
             results = []
@@ -943,20 +947,27 @@ class dataset(data_object):
         self.process_status['sort_units'] = True
 
     @Logger('Calculating Units Similarity')
-    def units_similarity(self, similarity_cutoff=50, shell=False):
+    def units_similarity(self, similarity_cutoff=50, shell=False, n_cores=None):
         if 'SSH_CONNECTION' in os.environ:
             shell= True
 
+        if n_cores is None or n_cores > cpu_count():
+            n_cores = cpu_count() - 1
+
         metrics_dir = os.path.join(self.root_dir, 'sorted_unit_metrics')
         if not os.path.isdir(metrics_dir):
             raise ValueError('No sorted unit metrics found. Must sort units before calculating similarity')
 
         violation_file = os.path.join(metrics_dir,
                                       'units_similarity_violations.txt')
-        violations, sim = ss.calc_units_similarity(self.h5_file,
-                                                   self.sampling_rate,
-                                                   similarity_cutoff,
-                                                   violation_file)
+        n_units = len(dio.h5io.get_unit_names(self.root_dir, h5_file=self.h5_file))
+        with tqdm(total=n_units) as pbar:
+            violations, sim = ss.calc_units_similarity(self.h5_file,
+                                                       self.sampling_rate,
+                                                       similarity_cutoff,
+                                                       violation_file,
+                                                       n_jobs=max(1, n_cores),
+                                                       callback=lambda x: pbar.update())
         if len(violations) == 0:
             userIO.tell_user('No similarity violations found!', shell=shell)
             self.process_status['units_similarity'] = True
@@ -1050,9 +1061,19 @@ class dataset(data_object):
         self.process_status['make_psth_arrays'] = True
         self.save()
 
-    def make_rate_arrays(self, overwrite=True):
+    def make_rate_arrays(self, overwrite=True, n_jobs=6, dt=0.001,
+                         dtype='float64'):
         '''
         Make firing rate arrays for each unit and store in hdf5 store
+
+        Parameters
+        ----------
+        overwrite : bool (optional)
+            if True (default) all rates are recomputed. If False and a
+            previous run was interrupted, units already done are skipped
+        n_jobs : int (optional), number of parallel BAKS jobs, default 6
+        dt : float (optional), BAKS time step in seconds, default 0.001
+        dtype : str (optional), 'float64' (default) or 'float32' for rates
         '''
         #check if self.rate_arrays exists
         #if not, create it
@@ -1063,13 +1084,53 @@ class dataset(data_object):
             params = self.psth_params
             dig_ins = self.dig_in_mapping.query('spike_array == True')
             dinlist = dig_ins.channel.to_list()
-            spike_analysis.make_rate_arrays(self.h5_file, dinlist)
+            spike_analysis.make_rate_arrays(self.h5_file, dinlist,
+                                            n_jobs=n_jobs, dt=dt, dtype=dtype,
+                                            resume=not overwrite)
 
             self.process_status['make_rate_arrays'] = True
             self.save()
         else:
             print('Rate arrays already exist, new rate arrays not created')
 
+    def get_rates(self, units=None, din=None, window=None, method='psth',
+                  params=None, disk_cache=False):
+        '''Computes firing rates from the spike arrays on demand, see
+        spike_analysis.get_rates. Rates are cached in memory, and in
+        root_dir/rate_cache if disk_cache is True, so repeated queries with
+        the same parameters are not recomputed.
+
+        Parameters
+        ----------
+        units : str or int or list of str/int (optional), default all units
+        din : int or list of int (optional), default all with spike arrays
+        window : tuple (optional)
+            (start, end) in ms relative to stimulus onset, default is the
+            whole spike array
+        method : {'psth' (default), 'baks'}
+        params : dict (optional)
+            rate parameters, psth window_size and window_step default to
+            psth_params
+        disk_cache : bool (optional), also cache rates on disk
+
+        Returns
+        -------
+        time : numpy.array
+        rates : numpy.array or dict of numpy.array
+            Unit x Trial x Time firing rates, keyed by digital input if
+            there are several
+        '''
+        if method == 'psth':
+            params = {'window_size': self.psth_params['window_size'],
+                      'window_step': self.psth_params['window_step'],
+                      **(params or {})}
+
+        cache_dir = os.path.join(self.root_dir, 'rate_cache') if disk_cache else None
+        cache = spike_analysis.get_rate_cache(self.h5_file, cache_dir=cache_dir)
+        return spike_analysis.get_rates(self.h5_file, units=units, din=din,
+                                        window=window, method=method,
+                                        params=params, cache=cache)
+
 
     def make_psth_plots(self, sd = True, save_prefix = None):
         unit_table = self.get_unit_table()
@@ -1367,7 +1428,7 @@ class dataset(data_object):
 
         for i in range(loops):
             if i < len(taste_dig_in):
-                spike_arrs[i] = taste_dig_in[i].spike_array[:]
+                spike_arrs[i] = dio.h5io.read_spike_array(taste_dig_in[i])
 
         nameparts = str.split(self.tbla_name, '_')
         tbl['ID'] = nameparts[0]
@@ -1402,7 +1463,7 @@ class dataset(data_object):
 
         for i in range(loops):
             if i < len(taste_dig_in):
-                spike_arrs[i] = taste_dig_in[i].spike_array[:]
+                spike_arrs[i] = dio.h5io.read_spike_array(taste_dig_in[i])
 
         h5.flush()
         h5.close()
@@ -1452,27 +1513,37 @@ class dataset(data_object):
         h5 = tables.open_file(h5_file, mode='r+')
         for unit in h5.root.sorted_units:
             unm = unit._v_name
+            # compact units store snippets and alignment instead of waveforms
+            wave_arrays = [x for x in ['waveforms', 'snippets', 'alignment']
+                           if x in h5.root.sorted_units[unm]]
             for bidx in badidxs:
                 times = h5.root.sorted_units[unm].times[:]
-                waves = h5.root.sorted_units[unm].waveforms[:]
                 t = times[(times > bidx - 30) & (times < bidx + 30)]
                 if len(t) > 0:
                     idx = np.where(times == t)
                     idx = idx[0][0]
                     print(len(h5.root.sorted_units[unm].times[:]))
                     newtimes = np.delete(times, idx)
-                    newwaveforms = np.delete(waves, idx, 0)
                     h5.remove_node(h5.root.sorted_units[unm].times)
                     h5.create_array(h5.root.sorted_units[unm], "times", newtimes)
-                    h5.remove_node(h5.root.sorted_units[unm].waveforms)
-                    h5.create_array(h5.root.sorted_units[unm], "waveforms", newwaveforms)
+                    for arr in wave_arrays:
+                        data = getattr(h5.root.sorted_units[unm], arr)[:]
+                        h5.remove_node(h5.root.sorted_units[unm], arr)
+                        h5.create_array(h5.root.sorted_units[unm], arr,
+                                        np.delete(data, idx, 0))
 
         # fixing the spike arrays
         h5 = tables.open_file(h5_file, mode='r+')
-        new_array = h5.root.spike_trains.dig_in_1.spike_array[:]
+        spike_trains = h5.root.spike_trains.dig_in_1
+        storage = dio.h5io.get_spike_array_storage(spike_trains)
+        new_array = dio.h5io.read_spike_array(spike_trains)
         new_array[:, :, 2000] = 0
-        h5.remove_node(h5.root.spike_trains.dig_in_1.spike_array)
-        h5.create_array(h5.root.spike_trains.dig_in_1, "spike_array", new_array)
+        if storage == 'sparse':
+            h5.remove_node(spike_trains, 'spike_events', recursive=True)
+        else:
+            h5.remove_node(spike_trains.spike_array)
+
+        dio.h5io.write_spike_array(h5, spike_trains, new_array, storage=storage)
 
         h5.flush()
         h5.close()
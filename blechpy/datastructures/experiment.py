@@ -157,7 +157,7 @@ class experiment(data_object):
                     
         self.taste_map = taste_map
 
-    def add_recording(self, new_dir=None, shell=None):
+    def add_recording(self, new_dir=None, shell=None, update_clustering=False):
         '''Add recording directory to experiment
 
         Parameters
@@ -168,6 +168,11 @@ class experiment(data_object):
             True for command-line interface for user input
             False (default) for GUI
             If not passed then the preference set upon object creation is used
+        update_clustering : bool (optional)
+            if True, spikes of the new recording are assigned to the existing
+            clustering solutions with update_clustering instead of requiring
+            a full re-run of cluster_spikes. Spike detection must already be
+            done on the new recording.
         '''
         if 'SSH_CONNECTION' in os.environ:
             shell = True
@@ -197,8 +202,99 @@ class experiment(data_object):
         self.rec_labels[label] = new_dir
         self._order_dirs(shell=shell)
         self._setup_taste_map()
-        print('Added recording: %s')
+        print('Added recording: %s' % new_dir)
         self.save()
+        if update_clustering:
+            self.update_clustering()
+
+    def update_clustering(self, electrodes=None, max_outlier_fraction=0.05,
+                          refit=False):
+        '''Incrementally adds recordings to existing multi-recording
+        clustering. Spikes from recordings not yet in an electrode's
+        clustering are projected into the fitted feature space and assigned
+        with the stored GMM solutions. Electrodes where the new data fits
+        poorly are reported and can be re-clustered from scratch.
+
+        Parameters
+        ----------
+        electrodes : list of int (optional)
+            electrodes to update, default is all clustered electrodes
+        max_outlier_fraction : float (optional)
+            fraction of new spikes allowed outside the 99% ellipsoid of their
+            assigned cluster before an electrode is flagged for refitting
+        refit : bool (optional)
+            if True, flagged electrodes are re-clustered on all recordings
+
+        Returns
+        -------
+        list of int
+            electrodes flagged for a full refit
+        '''
+        rec_dirs = list(self.rec_labels.values())
+        if electrodes is None:
+            em = self.electrode_mapping
+            if 'dead' in em.columns:
+                electrodes = em.Electrode[em['dead'] == False].tolist()
+            else:
+                electrodes = em.Electrode.tolist()
+
+        clustering_params = load_dataset(rec_dirs[0]).clustering_params
+        flagged = []
+        failed = []
+        clusts = {}
+        for el in tqdm(electrodes):
+            out_dir = self._get_clustering_dir(el)
+            if out_dir is None:
+                continue
+
+            try:
+                clust = bclust.BlechClust(rec_dirs, el, out_dir=out_dir,
+                                          params=clustering_params,
+                                          incremental=True)
+                if not clust.clustered:
+                    continue
+
+                res = clust.update_clusters(max_outlier_fraction=max_outlier_fraction)
+            except Exception as e:
+                print('Could not update electrode %i: %s' % (el, e))
+                failed.append(el)
+                continue
+
+            if res['refit_needed']:
+                flagged.append(el)
+                clusts[el] = clust
+
+        print('Electrodes needing a full re-clustering: %s' % flagged)
+        if len(failed) > 0:
+            print('Electrodes that could not be updated: %s' % failed)
+
+        if refit and len(flagged) > 0:
+            for el in flagged:
+                # Re-cluster with the features the electrode was clustered with
+                clust = bclust.BlechClust(rec_dirs, el, out_dir=clusts[el].out_dir,
+                                          overwrite=True,
+                                          params=clustering_params,
+                                          data_transform=clusts[el]._data_transform,
+                                          n_pc=clusts[el]._n_pc)
+                clust.run()
+
+        return flagged
+
+    def _get_clustering_dir(self, electrode):
+        '''Returns the existing multi-recording BlechClust directory of an
+        electrode, looked up from the parent directories of the recordings
+        since the first recording can change when recordings are added or
+        reordered. None if the electrode has not been clustered.
+        '''
+        tops = [os.path.dirname(x) for x in self.rec_labels.values()]
+        tops.append(self.root_dir)
+        for top in dict.fromkeys(tops):
+            out_dir = os.path.join(top, 'BlechClust', 'electrode_%i' % electrode)
+            if os.path.isfile(os.path.join(out_dir, 'clustering_results',
+                                           'rec_key.json')):
+                return out_dir
+
+        return None
 
     def remove_recording(self, rec_dir=None, shell=None):
         '''Remove recording directory from experiment
@@ -345,7 +441,8 @@ class experiment(data_object):
 
     @Logger('Running Spike Clustering')
     def cluster_spikes(self, data_quality=None, multi_process=True,
-                       n_cores=None, custom_params=None, umap=False):
+                       n_cores=None, custom_params=None, umap=False,
+                       memory_budget=None):
         '''Write clustering parameters to file and
         Run blech_process on each electrode using GNU parallel
 
@@ -358,6 +455,10 @@ class experiment(data_object):
         accept_params : bool, False (default)
             set to True in order to skip popup confirmation of parameters when
             running
+        memory_budget : float (optional)
+            memory budget per worker in GB, pooled across workers to limit
+            how many large electrodes are clustered at once (see
+            blech_clustering.schedule_clustering)
         '''
         clustering_params = None
         if custom_params:
@@ -421,12 +522,9 @@ class experiment(data_object):
             if n_cores is None or n_cores > multiprocessing.cpu_count():
                 n_cores = multiprocessing.cpu_count() - 1
 
-            pool = multiprocessing.get_context('spawn').Pool(n_cores)
-            for x in clust_objs:
-                pool.apply_async(x.run, callback=update_pbar)
-
-            pool.close()
-            pool.join()
+            bclust.schedule_clustering(clust_objs, n_cores,
+                                       memory_budget=memory_budget,
+                                       callback=update_pbar)
         else:
             for x in clust_objs:
                 res = x.run()
@@ -243,12 +243,14 @@ class project(data_object):
                 dat = load_dataset(row['rec_dir'])
                 dat.make_split_psth_plots()
 
-    def make_rate_arrays(self, overwrite=True, parallel=False, n_jobs=-1):
+    def make_rate_arrays(self, overwrite=True, parallel=False, n_jobs=-1,
+                         baks_jobs=6, dt=0.001, dtype='float64'):
         rec_info = self.rec_info
         def run_make_rate_arrays(rec_dir):
             print("Making rate arrays for %s" % rec_dir)
             dat = load_dataset(rec_dir)
-            dat.make_rate_arrays(overwrite)
+            dat.make_rate_arrays(overwrite, n_jobs=baks_jobs, dt=dt,
+                                 dtype=dtype)
             print("Rate arrays made for %s" % rec_dir)
 
         rec_dirs = rec_info.rec_dir
@@ -723,6 +723,30 @@ def get_unit_names(rec_dir, h5_file=None):
     return unit_names
 
 
+def get_spike_train_names(rec_dir, h5_file=None):
+    '''Returns the names of the digital inputs with spike arrays, e.g.
+    dig_in_0
+
+    Parameters
+    ----------
+    rec_dir : str, full path to recording dir
+
+    Returns
+    -------
+    list of str
+    '''
+    if h5_file is None:
+        h5_file = get_h5_filename(rec_dir)
+
+    with tables.open_file(h5_file, 'r') as hf5:
+        if '/spike_trains' in hf5:
+            names = [x._v_name for x in hf5.list_nodes('/spike_trains')]
+        else:
+            names = []
+
+    return names
+
+
 def get_unit_table(rec_dir, h5_file=None):
     '''Returns pandas DataFrame with sorted unit info read from hdf5 store
 
@@ -922,23 +946,150 @@ def get_rate_data(rec_dir, units=None, din=None, trials=None, h5_file=None):
 
     return time, out
 
-def get_spike_data(rec_dir, units=None, din=None, trials=None, h5_file=None):
-    '''Opens hf5 file in rec_dir and returns a Trial x Time spike array and a
-    1D time vector
+def write_sparse_spike_array(hf5, where, trials, time_idx, unit_ptr, shape):
+    '''Stores a Trial x Unit x Time spike array as a list of spike events in
+    a spike_events group under where. Events are ordered by unit, and those
+    of unit u are trials[unit_ptr[u]:unit_ptr[u+1]] and
+    time_idx[unit_ptr[u]:unit_ptr[u+1]], so single units can be read without
+    reading the rest.
+
     Parameters
     ----------
-    rec_dir : str, path to recording directory
-    units : str or int or list of str/int, unit names or unit numbers
-    din : int, digital input channel
-    trials: int or list-like
-        if None (default), returns all trials, if int N returns first N-trials
-        for each din, if list-like then returns those indices for each taste
+    hf5 : tables.File, open for writing
+    where : str or tables.Group, spike_trains group of a digital input
+    trials : np.array, trial index of each spike
+    time_idx : np.array, time index of each spike
+    unit_ptr : np.array, start of each unit's events, length n_units+1
+    shape : tuple, shape of the dense spike array
+    '''
+    grp = hf5.create_group(where, 'spike_events')
+    filters = tables.Filters(complevel=5, complib='blosc:lz4', shuffle=True)
+    for name, arr in [('trials', trials), ('time_idx', time_idx),
+                      ('unit_ptr', unit_ptr)]:
+        arr = np.asarray(arr, dtype='int64' if name == 'unit_ptr' else 'int32')
+        if arr.size == 0:
+            hf5.create_array(grp, name, arr)
+        else:
+            hf5.create_carray(grp, name, obj=arr, filters=filters)
+
+    grp._v_attrs.shape = tuple(int(x) for x in shape)
+    return grp
+
+
+def write_spike_array(hf5, where, spike_array, storage='dense'):
+    '''Stores a dense Trial x Unit x Time spike array in the spike_trains
+    group of a digital input
+
+    Parameters
+    ----------
+    hf5 : tables.File, open for writing
+    where : str or tables.Group, spike_trains group of a digital input
+    spike_array : np.array, Trial x Unit x Time array of 0s and 1s
+    storage : {'dense' (default), 'sparse'}
+        dense stores spike_array as is, sparse stores spike events with
+        write_sparse_spike_array
+    '''
+    if storage == 'dense':
+        return hf5.create_array(where, 'spike_array', spike_array)
+    elif storage != 'sparse':
+        raise ValueError('storage must be dense or sparse, not %s' % storage)
+
+    # nonzero of the Unit x Trial x Time array orders events by unit
+    units, trials, time_idx = np.nonzero(np.swapaxes(spike_array, 0, 1))
+    unit_ptr = np.searchsorted(units, np.arange(spike_array.shape[1] + 1))
+    return write_sparse_spike_array(hf5, where, trials, time_idx, unit_ptr,
+                                    spike_array.shape)
+
+
+def get_spike_array_storage(group):
+    '''Returns 'sparse' or 'dense', the storage format of the spike array of
+    a /spike_trains/dig_in_# group
+    '''
+    return 'sparse' if 'spike_events' in group else 'dense'
+
+
+def read_sparse_spike_array(group, units=None):
+    '''Returns the spike events of a digital input's spike array, from
+    either storage format
+
+    Parameters
+    ----------
+    group : tables.Group, /spike_trains/dig_in_# node
+    units : int or list of int (optional)
+        unit numbers to return, default is all units
 
     Returns
     -------
-    time : numpy.array
-    spike_array : numpy.array
+    trials, units, time_idx : np.array
+        indices of each spike in the dense spike array, with units numbered
+        by their position in units if given
+    shape : tuple, shape of the dense Trial x Unit x Time spike array
+    '''
+    if 'spike_events' not in group:
+        spikes = group['spike_array']
+        if units is not None:
+            spikes = spikes[:, np.atleast_1d(units), :]
+        else:
+            spikes = spikes[:]
+
+        trials, unit_idx, time_idx = np.nonzero(spikes)
+        return trials, unit_idx, time_idx, spikes.shape
+
+    events = group['spike_events']
+    shape = tuple(events._v_attrs.shape)
+    unit_ptr = events['unit_ptr'][:]
+    if units is None:
+        units = np.arange(shape[1])
+        trials = events['trials'][:]
+        time_idx = events['time_idx'][:]
+        unit_idx = np.repeat(units, np.diff(unit_ptr))
+        return trials, unit_idx, time_idx, shape
+
+    units = np.atleast_1d(units)
+    trials = []
+    time_idx = []
+    unit_idx = []
+    for i, u in enumerate(units):
+        trials.append(events['trials'][unit_ptr[u]:unit_ptr[u+1]])
+        time_idx.append(events['time_idx'][unit_ptr[u]:unit_ptr[u+1]])
+        unit_idx.append(np.full(unit_ptr[u+1] - unit_ptr[u], i))
+
+    shape = (shape[0], len(units), shape[2])
+    return (np.concatenate(trials), np.concatenate(unit_idx),
+            np.concatenate(time_idx), shape)
+
+
+def read_spike_array(group, units=None):
+    '''Returns the dense Trial x Unit x Time spike array of a digital input,
+    whichever format it is stored in
+
+    Parameters
+    ----------
+    group : tables.Group, /spike_trains/dig_in_# node
+    units : int or list of int (optional)
+        unit numbers to return, default is all units. If an int the unit
+        axis is dropped
+
+    Returns
+    -------
+    numpy.array
     '''
+    if 'spike_events' not in group:
+        if units is None:
+            return group['spike_array'][:]
+
+        return group['spike_array'][:, units, :]
+
+    trials, unit_idx, time_idx, shape = read_sparse_spike_array(group, units)
+    spike_array = np.zeros(shape)
+    spike_array[trials, unit_idx, time_idx] = 1
+    if units is not None and np.ndim(units) == 0:
+        spike_array = spike_array[:, 0, :]
+
+    return spike_array
+
+
+def _get_spike_trains(rec_dir, units, din, h5_file, reader):
     if h5_file is None:
         h5_file = get_h5_filename(rec_dir)
 
@@ -977,8 +1128,31 @@ def get_spike_data(rec_dir, units=None, din=None, trials=None, h5_file=None):
             elif not np.array_equal(time, tmp_time):
                 raise ValueError('Misaligned time vectors encountered')
 
-            spike_array = st['spike_array'][:, unit_nums, :]
-            out[dig_str] = spike_array
+            out[dig_str] = reader(st, unit_nums)
+
+    return time, out
+
+
+def get_spike_data(rec_dir, units=None, din=None, trials=None, h5_file=None):
+    '''Opens hf5 file in rec_dir and returns a Trial x Time spike array and a
+    1D time vector. Spike arrays stored as spike events are made dense.
+
+    Parameters
+    ----------
+    rec_dir : str, path to recording directory
+    units : str or int or list of str/int, unit names or unit numbers
+    din : int, digital input channel
+    trials: int or list-like
+        if None (default), returns all trials, if int N returns first N-trials
+        for each din, if list-like then returns those indices for each taste
+
+    Returns
+    -------
+    time : numpy.array
+    spike_array : numpy.array
+    '''
+    time, out = _get_spike_trains(rec_dir, units, din, h5_file,
+                                  read_spike_array)
 
     if isinstance(trials, int) or isinstance(trials, np.int32) or isinstance(trials, np.int64):
         for k in out.keys():
@@ -994,6 +1168,33 @@ def get_spike_data(rec_dir, units=None, din=None, trials=None, h5_file=None):
     return time, out
 
 
+def get_sparse_spike_data(rec_dir, units=None, din=None, h5_file=None):
+    '''Opens hf5 file in rec_dir and returns the spikes in the spike arrays
+    as lists of events, without making dense arrays when they are stored as
+    spike events
+
+    Parameters
+    ----------
+    rec_dir : str, path to recording directory
+    units : str or int or list of str/int, unit names or unit numbers
+    din : int, digital input channel
+
+    Returns
+    -------
+    time : numpy.array
+    spike_events : tuple
+        (trials, units, time_idx, shape) as returned by
+        read_sparse_spike_array, or a dict of these keyed by digital input if
+        there are several
+    '''
+    time, out = _get_spike_trains(rec_dir, units, din, h5_file,
+                                  read_sparse_spike_array)
+    if len(out) == 1:
+        out = out.popitem()[1]
+
+    return time, out
+
+
 def get_raw_digital_signal(rec_dir, dig_type, channel, h5_file=None):
     if h5_file is None:
         h5_file = get_h5_filename(rec_dir)
@@ -1189,7 +1390,15 @@ def get_unit_waveforms(file_dir, unit, required_descrip=None, h5_file=None):
     clustering_params = params.load_params('clustering_params', file_dir)
     fs = clustering_params['sampling_rate']
     with tables.open_file(h5_file, 'r') as hf5:
-        waveforms = hf5.root.sorted_units[un].waveforms[:]
+        unit_node = hf5.root.sorted_units[un]
+        if 'waveforms' in unit_node:
+            waveforms = unit_node.waveforms[:]
+        else:
+            # Compact units store native rate snippets, upsample on demand
+            snippets = unit_node.snippets[:]
+            waveforms = clust.upsample_waveforms(snippets, unit_node.alignment[:],
+                                                 10*(snippets.shape[1] - 2))
+
         descriptor = hf5.root.unit_descriptor[unit]
 
     if required_descrip is not None:
@@ -1404,7 +1613,8 @@ def read_unit_description(unit_description):
         return 'Unlabelled'
 
 
-def add_new_unit(rec_dir, electrode, waves, times, single_unit, pyramidal, interneuron, h5_file=None):
+def add_new_unit(rec_dir, electrode, waves, times, single_unit, pyramidal,
+                 interneuron, h5_file=None, snippets=None, alignment=None):
     '''Adds new sorted unit to h5_file and returns the new unit name
     Creates new row for unit description and add waveforms and times arrays
 
@@ -1417,42 +1627,129 @@ def add_new_unit(rec_dir, electrode, waves, times, single_unit, pyramidal, inter
     single_unit : bool or int
     pyramidal : bool or int
     interneuron : bool or int
+    snippets : np.array (optional)
+        native rate waveform snippets, if provided these are stored along
+        with alignment instead of waves and get_unit_waveforms upsamples them
+    alignment : np.array (optional)
+        sub-sample alignment of snippets in 1/10 samples
 
     Returns
     -------
     str : unit_name
     '''
-    if h5_file is None:
-        h5_file = get_h5_filename(rec_dir)
+    unit = {'rec_dir': rec_dir, 'electrode': electrode, 'waves': waves,
+            'times': times, 'single_unit': single_unit,
+            'pyramidal': pyramidal, 'interneuron': interneuron,
+            'snippets': snippets, 'alignment': alignment}
+    h5_files = None if h5_file is None else {rec_dir: h5_file}
+    return add_new_units([unit], h5_files=h5_files)[0]
+
+
+def _create_unit_array(hf5, where, name, arr):
+    '''Stores integer arrays (spike times, snippets) compressed. Float
+    waveforms barely compress so are stored as plain arrays to keep writes
+    fast.
+    '''
+    arr = np.asarray(arr)
+    if arr.size == 0 or not np.issubdtype(arr.dtype, np.integer):
+        return hf5.create_array(where, name, arr)
 
-    unit_name = get_next_unit_name(rec_dir)
+    filters = tables.Filters(complevel=5, complib='blosc:lz4', shuffle=True)
+    return hf5.create_carray(where, name, obj=arr, filters=filters)
 
-    with tables.open_file(h5_file, 'r+') as hf5:
-        if '/sorted_units' not in hf5:
-            hf5.create_group('/', 'sorted_units')
 
-        if '/unit_descriptor' not in hf5:
-            hf5.create_table('/', 'unit_descriptor',
-                             description=particles.unit_descriptor)
+def add_new_units(units, h5_files=None):
+    '''Adds several sorted units at once. Each recording's h5 file is opened
+    once, unit numbers are assigned in a single pass and all unit arrays are
+    written before a single flush, with spike times and snippets
+    compressed. If writing to a file fails, the units already added to that
+    file are removed again.
+
+    Parameters
+    ----------
+    units : list of dict
+        one dict per unit with keys rec_dir, electrode, waves, times,
+        single_unit, pyramidal, interneuron and optionally snippets and
+        alignment, as for add_new_unit
+    h5_files : dict (optional)
+        h5 file for each rec_dir, found with get_h5_filename if not provided
 
+    Returns
+    -------
+    list of str
+        unit names in the order of units
+    '''
+    if h5_files is None:
+        h5_files = {}
+
+    by_rec = {}
+    for i, unit in enumerate(units):
+        by_rec.setdefault(unit['rec_dir'], []).append(i)
+
+    out = [None] * len(units)
+    for rec_dir, idx in by_rec.items():
+        h5_file = h5_files.get(rec_dir)
+        if h5_file is None:
+            h5_file = get_h5_filename(rec_dir)
+
+        with tables.open_file(h5_file, 'r+') as hf5:
+            if '/sorted_units' not in hf5:
+                hf5.create_group('/', 'sorted_units')
+
+            if '/unit_descriptor' not in hf5:
+                hf5.create_table('/', 'unit_descriptor',
+                                 description=particles.unit_descriptor)
+
+            existing = [parse_unit_number(x._v_name)
+                        for x in hf5.list_nodes('/sorted_units')]
+            next_unit = max(existing) + 1 if len(existing) > 0 else 0
+            table = hf5.root.unit_descriptor
+            n_rows = table.nrows
+            created = []
+            try:
+                for i in idx:
+                    unit = units[i]
+                    unit_name = 'unit%03d' % next_unit
+                    next_unit += 1
+                    unit_descrip = table.row
+                    unit_descrip['electrode_number'] = int(unit['electrode'])
+                    unit_descrip['single_unit'] = int(unit['single_unit'])
+                    unit_descrip['regular_spiking'] = int(unit['pyramidal'])
+                    unit_descrip['fast_spiking'] = int(unit['interneuron'])
+                    unit_descrip.append()
+
+                    where = '/sorted_units/%s' % unit_name
+                    hf5.create_group('/sorted_units', unit_name, title=unit_name)
+                    created.append(where)
+                    if unit.get('snippets') is not None:
+                        _create_unit_array(hf5, where, 'snippets',
+                                           unit['snippets'])
+                        _create_unit_array(hf5, where, 'alignment',
+                                           unit['alignment'])
+                    else:
+                        _create_unit_array(hf5, where, 'waveforms',
+                                           unit['waves'])
 
-        table = hf5.root.unit_descriptor
-        unit_descrip = table.row
-        unit_descrip['electrode_number'] = int(electrode)
-        unit_descrip['single_unit'] = int(single_unit)
-        unit_descrip['regular_spiking'] = int(pyramidal)
-        unit_descrip['fast_spiking'] = int(interneuron)
-
-        hf5.create_group('/sorted_units', unit_name, title=unit_name)
-        waveforms = hf5.create_array('/sorted_units/%s' % unit_name,
-                                     'waveforms', waves)
-        times = hf5.create_array('/sorted_units/%s' % unit_name,
-                                 'times', times)
-        unit_descrip.append()
-        table.flush()
-        hf5.flush()
+                    _create_unit_array(hf5, where, 'times', unit['times'])
+                    out[i] = unit_name
+
+            except Exception:
+                # Roll back this file so unit numbers stay consistent
+                table.flush()
+                if table.nrows > n_rows:
+                    table.remove_rows(n_rows)
+
+                for where in created:
+                    hf5.remove_node(where, recursive=True)
+
+                hf5.flush()
+                raise
+
+            table.flush()
+            hf5.flush()
+
+    return out
 
-    return unit_name
 
 def edit_unit_descriptor(file_dir, unit_num, descriptor_key, descriptor_val, h5_file = None):
     '''
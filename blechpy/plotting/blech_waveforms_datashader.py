@@ -1,69 +1,241 @@
-# yaml.load is deprecated so hide the warnings
-import os
-import warnings
-import yaml
-warnings.simplefilter('ignore',category=yaml.YAMLLoadWarning)
-
 # Import stuff
-import datashader as ds
-import datashader.transfer_functions as tf
-from functools import partial
-from datashader.utils import export_image
 import numpy as np
-import pandas as pd
 import matplotlib.pyplot as plt
-from imageio import imread
-import shutil
+from numba import njit, prange, get_num_threads
 
-# A function that accepts a numpy array of waveforms and creates a datashader image from them
-def waveforms_datashader(waveforms, threshold=None):
-    if waveforms.shape[0]==0:
-        return None
-    # Make a pandas dataframe with two columns, x and y, holding all the data. The individual waveforms are separated by a row of NaNs
 
-    # First downsample the waveforms 10 times (to remove the effects of 10 times upsampling during de-jittering)
-    waveforms = waveforms[:, ::10]
-    x_values = np.arange(len(waveforms[0])) + 1
-    # Then make a new array of waveforms - the last element of each waveform is a NaN
+@njit(cache=True)
+def _draw_waveform_lines(waveforms, x_px, y_lo, y_scale, counts):
+    '''Draws each waveform as connected line segments into counts. Each
+    pixel is counted at most once per waveform.
+    '''
+    n_waves, n_samples = waveforms.shape
+    height, width = counts.shape
+    col_min = np.empty(width)
+    col_max = np.empty(width)
+    for i in range(n_waves):
+        col_min[:] = np.inf
+        col_max[:] = -np.inf
+        for j in range(n_samples - 1):
+            x0 = x_px[j]
+            x1 = x_px[j+1]
+            y0 = (waveforms[i, j] - y_lo) * y_scale
+            y1 = (waveforms[i, j+1] - y_lo) * y_scale
+            slope = (y1 - y0) / (x1 - x0)
+            c0 = int(x0)
+            c1 = min(int(x1), width - 1)
+            for c in range(c0, c1 + 1):
+                # y range covered by this segment within pixel column c
+                xa = max(x0, c)
+                xb = min(x1, c + 1)
+                ya = y0 + slope * (xa - x0)
+                yb = y0 + slope * (xb - x0)
+                lo = min(ya, yb)
+                hi = max(ya, yb)
+                if lo < col_min[c]:
+                    col_min[c] = lo
+
+                if hi > col_max[c]:
+                    col_max[c] = hi
+
+        for c in range(width):
+            if col_max[c] < col_min[c]:
+                continue
+
+            r0 = max(int(col_min[c]), 0)
+            r1 = min(int(col_max[c]), height - 1)
+            for r in range(r0, r1 + 1):
+                counts[r, c] += 1
+
+
+@njit(parallel=True, cache=True)
+def _draw_waveform_blocks(waveforms, x_px, y_lo, y_scale, counts, n_blocks):
+    '''Draws blocks of waveforms in parallel into separate count arrays
+    and sums them into counts
+    '''
+    bounds = np.linspace(0, waveforms.shape[0], n_blocks + 1).astype(np.int64)
+    block_counts = np.zeros((n_blocks,) + counts.shape, dtype=counts.dtype)
+    for b in prange(n_blocks):
+        _draw_waveform_lines(waveforms[bounds[b]:bounds[b+1]], x_px, y_lo,
+                             y_scale, block_counts[b])
+
+    counts += block_counts.sum(axis=0)
+
+
+def rasterize_waveforms(waveforms, width=1600, height=1200, y_range=None,
+                        interpolate=True, chunk_size=10000):
+    '''Bins waveforms into a 2D histogram of (sample, voltage) without
+    building a DataFrame or going through an image file.
+
+    Parameters
+    ----------
+    waveforms : np.array
+        waveforms with a row for each spike
+    width : int (optional)
+        image width in pixels, spans first to last sample
+    height : int (optional)
+        image height in pixels, spans y_range
+    y_range : tuple (optional)
+        (min, max) voltage of image, defaults to range of waveforms +/- 10
+    interpolate : bool (optional)
+        True (default) draws connected line segments between samples with
+        numba. False samples each waveform at every pixel column instead
+        with numpy, which leaves gaps on steep slopes.
+    chunk_size : int (optional)
+        number of waveforms resampled at a time when interpolate is False
+
+    Returns
+    -------
+    np.array, tuple
+        (height, width) array of counts with row 0 at the bottom of y_range,
+        and the y_range used
+    '''
+    waveforms = np.asarray(waveforms, dtype='float64')
+    if y_range is None:
+        y_range = (np.min(waveforms) - 10, np.max(waveforms) + 10)
+
+    y_lo, y_hi = y_range
+    y_scale = height / (y_hi - y_lo)
+    n_samples = waveforms.shape[1]
+    counts = np.zeros((height, width), dtype='int64')
+    if n_samples < 2:
+        return counts, y_range
+
+    # pixel x position of each sample, the last sample is at the right edge
+    x_px = np.arange(n_samples) * (width - 1) / (n_samples - 1)
+    if interpolate:
+        n_blocks = min(get_num_threads(), waveforms.shape[0] // 5000)
+        if n_blocks > 1:
+            _draw_waveform_blocks(waveforms, x_px, y_lo, y_scale, counts,
+                                  n_blocks)
+        else:
+            _draw_waveform_lines(waveforms, x_px, y_lo, y_scale, counts)
+
+        return counts, y_range
+
+    # Resample waveforms at each pixel column and bin
+    x = np.arange(width) * (n_samples - 1) / (width - 1)
+    i0 = np.minimum(x.astype('int64'), n_samples - 2)
+    frac = x - i0
+    cols = np.arange(width)
+    for start in range(0, waveforms.shape[0], chunk_size):
+        chunk = waveforms[start:start+chunk_size]
+        y = chunk[:, i0] * (1 - frac) + chunk[:, i0 + 1] * frac
+        rows = ((y - y_lo) * y_scale).astype('int64')
+        valid = (rows >= 0) & (rows < height)
+        flat = (rows * width + cols)[valid]
+        counts += np.bincount(flat, minlength=height*width).reshape(height, width)
+
+    return counts, y_range
+
+
+def shade_counts(counts, low_color=(173, 216, 230), high_color=(0, 0, 139),
+                 background=(255, 255, 255)):
+    '''Converts a counts image to RGB using histogram equalization, as with
+    datashader's eq_hist shading. Empty pixels are set to background.
+
+    Parameters
+    ----------
+    counts : np.array, 2D array of counts
+    low_color, high_color : tuple (optional)
+        RGB colors for the lowest and highest non-zero counts
+    background : tuple (optional)
+        RGB color for pixels with no counts
+
+    Returns
+    -------
+    np.array
+        (height, width, 3) uint8 image
+    '''
+    img = np.empty(counts.shape + (3,), dtype='uint8')
+    img[:] = background
+    nz = counts > 0
+    if not np.any(nz):
+        return img
+
+    vals, inverse, n = np.unique(counts[nz], return_inverse=True,
+                                 return_counts=True)
+    cdf = np.cumsum(n).astype('float64')
+    if len(vals) > 1:
+        cdf = (cdf - cdf[0]) / (cdf[-1] - cdf[0])
+    else:
+        cdf[:] = 1.0
+
+    level = cdf[inverse][:, None]
+    low = np.array(low_color, dtype='float64')
+    high = np.array(high_color, dtype='float64')
+    img[nz] = np.round(low + level * (high - low)).astype('uint8')
+    return img
+
+
+def _datashader_image(waveforms, x_values, y_range, width, height):
+    # Original datashader rendering: a DataFrame of NaN-separated waveforms
+    import datashader as ds
+    import datashader.transfer_functions as tf
+    import pandas as pd
     new_waveforms = np.zeros((waveforms.shape[0], waveforms.shape[1] + 1))
     new_waveforms[:, -1] = np.nan
     new_waveforms[:, :-1] = waveforms
-
-    # Now make an array of x's - the last element is a NaN
     x = np.zeros(x_values.shape[0] + 1)
     x[-1] = np.nan
     x[:-1] = x_values
-
-    # Now make the dataframe
-    df = pd.DataFrame({'x': np.tile(x, new_waveforms.shape[0]), 'y': new_waveforms.flatten()})
-
-    # Produce a datashader canvas
+    df = pd.DataFrame({'x': np.tile(x, new_waveforms.shape[0]),
+                       'y': new_waveforms.flatten()})
     canvas = ds.Canvas(x_range = (np.min(x_values), np.max(x_values)),
-                       y_range = (df['y'].min() - 10, df['y'].max() + 10),
-                       plot_height=1200, plot_width=1600)
-    # Aggregate the data
+                       y_range = y_range, plot_height=height, plot_width=width)
     agg = canvas.line(df, 'x', 'y', ds.count())
-    # Transfer the aggregated data to image using log transform and export the temporary image file
     img = tf.shade(agg, how='eq_hist')
     img = tf.set_background(img, 'white')
+    return img.to_pil()
+
+
+# A function that accepts a numpy array of waveforms and creates a datashader image from them
+def waveforms_datashader(waveforms, threshold=None, method='numpy'):
+    '''Plots a density image of waveforms
+
+    Parameters
+    ----------
+    waveforms : np.array, waveforms with a row for each spike
+    threshold : float (optional), draws a dashed line at this voltage
+    method : {'numpy' (default), 'datashader'}
+        numpy rasterizes in memory with rasterize_waveforms, datashader
+        uses the datashader line renderer
+
+    Returns
+    -------
+    matplotlib.pyplot.Figure, matplotlib.pyplot.Axes
+    '''
+    if waveforms.shape[0]==0:
+        return None
+
+    width = 1600
+    height = 1200
+
+    # First downsample the waveforms 10 times (to remove the effects of 10 times upsampling during de-jittering)
+    waveforms = np.asarray(waveforms[:, ::10])
+    x_values = np.arange(len(waveforms[0])) + 1
+    y_range = (np.min(waveforms) - 10, np.max(waveforms) + 10)
+    if method == 'datashader':
+        img = _datashader_image(waveforms, x_values, y_range, width, height)
+    else:
+        counts, _ = rasterize_waveforms(waveforms, width=width, height=height,
+                                        y_range=y_range)
+        # image rows run from top to bottom
+        img = shade_counts(counts[::-1])
 
     # Figure sizes chosen so that the resolution is 100 dpi
     fig,ax = plt.subplots(1, 1, figsize = (12,8), dpi = 200)
     # Start plotting
-    ax.imshow(img.to_pil())
+    ax.imshow(img)
     # Set ticks/labels - 10 on each axis
-    ax.set_xticks(np.linspace(0, 1600, 10))
+    ax.set_xticks(np.linspace(0, width, 10))
     ax.set_xticklabels(np.floor(np.linspace(np.min(x_values), np.max(x_values), 10)))
-    ax.set_yticks(np.linspace(0, 1200, 10))
-    yticklabels = np.floor(np.linspace(df['y'].max() + 10, df['y'].min() - 10, 10))
+    ax.set_yticks(np.linspace(0, height, 10))
+    yticklabels = np.floor(np.linspace(y_range[1], y_range[0], 10))
     ax.set_yticklabels(yticklabels)
     if threshold is not None:
-        scaled_thresh = (threshold - np.max(yticklabels))*(1200/(np.min(yticklabels) - np.max(yticklabels)))
+        scaled_thresh = (threshold - np.max(yticklabels))*(height/(np.min(yticklabels) - np.max(yticklabels)))
         ax.axhline(scaled_thresh, linestyle='--', color='r', alpha=0.3)
 
-    # Delete the dataframe
-    del df, waveforms, new_waveforms
-
     # Return and figure and axis for adding axis labels, title and saving the file
     return fig, ax
-
@@ -3,13 +3,11 @@ import numpy as np
 import tables
 import os
 import umap
-import pywt
 import itertools as it
 from blechpy import dio
-from blechpy.analysis import spike_analysis as sas
+from blechpy.analysis import spike_analysis as sas, clustering
 from scipy.stats import sem
 from scipy.ndimage.filters import gaussian_filter1d
-from statsmodels.stats.diagnostic import lilliefors
 from sklearn.decomposition import PCA
 from blechpy.plotting import blech_waveforms_datashader
 import matplotlib
@@ -944,7 +942,8 @@ def plot_ensemble_raster(dat, save_file = None):
         return fig,ax
 
 
-def plot_waveforms_pca(waveforms, cluster_ids=None, save_file=None):
+def plot_waveforms_pca(waveforms, cluster_ids=None, save_file=None,
+                       coordinates=None):
     '''Plot PCA view of clusters from spike_sorting
 
     Parameters
@@ -956,6 +955,8 @@ def plot_waveforms_pca(waveforms, cluster_ids=None, save_file=None):
     save_file : str (optional)
         path to save figure to, if provided, figure is saved and closed and
         this returns None
+    coordinates : list of np.array (optional)
+        precomputed first 3 PCs for each cluster, if provided no PCA is fit
 
     Returns
     -------
@@ -966,13 +967,15 @@ def plot_waveforms_pca(waveforms, cluster_ids=None, save_file=None):
 
     fig, axs = plt.subplots(2, 2, sharex=False, sharey=False, figsize=(20,15))
 
-    pca = PCA(n_components=3)
-    all_waves = np.vstack(waveforms)
-    pca.fit(all_waves)
+    if coordinates is None:
+        pca = PCA(n_components=3)
+        all_waves = np.vstack(waveforms)
+        pca.fit(all_waves)
+        coordinates = [pca.transform(x) for x in waveforms]
 
     colors = [plt.cm.jet(x) for x in np.linspace(0,1,len(waveforms))]
-    for i, c in enumerate(zip(cluster_ids, waveforms)):
-        pcs = pca.transform(c[1])
+    for i, c in enumerate(zip(cluster_ids, coordinates)):
+        pcs = c[1]
 
         axs[0, 0].scatter(pcs[:, 0], pcs[:, 1], alpha=0.4, s=5,
                           color=colors[i], label=str(c[0]))
@@ -1001,7 +1004,8 @@ def plot_waveforms_pca(waveforms, cluster_ids=None, save_file=None):
 
 
 def plot_waveforms_umap(waveforms, cluster_ids=None, save_file=None,
-                        n_neighbors=30, min_dist=0.0, embedding=None):
+                        n_neighbors=30, min_dist=0.0, embedding=None,
+                        coordinates=None):
     '''Plot UMAP view of clusters from spike_sorting
 
     Parameters
@@ -1018,6 +1022,11 @@ def plot_waveforms_umap(waveforms, cluster_ids=None, save_file=None,
         and higher preferences global structure
     min_dist : float [0,1] (optional)
         minimum distance between points in 2D represenation. (default = 0.1)
+    embedding : fitted umap.UMAP (optional)
+        used to transform waveforms instead of fitting a new UMAP
+    coordinates : list of np.array (optional)
+        precomputed 2D UMAP coordinates for each cluster (e.g. from a
+        blech_clustering.UmapCache), if provided no UMAP is fit
 
     Returns
     -------
@@ -1026,14 +1035,16 @@ def plot_waveforms_umap(waveforms, cluster_ids=None, save_file=None,
     if cluster_ids is None:
         cluster_ids = list(range(len(waveforms)))
 
-    if embedding is None:
-        reducer = umap.UMAP(n_neighbors=n_neighbors, min_dist=min_dist, n_components=2)
-        embedding = reducer.fit(np.vstack(waveforms))
+    if coordinates is None:
+        if embedding is None:
+            reducer = umap.UMAP(n_neighbors=n_neighbors, min_dist=min_dist, n_components=2)
+            embedding = reducer.fit(np.vstack(waveforms))
+
+        coordinates = [embedding.transform(x) for x in waveforms]
 
     colors = [plt.cm.rainbow(x) for x in np.linspace(0, 1, len(waveforms))]
     fig, ax = plt.subplots(figsize=(15,10))
-    for x, y, z in zip(waveforms, cluster_ids, colors):
-        u = embedding.transform(x)
+    for u, y, z in zip(coordinates, cluster_ids, colors):
         ax.scatter(u[:, 0],  u[:, 1], s=3, color=z, marker='o', label=y)
 
     ax.legend()
@@ -1049,25 +1060,17 @@ def plot_waveforms_umap(waveforms, cluster_ids=None, save_file=None,
 
 
 def plot_waveforms_wavelet_tranform(waveforms, cluster_ids=None,
-                                    save_file=None, n_pc=4):
+                                    save_file=None, n_pc=4, coeff_idx=None):
     all_waves = np.vstack(waveforms)
-    coeffs = pywt.wavedec(all_waves, 'haar', axis=1)
-    all_coeffs = np.column_stack(coeffs)
-    k_stats = np.zeros((all_coeffs.shape[1],))
-    p_vals = np.ones((all_coeffs.shape[1],))
-    for i, coef in enumerate(all_coeffs.T):
-        if len(np.unique(coef)) == 1:  # to avoid nans
-            continue
-
-        try:
-            k_stats[i], p_vals[i] = lilliefors(coef, dist='norm')
-        except ValueError:
-            continue
+    all_coeffs = clustering.get_wavelet_coefficients(all_waves)
 
     # pick best coefficients as ones that are least normally distributed
-    # that is lowest p-values from Lilliefors K-S test
-    idx = np.argsort(p_vals)
-    best_coeffs = all_coeffs[:, idx[:n_pc]]
+    # that is lowest p-values from Lilliefors K-S test, unless already selected
+    if coeff_idx is None:
+        coeff_idx = clustering.rank_wavelet_coefficients(all_coeffs,
+                                                         constant_pval=1)[:n_pc]
+
+    best_coeffs = all_coeffs[:, coeff_idx[:n_pc]]
     data = []
     for i, w in enumerate(waveforms):
         tmp = best_coeffs[:w.shape[0]]
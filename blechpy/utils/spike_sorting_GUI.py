@@ -1,5 +1,9 @@
 import tkinter as tk
 import sys
+import time
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 from tkinter import ttk
 import numpy as np
 import matplotlib
@@ -24,6 +28,11 @@ class SpikeSorterGUI(ttk.Frame):
         self.sorter = spike_sorter
         self.sorter._shell = False
         self.electrode = spike_sorter.electrode
+        self._status_var = tk.StringVar(self, 'Ready')
+        self._image_job = None
+        self._worker = BackgroundWorker(self.root,
+                                        status_callback=self._status_var.set)
+        self.root.protocol('WM_DELETE_WINDOW', self.close)
         self.initUI()
 
     def initUI(self):
@@ -49,6 +58,14 @@ class SpikeSorterGUI(ttk.Frame):
         figs.pack(side='left', fill='both', expand=True)
         ui.pack(side='left')
 
+        # Status of background computations
+        status_row = ttk.Frame(self)
+        status_row.pack(side='bottom', fill='x', padx=10, pady=5)
+        self._cancel_button = ttk.Button(status_row, text='Cancel',
+                                         command=self.cancel_jobs)
+        self._cancel_button.pack(side='right')
+        ttk.Label(status_row, textvariable=self._status_var).pack(side='left')
+
         row1.pack(side='top')
         row2.pack(side='top', fill='both', expand=True, anchor='n')
 
@@ -60,7 +77,14 @@ class SpikeSorterGUI(ttk.Frame):
 
         # Select solution
         solutions = self.sorter.get_possible_solutions()
-        self._solution_var = tk.IntVar(self, max(solutions))
+        # Keep a sorting session resumed by the sorter
+        resumed = self.sorter._active is not None
+        if resumed and self.sorter._current_solution in solutions:
+            self._solution_var = tk.IntVar(self, self.sorter._current_solution)
+        else:
+            resumed = False
+            self._solution_var = tk.IntVar(self, max(solutions))
+
         solution_drop = ttk.OptionMenu(solution_row, self._solution_var,
                                        *solutions)
         solution_drop.pack(side='right')
@@ -69,11 +93,13 @@ class SpikeSorterGUI(ttk.Frame):
         self._solution_var.trace('w', self.change_solution)
 
         # Set sorter to max solutions
-        self.sorter.set_active_clusters(self._solution_var.get())
+        if not resumed:
+            self.sorter.set_active_clusters(self._solution_var.get())
 
         # Check boxes
         cluster_choices = list(range(self._solution_var.get()))
-        self._check_bar = CheckBar(checks, cluster_choices)
+        self._check_bar = CheckBar(checks, cluster_choices,
+                                   command=self.prefetch)
         ttk.Label(checks, text='Clusters:').pack(side='top', pady=10)
         self._check_bar.pack()
 
@@ -97,6 +123,7 @@ class SpikeSorterGUI(ttk.Frame):
         viewACORR = ttk.Button(buttons, text='View AutoCorr', command=self.view_acorr)
         discard = ttk.Button(buttons, text='Discard Clusters', command=self.discard_clusters)
         self._undo_button = ttk.Button(buttons, text='Undo', command=self.undo)
+        self._redo_button = ttk.Button(buttons, text='Redo', command=self.redo)
         merge.pack(side='top', fill='x', pady=5)
         split.pack(side='top', fill='x', pady=5)
         splitUMAP.pack(side='top', fill='x', pady=5)
@@ -114,6 +141,8 @@ class SpikeSorterGUI(ttk.Frame):
         discard.pack(side='top', fill='x', pady=5)
         self._undo_button.pack(side='top', fill='x', pady=5)
         self._undo_button.config(state='disabled')
+        self._redo_button.pack(side='top', fill='x', pady=5)
+        self._redo_button.config(state='disabled')
 
         self._ui_frame = ui
 
@@ -124,29 +153,58 @@ class SpikeSorterGUI(ttk.Frame):
 
 
     def update(self):
-        if self.sorter._last_action is not None:
-            self._undo_button.config(text='Undo ' + self.sorter._last_action,
+        undo_action = self.sorter.get_undo_action()
+        if undo_action is not None:
+            self._undo_button.config(text='Undo ' + undo_action,
                                      state='normal')
         else:
             self._undo_button.config(text='Undo', state='disabled')
 
+        redo_action = self.sorter.get_redo_action()
+        if redo_action is not None:
+            self._redo_button.config(text='Redo ' + redo_action,
+                                     state='normal')
+        else:
+            self._redo_button.config(text='Redo', state='disabled')
+
         # Check active clusters
         clusters = list(range(len(self.sorter._active)))
 
         # Update cluster checkbar
         self._check_bar.updateChoices(clusters)
 
-        # Update waveforms
+        # Update waveforms, then add density images once they are
+        # rasterized in the background
         wave_dict = {}
         for i in clusters:
             wave_dict[i] = self.sorter.get_mean_waveform(i)
 
         self._wavepane.update(wave_dict)
+        active = self.sorter.get_clusters(clusters)
+
+        def finish(images):
+            if (len(self.sorter._active) != len(active) or
+                    not self._clusters_unchanged(clusters, active)):
+                return
+
+            self._wavepane.update({i: wave_dict[i] + (img,)
+                                   for i, img in zip(clusters, images)})
+
+        if self._image_job is not None:
+            self._worker.cancel(self._image_job)
+
+        self._image_job = ('waveform_images',) + tuple(id(c) for c in active)
+        self._worker.submit(self._image_job, self.sorter.get_waveform_images,
+                            active, label='Drawing waveforms', callback=finish)
 
     def undo(self):
         self.sorter.undo()
         self.update()
 
+    def redo(self):
+        self.sorter.redo()
+        self.update()
+
     def change_solution(self, *args):
         solutions = self._solution_var.get()
         self.sorter.set_active_clusters(solutions)
@@ -185,12 +243,35 @@ class SpikeSorterGUI(ttk.Frame):
         if popup.cancelled or params['n_clusters'] is None:
             return
 
-        new_clusts = self.sorter.split_cluster(chosen, params['n_iterations'],
-                                               params['n_restarts'],
-                                               params['thresh'],
-                                               params['n_clusters'],
-                                               store_split=True,
-                                               umap=umap)
+        cluster = self.sorter.get_clusters([chosen])[0]
+        split_params = (params['n_iterations'], params['n_restarts'],
+                        params['thresh'], params['n_clusters'])
+
+        def finish(new_clusts):
+            self.enable_all()
+            if not self._clusters_unchanged([chosen], [cluster]):
+                self._status_var.set('Clusters changed, split discarded')
+                return
+
+            self._choose_split(chosen, split_params, umap, new_clusts)
+
+        def failed(exc):
+            self.enable_all()
+            self._status_var.set('Split failed: %s' % exc)
+
+        # Sorting actions are blocked while the GMM is fit, the window stays
+        # responsive and the split can be cancelled
+        self.disable_all()
+        label = 'Splitting cluster %i' % chosen
+        self._worker.submit(('split', id(cluster)) + split_params + (umap,),
+                            self.sorter.compute_split, cluster, *split_params,
+                            umap=umap, label=label, callback=finish,
+                            error_callback=failed, progress=True)
+
+    def _choose_split(self, chosen, split_params, umap, new_clusts):
+        new_clusts = self.sorter.split_cluster(chosen, *split_params,
+                                               store_split=True, umap=umap,
+                                               new_clusts=new_clusts)
 
         choices = ['%i' % i for i in range(len(new_clusts))]
         popup = tkw.ListSelectPopup(choices, self.root,
@@ -266,29 +347,19 @@ class SpikeSorterGUI(ttk.Frame):
         self.sorter.plot_cluster_waveforms_over_time(chosen, params['interval'])
 
     def view_pca(self, *args):
-        chosen = self._check_bar.get_selected()
-        if len(chosen) == 0:
-            return
-
-        self.sorter.plot_clusters_pca(chosen)
+        self._run_view('pca', 'Computing PCA',
+                       self.sorter.get_pca_coordinates,
+                       self.sorter.plot_clusters_pca)
 
     def view_umap(self, *args):
-        chosen = self._check_bar.get_selected()
-        if len(chosen) == 0:
-            return
-
-        self.disable_all()
-        self.sorter.plot_clusters_umap(chosen)
-        self.enable_all()
+        self._run_view('umap', 'Computing UMAP',
+                       self.sorter.get_umap_coordinates,
+                       self.sorter.plot_clusters_umap, progress=True)
 
     def view_wavelets(self, *args):
-        chosen = self._check_bar.get_selected()
-        if len(chosen) == 0:
-            return
-
-        self.disable_all()
-        self.sorter.plot_clusters_wavelets(chosen)
-        self.enable_all()
+        self._run_view('wavelets', 'Ranking wavelet coefficients',
+                       self.sorter.get_wavelet_index,
+                       self.sorter.plot_clusters_wavelets)
 
     def view_ISI(self, *args):
         chosen = self._check_bar.get_selected()
@@ -305,18 +376,65 @@ class SpikeSorterGUI(ttk.Frame):
         self.sorter.plot_clusters_raster(chosen)
 
     def view_acorr(self, *args):
+        self._run_view('correlograms', 'Computing correlograms',
+                       self.sorter.get_correlograms,
+                       self.sorter.plot_clusters_acorr)
+
+    def view_xcorr(self, *args):
+        self._run_view('correlograms', 'Computing correlograms',
+                       self.sorter.get_correlograms,
+                       self.sorter.plot_clusters_xcorr)
+
+    def _run_view(self, name, label, compute, plot, progress=False):
+        '''Runs compute on the selected clusters in the background worker and
+        then plot on the Tk thread. compute stores its result in the sorter's
+        cache, so plot only draws it. The plot is skipped if the clusters
+        were changed in the meantime.
+        '''
         chosen = self._check_bar.get_selected()
         if len(chosen) == 0:
             return
 
-        self.sorter.plot_clusters_acorr(chosen)
+        clusters = self.sorter.get_clusters(chosen)
 
-    def view_xcorr(self, *args):
+        def finish(result):
+            if self._clusters_unchanged(chosen, clusters):
+                plot(chosen)
+
+        key = (name,) + tuple(id(c) for c in clusters)
+        self._worker.submit(key, compute, clusters, label=label,
+                            callback=finish, progress=progress)
+
+    def _clusters_unchanged(self, chosen, clusters):
+        active = self.sorter._active
+        return all(i < len(active) and active[i] is c
+                   for i, c in zip(chosen, clusters))
+
+    def prefetch(self, *args):
+        '''Computes PCA and correlograms of the selected clusters in the
+        background, so they are ready if asked for
+        '''
+        self._worker.cancel_prefetch()
         chosen = self._check_bar.get_selected()
         if len(chosen) == 0:
             return
 
-        self.sorter.plot_clusters_xcorr(chosen)
+        clusters = self.sorter.get_clusters(chosen)
+        ids = tuple(id(c) for c in clusters)
+        self._worker.submit(('pca',) + ids, self.sorter.get_pca_coordinates,
+                            clusters, prefetch=True)
+        self._worker.submit(('correlograms',) + ids,
+                            self.sorter.get_correlograms, clusters,
+                            prefetch=True)
+
+    def cancel_jobs(self, *args):
+        if self._worker.cancel():
+            self._status_var.set('Cancelled')
+            self.enable_all()
+
+    def close(self, *args):
+        self._worker.shutdown()
+        self.root.destroy()
 
     def discard_clusters(self, *args):
         chosen = self._check_bar.get_selected()
@@ -346,13 +464,209 @@ class SpikeSorterGUI(ttk.Frame):
 
     def disable_all(self):
         self.cstate('disabled')
+        # Background jobs can always be cancelled
+        self._cancel_button.state(('!disabled',))
+
+
+
+class BackgroundWorker(object):
+    '''Runs slow sorter computations in worker threads so the Tk main loop
+    stays responsive. Jobs are polled with root.after and their callbacks
+    are run on the Tk thread, so they are free to create figures and
+    widgets.
+
+    Threads are used rather than processes since jobs read the sorter's
+    clusters and memory-mapped spike data and store results in its caches.
+    The numpy, sklearn and numba work they do mostly releases the GIL.
+
+    Parameters
+    ----------
+    root : tk.Tk
+    status_callback : callable (optional)
+        called on the Tk thread with a status str while jobs are running and
+        once when they finish
+    poll_interval : int (optional)
+        ms between checks on running jobs, default 100
+    '''
+    def __init__(self, root, status_callback=None, poll_interval=100):
+        self.root = root
+        self._status_callback = status_callback
+        self._poll_interval = poll_interval
+        # Foreground jobs are requested by the user, prefetch jobs are
+        # guesses at what will be requested next and get their own thread so
+        # they never hold up a foreground job
+        self._pool = ThreadPoolExecutor(max_workers=1)
+        self._prefetch_pool = ThreadPoolExecutor(max_workers=1)
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._polling = False
+        self._last_status = None
+
+    def submit(self, key, func, *args, label=None, callback=None,
+               error_callback=None, prefetch=False, progress=False,
+               **kwargs):
+        '''Runs func(*args, **kwargs) in a worker thread. If a job with the
+        same key is still queued or running then callback is attached to it
+        instead of starting a new one, so a request for a result being
+        prefetched waits for the prefetch.
+
+        Parameters
+        ----------
+        key : hashable, identifies the job
+        func : callable
+        label : str (optional), description shown in the status
+        callback : callable (optional)
+            called on the Tk thread with the result of func
+        error_callback : callable (optional)
+            called on the Tk thread with the exception raised by func, by
+            default the traceback is printed
+        prefetch : bool (optional)
+            run in the prefetch thread and don't report status. Prefetch
+            jobs can be dropped with cancel_prefetch.
+        progress : bool (optional)
+            pass func a progress keyword argument, a callable taking a str
+            describing the current step, which is shown in the status
+
+        Returns
+        -------
+        concurrent.futures.Future
+        '''
+        job = self._jobs.get(key)
+        if job is not None and not job['cancelled']:
+            if callback is not None or error_callback is not None:
+                job['callbacks'].append((callback, error_callback))
+
+            if not prefetch:
+                job['prefetch'] = False
+                job['label'] = label or job['label']
+
+            self._start_polling()
+            return job['future']
+
+        job = {'key': key, 'label': label or str(key), 'prefetch': prefetch,
+               'cancelled': False, 'start': time.time(), 'step': None,
+               'callbacks': []}
+        if callback is not None or error_callback is not None:
+            job['callbacks'].append((callback, error_callback))
+
+        if progress:
+            def report(step):
+                with self._lock:
+                    job['step'] = step
+
+            kwargs['progress'] = report
+
+        pool = self._prefetch_pool if prefetch else self._pool
+        job['future'] = pool.submit(func, *args, **kwargs)
+        self._jobs[key] = job
+        self._start_polling()
+        return job['future']
+
+    def cancel(self, key=None):
+        '''Cancels the job with key or all foreground jobs. Queued jobs
+        never start. Running jobs can't be interrupted, so they are left to
+        finish and their results are discarded.
+        '''
+        if key is None:
+            keys = [k for k, j in self._jobs.items() if not j['prefetch']]
+        else:
+            keys = [key] if key in self._jobs else []
+
+        for k in keys:
+            job = self._jobs[k]
+            job['cancelled'] = True
+            job['future'].cancel()
+
+        self._report_status()
+        return len(keys) > 0
+
+    def cancel_prefetch(self):
+        '''Drops prefetch jobs that no request is waiting on'''
+        for job in self._jobs.values():
+            if job['prefetch']:
+                job['cancelled'] = True
+                job['future'].cancel()
+
+    def is_busy(self):
+        return any(not j['prefetch'] and not j['cancelled']
+                   for j in self._jobs.values())
+
+    def shutdown(self):
+        for job in self._jobs.values():
+            job['cancelled'] = True
+            job['future'].cancel()
+
+        self._pool.shutdown(wait=False)
+        self._prefetch_pool.shutdown(wait=False)
+
+    def _start_polling(self):
+        if not self._polling:
+            self._polling = True
+            self.root.after(self._poll_interval, self._poll)
+
+    def _poll(self):
+        done = [k for k, j in self._jobs.items() if j['future'].done()]
+        for k in done:
+            job = self._jobs.pop(k)
+            if job['cancelled']:
+                continue
+
+            exc = job['future'].exception()
+            for callback, error_callback in job['callbacks']:
+                try:
+                    if exc is None:
+                        if callback is not None:
+                            callback(job['future'].result())
+                    elif error_callback is not None:
+                        error_callback(exc)
+                    else:
+                        traceback.print_exception(type(exc), exc,
+                                                  exc.__traceback__)
+                except Exception:
+                    traceback.print_exc()
+
+            if exc is not None and len(job['callbacks']) == 0 and not job['prefetch']:
+                traceback.print_exception(type(exc), exc, exc.__traceback__)
+
+        self._report_status()
+        if len(self._jobs) > 0:
+            self.root.after(self._poll_interval, self._poll)
+        else:
+            self._polling = False
+
+    def get_status(self):
+        '''Returns a str describing the running foreground job'''
+        jobs = [j for j in self._jobs.values()
+                if not j['prefetch'] and not j['cancelled']]
+        if len(jobs) == 0:
+            return 'Ready'
 
+        job = min(jobs, key=lambda x: x['start'])
+        with self._lock:
+            step = job['step']
+
+        out = '%s (%.0f s)' % (job['label'], time.time() - job['start'])
+        if step is not None:
+            out += ': ' + step
+
+        if len(jobs) > 1:
+            out += ', %i more queued' % (len(jobs) - 1)
+
+        return out
+
+    def _report_status(self):
+        status = self.get_status()
+        if self._status_callback is not None and status != self._last_status:
+            self._status_callback(status)
+
+        self._last_status = status
 
 
 class CheckBar(ttk.Frame):
-    def __init__(self, parent=None, choices=[]):
+    def __init__(self, parent=None, choices=[], command=None):
         tk.Frame.__init__(self, parent)
         self.choices = choices
+        self.command = command
         title = ttk.Label(self, text='Clusters')
         self.choice_rows = []
         self.choice_vars = []
@@ -369,7 +683,8 @@ class CheckBar(ttk.Frame):
         self.choice_vars = [tk.IntVar(self, 0) for i in self.choices]
         self.choice_rows = []
         for choice, var in zip(self.choices, self.choice_vars):
-            check = tk.Checkbutton(self, text=str(choice), variable=var)
+            check = tk.Checkbutton(self, text=str(choice), variable=var,
+                                   command=self.command)
             check.pack(fill='x', anchor='n', pady=5)
             self.choice_rows.append(check)
 
@@ -379,13 +694,19 @@ class CheckBar(ttk.Frame):
         return out
 
 
-def make_waveform_plot(wave, wave_std, n_waves=None,index=None):
+def make_waveform_plot(wave, wave_std, n_waves=None,index=None, image=None):
     minima = min(wave)
     fig, ax = plt.subplots(figsize=(3, 2))
     ax.xaxis.set_tick_params(bottom=False, top=False, labelbottom=False)
     ax.yaxis.set_tick_params(bottom=False, top=False, labelbottom=False)
     fig.tight_layout()
     X = list(range(len(wave)))
+    if image is not None:
+        # density image of all waveforms, from SpikeSorter.get_waveform_image
+        img, y_range = image
+        ax.imshow(img, extent=(0, len(wave)-1, y_range[0], y_range[1]),
+                  aspect='auto', interpolation='nearest')
+
     ax.fill_between(X, [i+j for i,j in zip(wave, wave_std)],
                     [i-j for i,j in zip(wave, wave_std)],
                     alpha=0.4)
@@ -450,7 +771,9 @@ class WaveformPane(ttk.Frame):
             wave = v[0]
             wave_std = v[1]
             n_waves = v[2]
-            fig = make_waveform_plot(wave, wave_std, n_waves=n_waves, index=k)
+            image = v[3] if len(v) > 3 else None
+            fig = make_waveform_plot(wave, wave_std, n_waves=n_waves, index=k,
+                                     image=image)
             self._all_figs.append(fig)
 
             if row is None: